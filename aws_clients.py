@@ -0,0 +1,217 @@
+#----------------
+# aws_clients.py
+#-----------------
+# Process-wide registry of boto3 sessions and clients.
+#
+# boto3 clients are thread-safe, so one client per (profile, region, role,
+# service) is shared by every helper and every thread. Resources are not thread-safe,
+# so they are cached per thread instead.
+#
+# Every client is created with the request scheduler (scheduler.py) and the
+# API call tracer (tracing.py) installed, unless configure(scheduler=False)
+# or configure(tracing=False) is used.
+#
+# boto3 and botocore are imported on first use rather than at import time,
+# so short CLI invocations that never reach AWS do not pay for loading them.
+import weakref
+import threading
+from scheduler import get_scheduler
+from tracing import get_tracer
+
+_lock = threading.Lock()
+_local = threading.local()
+_sessions = {}
+_clients = {}
+_credentials = {}
+_accounts = {}
+_single_attempt = weakref.WeakKeyDictionary()
+_scopes = weakref.WeakKeyDictionary()
+_generation = 0
+
+_settings = {
+  'profile': None,
+  'region': None,
+  # IAM role to assume (through STS) for every client, unless get_client() names one
+  'role': None,
+  'role_session_name': 'my-functions',
+  'role_duration': 3600,
+  'max_pool_connections': 50,
+  'tcp_keepalive': True,
+  'connect_timeout': 10,
+  'read_timeout': 60,
+  'retries': {'max_attempts': 10, 'mode': 'standard'},
+  'scheduler': True,
+  'tracing': True,
+  # extra callables run on every new client, e.g. to register event handlers
+  'client_hooks': (),
+}
+
+def configure(**settings):
+  # Change the defaults used for new clients. Existing clients are dropped so
+  # the next get_client() picks the new settings up.
+  global _generation
+  unknown = set(settings) - set(_settings)
+  if unknown:
+    raise TypeError(f'unknown client settings: {sorted(unknown)}')
+  with _lock:
+    _settings.update(settings)
+    _sessions.clear()
+    _clients.clear()
+    _credentials.clear()
+    _accounts.clear()
+    _generation += 1
+
+def reset_clients():
+  configure()
+
+def client_config():
+  from botocore.config import Config
+  return Config(
+    max_pool_connections=_settings['max_pool_connections'],
+    tcp_keepalive=_settings['tcp_keepalive'],
+    connect_timeout=_settings['connect_timeout'],
+    read_timeout=_settings['read_timeout'],
+    retries=dict(_settings['retries']),
+  )
+
+def _key(service, profile, region, role):
+  if profile is None:
+    profile = _settings['profile']
+  if region is None:
+    region = _settings['region']
+  if role is None:
+    role = _settings['role']
+  return (profile, region, role, service)
+
+def _assume_role(profile, role):
+  # Fetches the role's temporary credentials from STS, with the profile's own
+  # credentials, in the format botocore's refreshable credentials expect.
+  def fetch():
+    with _lock:
+      sts = _session(profile, None, None).client('sts', config=client_config())
+    credentials = sts.assume_role(RoleArn=role, RoleSessionName=_settings['role_session_name'],
+                                  DurationSeconds=_settings['role_duration'])['Credentials']
+    return {
+      'access_key': credentials['AccessKeyId'],
+      'secret_key': credentials['SecretAccessKey'],
+      'token': credentials['SessionToken'],
+      'expiry_time': credentials['Expiration'].isoformat(),
+    }
+  return fetch
+
+def _role_credentials(profile, role):
+  # caller must hold _lock. One set of credentials per (profile, role), so
+  # every region of an account shares a single AssumeRole call; they are
+  # fetched on first use and refreshed by botocore before they expire.
+  credentials = _credentials.get((profile, role))
+  if credentials is None:
+    from botocore.credentials import DeferredRefreshableCredentials
+    credentials = DeferredRefreshableCredentials(refresh_using=_assume_role(profile, role), method='sts-assume-role')
+    _credentials[(profile, role)] = credentials
+  return credentials
+
+def _session(profile, region, role):
+  # caller must hold _lock; boto3 sessions are not safe to share while
+  # clients are being created from them.
+  session = _sessions.get((profile, region, role))
+  if session is None:
+    import boto3
+    if role is None:
+      session = boto3.session.Session(profile_name=profile, region_name=region)
+    else:
+      import botocore.session
+      core = botocore.session.get_session()
+      core._credentials = _role_credentials(profile, role)
+      session = boto3.session.Session(botocore_session=core, region_name=region)
+    _sessions[(profile, region, role)] = session
+  return session
+
+def _scope(key):
+  # the account (profile, role) and region a client's calls are throttled in
+  profile, region, role, service = key
+  return (profile, role, region)
+
+def client_scope(client):
+  # (profile, role, region) get_client() made the client for; for any other
+  # client (None, None, its region)
+  return _scopes.get(client) or (None, None, client.meta.region_name)
+
+def _install(client, scope):
+  _scopes[client] = scope
+  if _settings['scheduler']:
+    get_scheduler().install(client, scope)
+  if _settings['tracing']:
+    get_tracer().install(client)
+  for hook in _settings['client_hooks']:
+    hook(client)
+  return client
+
+def get_client(service, profile=None, region=None, role=None):
+  key = _key(service, profile, region, role)
+  client = _clients.get(key)
+  if client is not None:
+    return client
+  with _lock:
+    client = _clients.get(key)
+    if client is None:
+      client = _session(key[0], key[1], key[2]).client(service, config=client_config())
+      _install(client, _scope(key))
+      _clients[key] = client
+  return client
+
+def get_resource(service, profile=None, region=None, role=None):
+  key = _key(service, profile, region, role)
+  cache = getattr(_local, 'resources', None)
+  if cache is None or _local.generation != _generation:
+    cache = _local.resources = {}
+    _local.generation = _generation
+  resource = cache.get(key)
+  if resource is None:
+    with _lock:
+      resource = _session(key[0], key[1], key[2]).resource(service, config=client_config())
+    _install(resource.meta.client, _scope(key))
+    cache[key] = resource
+  return resource
+
+def account_id(client):
+  # The account of the credentials a client signs with: one STS call per
+  # access key. Process-wide caches of account resources (launch templates,
+  # baked images) are keyed on it, so targets in other accounts never see
+  # each other's IDs.
+  credentials = client._request_signer._credentials
+  if credentials is None:
+    return None
+  frozen = credentials.get_frozen_credentials()
+  account = _accounts.get(frozen.access_key)
+  if account is None:
+    with _lock:
+      sts = _session(None, None, None).client(
+        'sts', region_name=client.meta.region_name, config=client_config(), aws_access_key_id=frozen.access_key,
+        aws_secret_access_key=frozen.secret_key, aws_session_token=frozen.token)
+    account = _accounts[frozen.access_key] = sts.get_caller_identity()['Account']
+  return account
+
+def single_attempt(client):
+  # The client's twin that makes every call exactly once. botocore retries
+  # 5xx errors, and InsufficientInstanceCapacity is one, so a caller that
+  # falls back to something else on an error (capacity.py) would otherwise
+  # wait out the whole retry schedule first. Same credentials, region,
+  # endpoint and hooks.
+  twin = _single_attempt.get(client)
+  if twin is not None:
+    return twin
+  import boto3
+  import botocore.session
+  from botocore.config import Config
+  with _lock:
+    twin = _single_attempt.get(client)
+    if twin is None:
+      core = botocore.session.get_session()
+      core._credentials = client._request_signer._credentials
+      session = boto3.session.Session(botocore_session=core, region_name=client.meta.region_name)
+      twin = session.client(client.meta.service_model.service_name, endpoint_url=client.meta.endpoint_url,
+                            config=client.meta.config.merge(Config(retries={'total_max_attempts': 1,
+                                                                            'mode': 'standard'})))
+      _install(twin, _scopes.get(client))
+      _single_attempt[client] = twin
+  return twin
@@ -0,0 +1,148 @@
+#----------------
+# bake.py
+#-----------------
+# Baked AMIs, keyed by a hash of what went into them.
+#
+# bake_image() launches a builder instance from the base AMI with the
+# userdata, lets the userdata run to completion (the builder shuts itself
+# down at the end), creates an image from the stopped builder and tags it
+# with bake_key(base AMI, userdata, instance type family).
+#
+# Launching from baked images is opt-in, with use_baked_images(): a baked
+# image holds whatever the userdata did on the builder, so it is only right
+# for userdata that installs and nothing else. Userdata with per-boot steps
+# (starting services, writing the instance's own address somewhere) must
+# not be baked. Once enabled, the launch helpers (setup_instance(),
+# setup_instances(), capacity and the warm pool) look the key up with
+# baked_image() and launch from the baked image without userdata, so the
+# boot-time install is skipped entirely.
+#
+#   from bake import bake_image, use_baked_images
+#   bake_image(AMI, userdata, 'm5.4xlarge', subnet_id, security_group_id)
+#   use_baked_images()
+import hashlib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from aws_clients import get_client, account_id
+
+BAKE_TAG = 'bake-key'
+
+_SHUTDOWN = 'shutdown -h now\n'
+
+_images = {}
+_images_lock = threading.Lock()
+_enabled = False
+
+def instance_family(instance_type):
+  return instance_type.split('.', 1)[0]
+
+def bake_key(base_ami, userdata, instance_type):
+  text = '\0'.join([base_ami, userdata or '', instance_family(instance_type)])
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def with_shutdown(userdata):
+  # Userdata that stops the instance once it has run, for bake builders and
+  # warm pool instances. cloud-init only runs a script that starts with #!,
+  # so no userdata (a baked image's) becomes a script of its own and
+  # cloud-config gets the script as a second MIME part.
+  if not userdata or not userdata.strip():
+    return '#!/bin/bash\n' + _SHUTDOWN
+  if userdata.lstrip().startswith('#!'):
+    return userdata.rstrip('\n') + '\n' + _SHUTDOWN
+  if userdata.lstrip().startswith('#cloud-config'):
+    message = MIMEMultipart()
+    message.attach(MIMEText(userdata, 'cloud-config'))
+    message.attach(MIMEText('#!/bin/bash\n' + _SHUTDOWN, 'x-shellscript'))
+    return message.as_string()
+  raise ValueError('userdata is neither a script nor cloud-config, no shutdown can be added to it')
+
+def find_baked_image(key, client=None):
+  client = client or get_client('ec2')
+  images = client.describe_images(Owners=['self'], Filters=[
+    {'Name': f'tag:{BAKE_TAG}', 'Values': [key]},
+    {'Name': 'state', 'Values': ['available']},
+  ])['Images']
+  if not images:
+    return None
+  return max(images, key=lambda image: image.get('CreationDate', ''))['ImageId']
+
+def baked_image(base_ami, userdata, instance_type, client=None):
+  # The baked image ID for these inputs, or None. The answer, found or not,
+  # is remembered for the life of the process, per account and region, so
+  # every launch candidate after the first costs no DescribeImages; an image
+  # baked here since replaces a miss, one baked elsewhere is picked up after
+  # reset_images().
+  client = client or get_client('ec2')
+  key = (bake_key(base_ami, userdata, instance_type), account_id(client), client.meta.region_name)
+  with _images_lock:
+    if key in _images:
+      return _images[key]
+  image_id = find_baked_image(key[0], client=client)
+  with _images_lock:
+    return _images.setdefault(key, image_id)
+
+def reset_images():
+  with _images_lock:
+    _images.clear()
+
+def use_baked_images(enabled=True):
+  global _enabled
+  _enabled = enabled
+
+def launch_image(base_ami, userdata, instance_type, client=None):
+  # (AMI, userdata) to launch with: the baked image and no userdata when
+  # baked images are in use and one exists, the inputs unchanged otherwise
+  if not _enabled or not userdata:
+    return base_ami, userdata
+  image_id = baked_image(base_ami, userdata, instance_type, client=client)
+  if image_id is None:
+    return base_ami, userdata
+  return image_id, ''
+
+def bake_image(base_ami, userdata, instance_type, subnet_id, security_group_id, key_pair_name=None,
+               timeout=3600, client=None):
+  from my_functions import instance_params, log
+  from waiters import wait_for
+  client = client or get_client('ec2')
+  key = bake_key(base_ami, userdata, instance_type)
+  image_id = find_baked_image(key, client=client)
+  if image_id:
+    log('Baked AMI already exists', image_id)
+  else:
+    name = f'bake-{key[:16]}'
+    params = instance_params(base_ami, subnet_id, security_group_id, key_pair_name, with_shutdown(userdata),
+                             instance_type, True,
+                             [{'Key': 'Name', 'Value': name}, {'Key': 'auto-delete', 'Value': 'yes'}])
+    # the builder's data volume would outlive it, and does not belong in the image
+    params.pop('BlockDeviceMappings')
+    if key_pair_name is None:
+      params.pop('KeyName')
+    params['InstanceInitiatedShutdownBehavior'] = 'stop'
+    builder_id = client.run_instances(**params)['Instances'][0]['InstanceId']
+    log('AMI builder launched', name)
+    try:
+      wait_for('instance', builder_id, 'stopped', client=client, timeout=timeout)
+      image_id = client.create_image(
+        InstanceId=builder_id,
+        Name=name,
+        Description=f'{base_ami} baked for {instance_family(instance_type)}',
+        TagSpecifications=[
+          {
+            'ResourceType': 'image',
+            'Tags': [
+              {'Key': 'Name', 'Value': name},
+              {'Key': BAKE_TAG, 'Value': key},
+              {'Key': 'base-ami', 'Value': base_ami},
+              {'Key': 'instance-family', 'Value': instance_family(instance_type)},
+            ]
+          }
+        ]
+      )['ImageId']
+      wait_for('image', image_id, 'available', client=client, timeout=timeout)
+    finally:
+      client.terminate_instances(InstanceIds=[builder_id])
+    log('AMI baked', image_id)
+  with _images_lock:
+    _images[(key, account_id(client), client.meta.region_name)] = image_id
+  return image_id
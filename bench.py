@@ -0,0 +1,293 @@
+#----------------
+# bench.py
+#-----------------
+# Offline provisioning benchmarks with API-call and latency budgets.
+#
+# Runs the launch_ec2.py topology, a converged rerun, the teardown and
+# scaled-up variants (N subnets, N instances, N environments) against moto,
+# a local EC2/ELBv2 stand-in, with a configurable latency injected per API
+# operation. For every scenario it reports wall time, API calls per helper
+# and per operation, and peak Python memory. Only the scenario's own run is
+# measured: moto is warmed up and the desired topology built beforehand,
+# and the wall time comes from a pass without tracemalloc, the peak memory
+# from a second one. Budgets are kept in
+# bench_budgets.json; a scenario that makes more API calls than its budget,
+# runs slower than its budget plus a tolerance, or has no budget at all,
+# fails the run.
+#
+#   python bench.py                     # run all scenarios, check budgets
+#   python bench.py --record            # run and record the current numbers as budgets
+#   python bench.py -s launch -s scaled_instances --latency 0.05
+#
+# Needs moto (pip install moto).
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+import inventory
+import waiters
+import templates
+import bake
+from tracing import get_tracer
+from scheduler import category
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_budgets.json')
+REGION = 'us-west-2'
+AZS = ['us-west-2a', 'us-west-2b', 'us-west-2c']
+
+def _mock_aws():
+  try:
+    from moto import mock_aws
+    return mock_aws()
+  except ImportError:
+    # moto < 5
+    from moto import mock_ec2, mock_elbv2
+    class _Both:
+      def __enter__(self):
+        self.mocks = [mock_ec2(), mock_elbv2()]
+        for mock in self.mocks:
+          mock.start()
+      def __exit__(self, *exc):
+        for mock in reversed(self.mocks):
+          mock.stop()
+    return _Both()
+
+class StandIn:
+  # moto with injected per-operation latency. latency maps operation names
+  # (RunInstances, DescribeVpcs, ...) to seconds; 'default' covers the rest.
+  def __init__(self, latency=None):
+    self.latency = dict(latency or {})
+    self._mock = None
+
+  def _sleep(self, model, **kwargs):
+    delay = self.latency.get(model.name, self.latency.get('default', 0))
+    if delay:
+      time.sleep(delay)
+
+  def _hook(self, client):
+    client.meta.events.register('before-call', self._sleep, unique_id='bench-latency')
+
+  def __enter__(self):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+      os.environ[name] = 'testing'
+    os.environ['AWS_DEFAULT_REGION'] = REGION
+    self._mock = _mock_aws()
+    self._mock.__enter__()
+    aws_clients.configure(region=REGION, profile=None, client_hooks=(self._hook,))
+    waiters.use_waiter_service(waiters.WaiterService(delay_scale=0.01))
+    inventory.use_inventory(None)
+    # every stand-in is a fresh account: nothing cached from the last one is valid
+    templates.reset_templates()
+    bake.reset_images()
+    return self
+
+  def __exit__(self, *exc):
+    inventory.use_inventory(None)
+    templates.reset_templates()
+    bake.reset_images()
+    aws_clients.configure(client_hooks=())
+    self._mock.__exit__(*exc)
+
+def topology(prefix='LinuxEnv', n_subnets=1, n_instances=1):
+  client = aws_clients.get_client('ec2')
+  ami = client.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+  key_pair_name = f'{prefix}KeyPair'
+  try:
+    client.create_key_pair(KeyName=key_pair_name)
+  except Exception:
+    pass
+  subnets = [{'name': f'{prefix}Public{i}', 'cidr': f'10.0.{i}.0/24', 'az': AZS[i % len(AZS)]}
+             for i in range(n_subnets)]
+  return {
+    'vpc': {'name': f'{prefix}Vpc', 'cidr': '10.0.0.0/16'},
+    'internet_gateway': {'name': f'{prefix}Igw'},
+    'route_table': {'name': f'{prefix}RTPublic'},
+    'subnets': subnets,
+    'security_groups': [{'name': f'{prefix}Sg', 'ingress': [('tcp', 22, 22, '0.0.0.0/0'), ('tcp', 80, 80, '0.0.0.0/0')]}],
+    'instances': [{'name': f'{prefix}Worker{i}', 'ami': ami, 'instance_type': 'm5.large',
+                   'subnet': subnets[i % n_subnets]['name'], 'security_group': f'{prefix}Sg',
+                   'key_pair': key_pair_name, 'userdata': '', 'public': True}
+                  for i in range(n_instances)],
+  }
+
+def _provision(desired):
+  from plan import plan, apply, PLAN_KINDS
+  inventory.snapshot(kinds=PLAN_KINDS)
+  return apply(plan(desired))
+
+def _teardown(desired):
+  from teardown import teardown_vpc
+  inventory.use_inventory(None)
+  return teardown_vpc(desired['vpc']['name'])
+
+# scenario -> (setup run outside the measurement, measured run)
+def _launch(n_subnets=1, n_instances=1):
+  def setup(state):
+    state['desired'] = topology(n_subnets=n_subnets, n_instances=n_instances)
+  def measured(state):
+    _provision(state['desired'])
+  return setup, measured
+
+def _rerun():
+  def setup(state):
+    state['desired'] = topology()
+    _provision(state['desired'])
+  def measured(state):
+    _provision(state['desired'])
+  return setup, measured
+
+def _teardown_scenario(n_instances=1):
+  def setup(state):
+    state['desired'] = topology(n_instances=n_instances)
+    _provision(state['desired'])
+  def measured(state):
+    _teardown(state['desired'])
+  return setup, measured
+
+def _environments(n):
+  def setup(state):
+    state['desired'] = [topology(prefix=f'Env{i}') for i in range(n)]
+  def measured(state):
+    # one VPC per environment, all environments provisioned concurrently
+    with ThreadPoolExecutor(max_workers=n) as pool:
+      list(pool.map(_provision_isolated, state['desired']))
+  return setup, measured
+
+def _provision_isolated(desired):
+  from plan import plan, apply
+  snapshot = inventory.Inventory().load(kinds=['vpc', 'internet_gateway', 'route_table', 'subnet',
+                                              'security_group', 'instance'])
+  return apply(plan(desired, inventory=snapshot))
+
+SCENARIOS = {
+  'launch': lambda: _launch(),
+  'rerun': lambda: _rerun(),
+  'teardown': lambda: _teardown_scenario(),
+  'scaled_subnets': lambda: _launch(n_subnets=12, n_instances=1),
+  'scaled_instances': lambda: _launch(n_subnets=3, n_instances=20),
+  'scaled_teardown': lambda: _teardown_scenario(n_instances=20),
+  'environments': lambda: _environments(5),
+}
+
+def warm_up():
+  # moto builds a region's backends, and loads its AMI catalogue, on first
+  # use; that is paid here rather than by the first measured call
+  client = aws_clients.get_client('ec2')
+  client.describe_images(Owners=['amazon'])
+  client.describe_vpcs()
+  client.describe_instances()
+  aws_clients.get_client('elbv2').describe_load_balancers()
+
+def _measure(name, latency, trace_memory):
+  # one pass of a scenario on a fresh stand-in: (wall time, peak memory)
+  setup, measured = SCENARIOS[name]()
+  state = {}
+  with StandIn(latency=latency):
+    warm_up()
+    if setup is not None:
+      setup(state)
+    get_tracer().reset()
+    if trace_memory:
+      tracemalloc.start()
+    start = time.monotonic()
+    measured(state)
+    wall = time.monotonic() - start
+    peak = None
+    if trace_memory:
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+  return wall, peak
+
+def run_scenario(name, latency):
+  # Two passes: the wall time and API calls of one without tracemalloc,
+  # which slows everything down several times over, and the peak memory of
+  # another.
+  tracer = get_tracer()
+  wall, _ = _measure(name, latency, trace_memory=False)
+  operations = dict((op, totals.calls) for op, totals in tracer.operation_totals().items())
+  helpers = dict((helper, totals.calls) for helper, totals in tracer.helper_totals().items())
+  _, peak = _measure(name, latency, trace_memory=True)
+  mutating = sum(count for op, count in operations.items() if category(op.split('.', 1)[1]) == 'mutate')
+  return {
+    'wall': wall,
+    'calls': sum(operations.values()),
+    'mutating_calls': mutating,
+    'peak_memory': peak,
+    'operations': operations,
+    'helpers': helpers,
+  }
+
+def load_budgets(path=BUDGET_FILE):
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+def save_budgets(results, path=BUDGET_FILE):
+  budgets = load_budgets(path)
+  for name, result in results.items():
+    budgets[name] = {'calls': result['calls'], 'mutating_calls': result['mutating_calls'],
+                     'wall': round(result['wall'], 3)}
+  with open(path, 'w') as f:
+    json.dump(budgets, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+def check_budget(name, result, budgets, tolerance):
+  budget = budgets.get(name)
+  if budget is None:
+    # a scenario without a budget can not regress, so it fails until one is recorded
+    return [f'{name}: no budget recorded (python bench.py --record -s {name})']
+  failures = []
+  for key in ('calls', 'mutating_calls'):
+    if key in budget and result[key] > budget[key]:
+      failures.append(f'{name}: {result[key]} {key.replace("_", " ")}, budget {budget[key]}')
+  if 'wall' in budget and result['wall'] > budget['wall'] * (1 + tolerance):
+    failures.append(f'{name}: {result["wall"]:.2f}s wall time, budget {budget["wall"]:.2f}s (+{tolerance:.0%})')
+  return failures
+
+def report(name, result):
+  lines = [f'== {name}: {result["wall"]:.2f}s, {result["calls"]} API calls '
+           f'({result["mutating_calls"]} mutating), peak memory {result["peak_memory"] / 1024:.0f} KiB']
+  for helper, count in sorted(result['helpers'].items(), key=lambda item: -item[1]):
+    lines.append(f'   {helper:<40}{count:>6}')
+  return '\n'.join(lines)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Offline provisioning benchmarks')
+  parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS))
+  parser.add_argument('--latency', type=float, default=0.02, help='injected latency per API call, seconds')
+  parser.add_argument('--op-latency', action='append', default=[], metavar='OPERATION=SECONDS',
+                      help='latency for one operation, e.g. RunInstances=0.5')
+  parser.add_argument('--record', action='store_true', help='record the results as the new budgets')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='allowed wall time regression')
+  parser.add_argument('--budgets', default=BUDGET_FILE)
+  args = parser.parse_args(argv)
+
+  latency = {'default': args.latency}
+  for item in args.op_latency:
+    operation, seconds = item.split('=', 1)
+    latency[operation] = float(seconds)
+
+  budgets = load_budgets(args.budgets)
+  results = {}
+  failures = []
+  for name in args.scenario or list(SCENARIOS):
+    results[name] = run_scenario(name, latency)
+    print(report(name, results[name]))
+    failures += check_budget(name, results[name], budgets, args.tolerance)
+
+  if args.record:
+    save_budgets(results, args.budgets)
+    print(f'budgets recorded in {args.budgets}')
+    return 0
+  for failure in failures:
+    print(f'BUDGET CHECK FAILED {failure}')
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
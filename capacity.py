@@ -0,0 +1,137 @@
+#----------------
+# capacity.py
+#-----------------
+# Capacity-aware launches that fall back across instance types, AZs and
+# purchase options.
+#
+# A candidate is an (instance type, subnet ID, market) triple, the market
+# being 'on-demand' or 'spot'. launch_capacity() asks the candidates, in
+# rank order, for the instances that are still missing. A capacity error
+# costs one API round trip before the next candidate is asked, instead of
+# a failed run: RunInstances is called without botocore's retries, which
+# would otherwise back off on the (5xx) capacity errors for a minute.
+#
+# Hedging is opt-in: with parallel > 1 that many candidates are asked at
+# once, each for everything still missing, which hides a slow candidate
+# behind the next one. Together they can launch more than was asked for,
+# and the extra instances, those of the lowest ranked candidates, are
+# terminated right away. Hedged launches delete their data volume on
+# termination, so the extra instances leave no volume behind.
+#
+#   ranked = candidates(['m5.4xlarge', 'm5a.4xlarge', 'm6i.4xlarge'], subnet_ids, ['spot', 'on-demand'])
+#   instances = launch_capacity(AMI, ranked, security_group_id, ['RHEL8'], key_pair_name, userdata, True)
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+from handles import Instance
+from inventory import remember
+from journal import client_token
+from bake import launch_image
+from my_functions import CAPACITY_ERRORS, launch_params, run_instances, create_name_tag, _existing_instances, log
+
+# errors after which the next candidate is asked: no capacity, a type the
+# AZ does not offer, no spot capacity at the price or no spot quota left
+FALLBACK_ERRORS = CAPACITY_ERRORS | {
+  'Unsupported', 'InsufficientFreeAddressesInSubnet', 'SpotMaxPriceTooLow', 'MaxSpotInstanceCountExceeded',
+}
+
+SPOT_OPTIONS = {
+  'MarketType': 'spot',
+  'SpotOptions': {'SpotInstanceType': 'one-time', 'InstanceInterruptionBehavior': 'terminate'},
+}
+
+def candidates(instance_types, subnet_ids, markets=('on-demand',)):
+  # Ranks the candidates: instance type first, then market, then subnet. The
+  # preferred type in any AZ is better than a fallback type.
+  return [(instance_type, subnet_id, market)
+          for instance_type in instance_types for market in markets for subnet_id in subnet_ids]
+
+def launch_candidate(candidate, count, AMI, security_group_id, key_pair_name, userdata, bool_public, tags,
+                     token=None, delete_on_termination=False, client=None):
+  # up to count instances from one candidate, [] when it has no capacity
+  client = client or get_client('ec2')
+  instance_type, subnet_id, market = candidate
+  AMI, userdata = launch_image(AMI, userdata, instance_type, client=client)
+
+  def params():
+    params = launch_params(AMI, subnet_id, security_group_id, key_pair_name, userdata, instance_type, bool_public,
+                           tags, count=count, delete_on_termination=delete_on_termination, client=client)
+    if market == 'spot':
+      params['InstanceMarketOptions'] = SPOT_OPTIONS
+    return params
+  try:
+    instances = run_instances(params, token, once=True, client=client)
+  except ClientError as e:
+    if e.response['Error']['Code'] in FALLBACK_ERRORS:
+      log(f'EC2 capacity short: {instance_type} {market} in {subnet_id}', e.response['Error']['Code'])
+      return []
+    raise
+  for record in instances:
+    record.setdefault('State', {'Name': 'pending'})
+    record.setdefault('SubnetId', subnet_id)
+    record.setdefault('InstanceType', instance_type)
+  return instances
+
+def terminate_extra(instance_ids, client=None):
+  client = client or get_client('ec2')
+  if instance_ids:
+    client.terminate_instances(InstanceIds=list(instance_ids))
+    log('EC2 extra instances terminated', ', '.join(instance_ids))
+
+def launch_capacity(AMI, candidates, security_group_id, instance_names, key_pair_name, userdata, bool_public,
+                    parallel=1, client=None):
+  # Launch the instances of instance_names that do not exist yet from the
+  # first candidates that have capacity. Returns the handles in the order
+  # of instance_names. Names that no candidate could launch are missing
+  # from the list.
+  client = client or get_client('ec2')
+  candidates = list(candidates)
+  instance_names = list(instance_names)
+  records = _existing_instances(instance_names, client)
+  for name in records:
+    log('EC2 Instance already exists', name)
+  missing = [name for name in instance_names if name not in records]
+  tags = [{'Key': 'auto-delete', 'Value': 'no'}]
+  launched = []
+  error = None
+  ranked = iter(enumerate(candidates))
+  running = {}
+  with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+    while True:
+      short = len(missing) - len(launched)
+      while error is None and short > 0 and len(running) < parallel:
+        item = next(ranked, None)
+        if item is None:
+          break
+        rank, candidate = item
+        # tokens are taken here, on the thread of the journaled step
+        running[pool.submit(launch_candidate, candidate, short, AMI, security_group_id, key_pair_name, userdata,
+                            bool_public, tags, client_token(f'capacity:{rank}:{short}'), parallel > 1,
+                            client)] = rank
+      if not running:
+        break
+      finished, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in finished:
+        rank = running.pop(future)
+        try:
+          launched.extend((rank, record) for record in future.result())
+        except Exception as e:
+          if error is None:
+            error = e
+    if error is not None:
+      # nothing is left half launched
+      terminate_extra([record['InstanceId'] for rank, record in launched], client=client)
+      raise error
+    launched.sort(key=lambda item: item[0])
+    terminate_extra([record['InstanceId'] for rank, record in launched[len(missing):]], client=client)
+    named = list(zip(missing, (record for rank, record in launched)))
+    list(pool.map(lambda item: create_name_tag(item[1]['InstanceId'], item[0], client=client), named))
+  for name, record in named:
+    record['Tags'] = [{'Key': 'Name', 'Value': name}] + tags
+    records[name] = remember('instance', record, client=client)
+    market = 'spot' if record.get('InstanceLifecycle') == 'spot' else 'on-demand'
+    log(f'EC2 Instance created ({record["InstanceType"]} {market} in {record["SubnetId"]})', name)
+  missing = [name for name in missing if name not in records]
+  if missing:
+    log('EC2 Instances not launched', ', '.join(missing))
+  return [Instance.from_record(records[name], client) for name in instance_names if name in records]
@@ -0,0 +1,107 @@
+#----------------
+# dag.py
+#-----------------
+# Small dependency-graph executor for provisioning steps.
+#
+# Every node is a callable that receives the results of the nodes finished so
+# far (a dict keyed by node name). A node is started on the thread pool as
+# soon as all of its dependencies have finished, so the total run time is set
+# by the longest chain of dependent steps instead of the sum of all steps.
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Dag:
+  def __init__(self):
+    self.nodes = {}
+    self.results = {}
+    self.timings = {}
+    self.wall_time = 0.0
+    self._t0 = None
+
+  def add(self, name, fn, deps=()):
+    # Dependencies must already be in the graph, so nodes are always added in
+    # topological order and the graph can not contain a cycle.
+    if name in self.nodes:
+      raise ValueError(f'node {name} already exists')
+    for dep in deps:
+      if dep not in self.nodes:
+        raise ValueError(f'node {name} depends on unknown node {dep}')
+    self.nodes[name] = (fn, tuple(deps))
+    return name
+
+  def _call(self, name, fn):
+    start = time.monotonic() - self._t0
+    try:
+      return fn(self.results)
+    finally:
+      self.timings[name] = (start, time.monotonic() - self._t0)
+
+  def _ready(self, pending):
+    return [name for name, (fn, deps) in pending.items()
+            if all(dep in self.results for dep in deps)]
+
+  def run(self, max_workers=8):
+    pending = dict((name, node) for name, node in self.nodes.items() if name not in self.results)
+    running = {}
+    error = None
+    self._t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+      while running or (pending and error is None):
+        if error is None:
+          for name in self._ready(pending):
+            fn, deps = pending.pop(name)
+            running[pool.submit(self._call, name, fn)] = name
+        if not running:
+          break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          try:
+            self.results[name] = future.result()
+          except Exception as e:
+            # stop scheduling new nodes, let the running ones finish
+            if error is None:
+              error = e
+    self.wall_time = time.monotonic() - self._t0
+    if error is not None:
+      raise error
+    return self.results
+
+  def duration(self, name):
+    start, end = self.timings[name]
+    return end - start
+
+  def critical_path(self):
+    # Longest chain of dependent nodes by measured duration.
+    finish = {}
+    previous = {}
+    for name, (fn, deps) in self.nodes.items():
+      if name not in self.timings:
+        continue
+      before = [dep for dep in deps if dep in finish]
+      longest = max(before, key=lambda dep: finish[dep], default=None)
+      previous[name] = longest
+      finish[name] = self.duration(name) + (finish[longest] if longest else 0.0)
+    if not finish:
+      return [], 0.0
+    name = max(finish, key=lambda n: finish[n])
+    total = finish[name]
+    path = []
+    while name is not None:
+      path.append(name)
+      name = previous[name]
+    return list(reversed(path)), total
+
+  def report(self):
+    path, total = self.critical_path()
+    lines = []
+    for name in self.nodes:
+      if name not in self.timings:
+        continue
+      start, end = self.timings[name]
+      mark = '*' if name in path else ' '
+      lines.append(f'{mark} {name:<20}\t{start:8.2f}s\t{end:8.2f}s\t{end - start:8.2f}s')
+    busy = sum(self.duration(name) for name in self.timings)
+    lines.append(f'critical path: {" -> ".join(path)} ({total:.2f}s)')
+    lines.append(f'wall time: {self.wall_time:.2f}s, sum of steps: {busy:.2f}s')
+    return '\n'.join(lines)
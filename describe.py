@@ -0,0 +1,146 @@
+#----------------
+# describe.py
+#-----------------
+# Streaming describe generators built on botocore paginators.
+#
+# iter_instances(filters), iter_subnets(filters), ... yield one record per
+# resource (instances are flattened out of their reservations) and fetch the
+# next page only when the caller asks for more, so memory stays bounded by
+# one page and a caller that stops early never fetches the remaining pages.
+# Filters are always passed to the API so the filtering happens server side.
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+
+KINDS = {
+  'vpc': {'service': 'ec2', 'operation': 'describe_vpcs', 'key': 'Vpcs', 'id': 'VpcId', 'id_filter': 'vpc-id'},
+  'subnet': {'service': 'ec2', 'operation': 'describe_subnets', 'key': 'Subnets', 'id': 'SubnetId', 'id_filter': 'subnet-id'},
+  'internet_gateway': {'service': 'ec2', 'operation': 'describe_internet_gateways', 'key': 'InternetGateways', 'id': 'InternetGatewayId',
+                       'id_filter': 'internet-gateway-id'},
+  'route_table': {'service': 'ec2', 'operation': 'describe_route_tables', 'key': 'RouteTables', 'id': 'RouteTableId',
+                  'id_filter': 'route-table-id'},
+  'security_group': {'service': 'ec2', 'operation': 'describe_security_groups', 'key': 'SecurityGroups', 'id': 'GroupId',
+                     'id_filter': 'group-id'},
+  'instance': {'service': 'ec2', 'operation': 'describe_instances', 'key': 'Reservations', 'id': 'InstanceId',
+               'id_filter': 'instance-id', 'state_filter': 'instance-state-name'},
+  'elastic_ip': {'service': 'ec2', 'operation': 'describe_addresses', 'key': 'Addresses', 'id': 'AllocationId',
+                 'id_filter': 'allocation-id'},
+  'nat_gateway': {'service': 'ec2', 'operation': 'describe_nat_gateways', 'key': 'NatGateways', 'id': 'NatGatewayId',
+                  'id_filter': 'nat-gateway-id', 'state_filter': 'state'},
+  'volume': {'service': 'ec2', 'operation': 'describe_volumes', 'key': 'Volumes', 'id': 'VolumeId', 'id_filter': 'volume-id',
+             'state_filter': 'status'},
+  'network_interface': {'service': 'ec2', 'operation': 'describe_network_interfaces', 'key': 'NetworkInterfaces',
+                        'id': 'NetworkInterfaceId', 'id_filter': 'network-interface-id'},
+  'key_pair': {'service': 'ec2', 'operation': 'describe_key_pairs', 'key': 'KeyPairs', 'id': 'KeyPairId',
+               'id_filter': 'key-pair-id', 'name': 'KeyName', 'name_filter': 'key-name'},
+  'load_balancer': {'service': 'elbv2', 'operation': 'describe_load_balancers', 'key': 'LoadBalancers', 'id': 'LoadBalancerArn',
+                    'id_param': 'LoadBalancerArns', 'name': 'LoadBalancerName', 'name_param': 'Names'},
+  'target_group': {'service': 'elbv2', 'operation': 'describe_target_groups', 'key': 'TargetGroups', 'id': 'TargetGroupArn',
+                   'id_param': 'TargetGroupArns', 'name': 'TargetGroupName', 'name_param': 'Names'},
+}
+
+# elbv2 fails the whole call when a name or ARN does not exist
+_NOT_FOUND = {'LoadBalancerNotFound', 'TargetGroupNotFound'}
+
+def record_id(kind, record):
+  return record[KINDS[kind]['id']]
+
+def record_name(kind, record):
+  spec = KINDS[kind]
+  if 'name' in spec:
+    return record.get(spec['name'])
+  return tag_value(record, 'Name')
+
+def tag_value(record, key):
+  for tag in record.get('Tags') or []:
+    if tag['Key'] == key:
+      return tag['Value']
+  return None
+
+def record_state(kind, record):
+  if kind == 'instance':
+    return record['State']['Name']
+  if kind in ('nat_gateway', 'volume'):
+    return record['State']
+  return None
+
+def items(kind, response):
+  records = response.get(KINDS[kind]['key'], [])
+  if kind == 'instance':
+    return [instance for reservation in records for instance in reservation['Instances']]
+  return records
+
+def name_params(kind, name, states=None):
+  # Request parameters that select resources by Name (tag) server side.
+  spec = KINDS[kind]
+  if 'name_param' in spec:
+    return {spec['name_param']: [name]}
+  filters = [{'Name': spec.get('name_filter', 'tag:Name'), 'Values': [name]}]
+  if states is not None:
+    filters.append({'Name': spec['state_filter'], 'Values': list(states)})
+  return {'Filters': filters}
+
+def id_params(kind, ids):
+  spec = KINDS[kind]
+  if 'id_param' in spec:
+    return {spec['id_param']: list(ids)}
+  return {'Filters': [{'Name': spec['id_filter'], 'Values': list(ids)}]}
+
+def iter_resources(kind, filters=None, client=None, page_size=None, **params):
+  spec = KINDS[kind]
+  client = client or get_client(spec['service'])
+  if filters:
+    params['Filters'] = filters
+  try:
+    if not client.can_paginate(spec['operation']):
+      for record in items(kind, getattr(client, spec['operation'])(**params)):
+        yield record
+      return
+    config = {'PageSize': page_size} if page_size else {}
+    for page in client.get_paginator(spec['operation']).paginate(PaginationConfig=config, **params):
+      for record in items(kind, page):
+        yield record
+  except ClientError as e:
+    if e.response['Error']['Code'] not in _NOT_FOUND:
+      raise
+
+def first(records):
+  return next(iter(records), None)
+
+def iter_vpcs(filters=None, client=None, **params):
+  return iter_resources('vpc', filters, client, **params)
+
+def iter_subnets(filters=None, client=None, **params):
+  return iter_resources('subnet', filters, client, **params)
+
+def iter_internet_gateways(filters=None, client=None, **params):
+  return iter_resources('internet_gateway', filters, client, **params)
+
+def iter_route_tables(filters=None, client=None, **params):
+  return iter_resources('route_table', filters, client, **params)
+
+def iter_security_groups(filters=None, client=None, **params):
+  return iter_resources('security_group', filters, client, **params)
+
+def iter_instances(filters=None, client=None, **params):
+  return iter_resources('instance', filters, client, **params)
+
+def iter_addresses(filters=None, client=None, **params):
+  return iter_resources('elastic_ip', filters, client, **params)
+
+def iter_nat_gateways(filters=None, client=None, **params):
+  return iter_resources('nat_gateway', filters, client, **params)
+
+def iter_volumes(filters=None, client=None, **params):
+  return iter_resources('volume', filters, client, **params)
+
+def iter_network_interfaces(filters=None, client=None, **params):
+  return iter_resources('network_interface', filters, client, **params)
+
+def iter_key_pairs(filters=None, client=None, **params):
+  return iter_resources('key_pair', filters, client, **params)
+
+def iter_load_balancers(client=None, **params):
+  return iter_resources('load_balancer', None, client, **params)
+
+def iter_target_groups(client=None, **params):
+  return iter_resources('target_group', None, client, **params)
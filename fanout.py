@@ -0,0 +1,133 @@
+#----------------
+# fanout.py
+#-----------------
+# Provision or tear down the same topology in many regions and accounts at
+# once.
+#
+# A target is an (IAM role, region, desired state) triple; the role is
+# assumed through STS once per account and the credentials are shared by all
+# of that account's regions (aws_clients). Targets run concurrently, at most
+# max_workers at a time. Each target gets its own clients, its own inventory
+# snapshot and its own dependency graph, so one target failing does not stop
+# or affect the others; its error is kept in its result.
+#
+#   targets = [Target('us-west-2', role='arn:aws:iam::111111111111:role/deploy', params=desired),
+#              Target('eu-west-1', role='arn:aws:iam::222222222222:role/deploy', params=desired)]
+#   results = run_targets(targets, provision)
+#   print(report(results))
+#
+#   python fanout.py targets.json [--teardown] [--max-workers 8]
+#
+# targets.json is a list of {"region": ..., "role": ..., "name": ..., "params": {desired state}}.
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import inventory
+import id_cache
+from aws_clients import get_client
+
+class Target:
+  __slots__ = ('region', 'role', 'params', 'name', 'profile')
+
+  def __init__(self, region, role=None, params=None, name=None, profile=None):
+    self.region = region
+    self.role = role
+    self.params = params or {}
+    self.name = name or (f'{role.split(":")[4]}/{region}' if role else region)
+    self.profile = profile
+
+  def client(self, service):
+    return get_client(service, profile=self.profile, region=self.region, role=self.role)
+
+  def __repr__(self):
+    return f'Target({self.name!r})'
+
+class TargetResult:
+  __slots__ = ('target', 'result', 'error', 'traceback', 'start', 'end')
+
+  @property
+  def ok(self):
+    return self.error is None
+
+  @property
+  def duration(self):
+    return self.end - self.start
+
+def provision(target):
+  from plan import plan, apply, PLAN_KINDS
+  client = target.client('ec2')
+  snapshot = inventory.Inventory().load(kinds=PLAN_KINDS, clients={'ec2': client})
+  return apply(plan(target.params, inventory=snapshot, client=client))
+
+def teardown(target):
+  from teardown import teardown_vpc
+  return teardown_vpc(target.params['vpc']['name'], client=target.client('ec2'),
+                      elbv2_client=target.client('elbv2'))
+
+def _run_target(fn, target):
+  result = TargetResult()
+  result.target = target
+  result.result = None
+  result.error = None
+  result.traceback = None
+  result.start = time.monotonic()
+  try:
+    result.result = fn(target)
+  except Exception as e:
+    result.error = e
+    result.traceback = traceback.format_exc()
+  result.end = time.monotonic()
+  return result
+
+def run_targets(targets, fn, max_workers=8):
+  # Runs fn(target) for every target, max_workers targets at a time, and
+  # returns one TargetResult per target, in order. The process-wide inventory
+  # and ID cache describe a single account and region, so they are switched
+  # off for the duration of the run and restored afterwards.
+  targets = list(targets)
+  if not targets:
+    return []
+  current_inventory, current_cache = inventory.current_inventory(), id_cache.current_cache()
+  inventory.use_inventory(None)
+  id_cache.use_cache(None)
+  try:
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as pool:
+      return list(pool.map(lambda target: _run_target(fn, target), targets))
+  finally:
+    inventory.use_inventory(current_inventory)
+    id_cache.use_cache(current_cache)
+
+def report(results):
+  lines = [f'{"target":<40}{"status":>8}{"time":>10}']
+  for result in results:
+    status = 'ok' if result.ok else 'FAILED'
+    lines.append(f'{result.target.name:<40}{status:>8}{result.duration:>9.2f}s')
+    if not result.ok:
+      lines.append(f'    {type(result.error).__name__}: {result.error}')
+  failed = sum(1 for result in results if not result.ok)
+  lines.append(f'{len(results)} targets, {len(results) - failed} ok, {failed} failed')
+  return '\n'.join(lines)
+
+def load_targets(path):
+  with open(path) as f:
+    return [Target(item['region'], role=item.get('role'), params=item.get('params'), name=item.get('name'),
+                   profile=item.get('profile'))
+            for item in json.load(f)]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Provision or tear down many regions and accounts concurrently')
+  parser.add_argument('targets', help='JSON file with the list of targets')
+  parser.add_argument('--teardown', action='store_true', help='tear the targets down instead')
+  parser.add_argument('--max-workers', type=int, default=8, help='targets in flight at once')
+  args = parser.parse_args(argv)
+
+  results = run_targets(load_targets(args.targets), teardown if args.teardown else provision,
+                        max_workers=args.max_workers)
+  print(report(results))
+  return 0 if all(result.ok for result in results) else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
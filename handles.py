@@ -0,0 +1,129 @@
+#----------------
+# handles.py
+#-----------------
+# Lightweight handles for EC2 resources.
+#
+# The helpers used to wrap every ID in a boto3 resource (ec2.Vpc(id), ...),
+# which loads the large EC2 resource model and issues a lazy describe the
+# first time an attribute is read. A handle only carries the ID, the record
+# that was already described or returned by the create call, and the client
+# to use. It supports the few resource methods the helpers need; reading any
+# other attribute upgrades it to the full boto3 resource on first use.
+from aws_clients import get_client, get_resource, client_scope
+
+class Handle:
+  __slots__ = ('id', 'data', '_client', '_resource')
+  resource_type = None
+  id_key = None
+
+  def __init__(self, id, data=None, client=None):
+    self.id = id
+    self.data = data or {self.id_key: id}
+    self._client = client
+    self._resource = None
+
+  @classmethod
+  def from_record(cls, record, client=None):
+    return cls(record[cls.id_key], record, client)
+
+  @property
+  def client(self):
+    if self._client is None:
+      self._client = get_client('ec2')
+    return self._client
+
+  def resource(self):
+    # the full boto3 resource, for anything the handle does not cover, in the
+    # account and region of the handle's client
+    if self._resource is None:
+      profile, role, region = client_scope(self.client)
+      resource = get_resource('ec2', profile=profile, region=region, role=role)
+      self._resource = getattr(resource, self.resource_type)(self.id)
+    return self._resource
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self.resource(), name)
+
+  def __eq__(self, other):
+    return type(other) is type(self) and other.id == self.id
+
+  def __hash__(self):
+    return hash((type(self), self.id))
+
+  def __repr__(self):
+    return f'{self.resource_type}(id={self.id!r})'
+
+class Vpc(Handle):
+  __slots__ = ()
+  resource_type = 'Vpc'
+  id_key = 'VpcId'
+
+  @property
+  def vpc_id(self):
+    return self.id
+
+  def attach_internet_gateway(self, InternetGatewayId):
+    return self.client.attach_internet_gateway(InternetGatewayId=InternetGatewayId, VpcId=self.id)
+
+  def create_route_table(self, **kwargs):
+    record = self.client.create_route_table(VpcId=self.id, **kwargs)['RouteTable']
+    return RouteTable.from_record(record, self._client)
+
+class InternetGateway(Handle):
+  __slots__ = ()
+  resource_type = 'InternetGateway'
+  id_key = 'InternetGatewayId'
+
+  @property
+  def internet_gateway_id(self):
+    return self.id
+
+class RouteTable(Handle):
+  __slots__ = ()
+  resource_type = 'RouteTable'
+  id_key = 'RouteTableId'
+
+  @property
+  def route_table_id(self):
+    return self.id
+
+  def create_route(self, **kwargs):
+    return self.client.create_route(RouteTableId=self.id, **kwargs)
+
+  def associate_with_subnet(self, SubnetId):
+    response = self.client.associate_route_table(RouteTableId=self.id, SubnetId=SubnetId)
+    self.data.setdefault('Associations', []).append({
+      'RouteTableAssociationId': response['AssociationId'], 'RouteTableId': self.id, 'SubnetId': SubnetId})
+    return response
+
+class Subnet(Handle):
+  __slots__ = ()
+  resource_type = 'Subnet'
+  id_key = 'SubnetId'
+
+  @property
+  def subnet_id(self):
+    return self.id
+
+class SecurityGroup(Handle):
+  __slots__ = ()
+  resource_type = 'SecurityGroup'
+  id_key = 'GroupId'
+
+  @property
+  def group_id(self):
+    return self.id
+
+  def authorize_ingress(self, **kwargs):
+    return self.client.authorize_security_group_ingress(GroupId=self.id, **kwargs)
+
+class Instance(Handle):
+  __slots__ = ()
+  resource_type = 'Instance'
+  id_key = 'InstanceId'
+
+  @property
+  def instance_id(self):
+    return self.id
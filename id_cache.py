@@ -0,0 +1,136 @@
+#----------------
+# id_cache.py
+#-----------------
+# Persistent local cache of resource IDs, keyed by account, region, resource
+# type and Name tag, so reruns do not have to rediscover the same VPC, subnet,
+# security group and instance IDs with tag-filtered describes.
+#
+# The account and region are those of the client a lookup is made with (the
+# default EC2 client's without one), so one cache serves every region and
+# account a fan-out goes through. Entries expire after a TTL. Before a cached ID is trusted it is validated,
+# in bulk: the first lookup of a type validates every cached entry of that
+# type with one describe-by-IDs call, which is far cheaper than one tag
+# filter per resource. Entries that no longer exist (or were renamed) are
+# dropped, and the lookup falls back to discovery.
+#
+#   from id_cache import enable_cache
+#   enable_cache(ttl=24 * 3600)
+import os
+import json
+import time
+import sqlite3
+import threading
+from aws_clients import get_client, account_id
+from describe import KINDS, iter_resources, id_params, record_id, record_name
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'my_functions', 'resource_ids.sqlite')
+
+# attributes kept next to the ID
+ATTRIBUTES = ['VpcId', 'SubnetId', 'CidrBlock', 'AvailabilityZone', 'GroupName', 'State', 'KeyName', 'Tags']
+
+class ResourceCache:
+  def __init__(self, path=DEFAULT_PATH, ttl=3600, account=None, region=None):
+    self.path = path
+    self.ttl = ttl
+    self._account = account
+    self._region = region
+    self._validated = {}
+    self._lock = threading.Lock()
+    if path != ':memory:':
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute(
+      'CREATE TABLE IF NOT EXISTS resources ('
+      ' account TEXT, region TEXT, kind TEXT, name TEXT, id TEXT, attributes TEXT, expires REAL,'
+      ' PRIMARY KEY (account, region, kind, name))')
+    self._db.commit()
+
+  def scope(self, client=None):
+    # (account, region) of the client, unless the cache was made for one
+    client = client or get_client('ec2')
+    return self._account or account_id(client), self._region or client.meta.region_name
+
+  def cacheable(self, kind):
+    # elbv2 fails a describe-by-ARNs call as a whole when one ARN is gone, so
+    # only types that can be validated with an ID filter are cached
+    return 'id_filter' in KINDS[kind]
+
+  def get(self, kind, name, client=None):
+    if not self.cacheable(kind):
+      return None
+    key = self.scope(client) + (kind,)
+    if key not in self._validated:
+      self.validate(kind, client=client)
+    return self._validated[key].get(name)
+
+  def validate(self, kind, client=None):
+    account, region = self.scope(client)
+    with self._lock:
+      rows = self._db.execute(
+        'SELECT name, id FROM resources WHERE account=? AND region=? AND kind=? AND expires>?',
+        (account, region, kind, time.time())).fetchall()
+    valid = {}
+    if rows:
+      ids = [id for name, id in rows]
+      records = {}
+      for i in range(0, len(ids), 200):
+        for record in iter_resources(kind, client=client, **id_params(kind, ids[i:i + 200])):
+          records[record_id(kind, record)] = record
+      for name, id in rows:
+        record = records.get(id)
+        if record is not None and record_name(kind, record) == name:
+          valid[name] = record
+    with self._lock:
+      self._db.execute(
+        'DELETE FROM resources WHERE account=? AND region=? AND kind=? AND (expires<=? OR name NOT IN (%s))'
+        % ','.join('?' * len(valid)),
+        (account, region, kind, time.time()) + tuple(valid))
+      self._db.commit()
+      self._validated[(account, region, kind)] = valid
+    return valid
+
+  def put(self, kind, record, client=None):
+    name = record_name(kind, record)
+    if name is None or not self.cacheable(kind):
+      return
+    account, region = self.scope(client)
+    attributes = dict((key, record[key]) for key in ATTRIBUTES if key in record)
+    with self._lock:
+      self._db.execute(
+        'INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (account, region, kind, name, record_id(kind, record), json.dumps(attributes, default=str),
+         time.time() + self.ttl))
+      self._db.commit()
+      if (account, region, kind) in self._validated:
+        self._validated[(account, region, kind)][name] = record
+
+  def forget(self, kind, id, client=None):
+    if not self.cacheable(kind):
+      return
+    account, region = self.scope(client)
+    with self._lock:
+      self._db.execute('DELETE FROM resources WHERE account=? AND region=? AND kind=? AND id=?',
+                       (account, region, kind, id))
+      self._db.commit()
+      validated = self._validated.get((account, region, kind), {})
+      for name in [name for name, record in validated.items() if record_id(kind, record) == id]:
+        del validated[name]
+
+  def clear(self):
+    with self._lock:
+      self._db.execute('DELETE FROM resources')
+      self._db.commit()
+      self._validated.clear()
+
+_current = None
+
+def current_cache():
+  return _current
+
+def use_cache(cache):
+  global _current
+  _current = cache
+  return cache
+
+def enable_cache(path=DEFAULT_PATH, ttl=3600):
+  return use_cache(ResourceCache(path=path, ttl=ttl))
@@ -0,0 +1,123 @@
+#----------------
+# inventory.py
+#-----------------
+# Account inventory snapshot with an in-memory index by Name and by ID.
+#
+# snapshot() sweeps every resource type once (one paginated describe per
+# type, all types in parallel) and makes the result the current inventory.
+# While an inventory is current, find() answers the Name lookups of the
+# my_functions helpers from the index instead of issuing a tag-filtered
+# describe per resource. Helpers that create or delete resources keep the
+# index up to date with remember() and forget().
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from id_cache import current_cache
+from describe import KINDS, iter_resources, first, name_params, record_id, record_name, record_state
+
+def describe_all(kind, client=None):
+  return list(iter_resources(kind, client=client))
+
+class Inventory:
+  def __init__(self):
+    self.by_id = {}
+    self.by_name = {}
+    self.loaded = set()
+    self._lock = threading.Lock()
+
+  def load(self, kinds=None, max_workers=None, clients=None):
+    kinds = list(kinds or KINDS)
+    clients = clients or {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(kinds)) as pool:
+      sweeps = dict((kind, pool.submit(describe_all, kind, clients.get(KINDS[kind]['service'])))
+                    for kind in kinds)
+    for kind, sweep in sweeps.items():
+      records = sweep.result()
+      with self._lock:
+        for stale in [id for id, (record_kind, record) in self.by_id.items() if record_kind == kind]:
+          del self.by_id[stale]
+        self.by_name[kind] = {}
+        self.loaded.add(kind)
+      for record in records:
+        self.add(kind, record)
+    return self
+
+  def covers(self, kind):
+    return kind in self.loaded
+
+  def add(self, kind, record):
+    name = record_name(kind, record)
+    with self._lock:
+      self.by_id[record_id(kind, record)] = (kind, record)
+      if name is not None:
+        self.by_name.setdefault(kind, {}).setdefault(name, []).append(record)
+
+  def remove(self, kind, id):
+    with self._lock:
+      entry = self.by_id.pop(id, None)
+      if entry is None:
+        return
+      name = record_name(kind, entry[1])
+      records = self.by_name.get(kind, {}).get(name, [])
+      records[:] = [record for record in records if record_id(kind, record) != id]
+
+  def get(self, id):
+    entry = self.by_id.get(id)
+    return entry[1] if entry else None
+
+  def find(self, kind, name, states=None):
+    for record in self.by_name.get(kind, {}).get(name, []):
+      if states is None or record_state(kind, record) in states:
+        return record
+    return None
+
+  def all(self, kind):
+    return [record for records in self.by_name.get(kind, {}).values() for record in records]
+
+  def records(self, kind):
+    # every record of the kind, with or without a Name
+    return [record for record_kind, record in self.by_id.values() if record_kind == kind]
+
+_current = None
+
+def current_inventory():
+  return _current
+
+def use_inventory(inventory):
+  global _current
+  _current = inventory
+  return inventory
+
+def snapshot(kinds=None, max_workers=None, clients=None):
+  return use_inventory(Inventory().load(kinds=kinds, max_workers=max_workers, clients=clients))
+
+def remember(kind, record, client=None):
+  # client: the one the record was made with, for the ID cache's account and region
+  if _current is not None and _current.covers(kind):
+    _current.add(kind, record)
+  cache = current_cache()
+  if cache is not None:
+    cache.put(kind, record, client=client)
+  return record
+
+def forget(kind, id, client=None):
+  if _current is not None:
+    _current.remove(kind, id)
+  cache = current_cache()
+  if cache is not None:
+    cache.forget(kind, id, client=client)
+
+def find(kind, name, client=None, states=None):
+  # First record with this Name (and one of the states, if given), from the
+  # current inventory when it covers the kind, then from the local ID cache,
+  # from a describe otherwise.
+  if _current is not None and _current.covers(kind):
+    return _current.find(kind, name, states)
+  cache = current_cache()
+  if cache is not None:
+    record = cache.get(kind, name, client=client)
+    if record is not None and (states is None or record_state(kind, record) in states):
+      return record
+  record = first(iter_resources(kind, client=client, **name_params(kind, name, states)))
+  if record is not None and cache is not None:
+    cache.put(kind, record, client=client)
+  return record
@@ -0,0 +1,182 @@
+#----------------
+# journal.py
+#-----------------
+# Write-ahead journal for crash-resumable provisioning.
+#
+# Before apply() runs a step it appends a 'begin' entry to the journal file,
+# and once the step has finished a 'done' entry with the IDs it created;
+# every entry is flushed and fsynced before the step goes on. plan() also
+# journals the IDs of the resources it found already existing, and apply()
+# a 'planned' entry before the first step, once the plan is whole. Steps run
+# with a deterministic idempotency token, derived from the journal's run ID
+# and the step, which the helpers pass as ClientToken to the create calls
+# that take one (RunInstances, CreateNatGateway, CreateRouteTable), so a step
+# that is re-run after a crash gets back the resources of its first attempt
+# instead of launching new ones.
+#
+# A run that did not reach complete() is resumed by the next one: instead of
+# sweeping the account, inventory() describes the journaled IDs (one
+# describe-by-ID call per type) and looks up by Name only the steps that had
+# begun without finishing, so only the incomplete steps are planned again.
+# A run that died before it was planned journaled too little to resume from
+# and is started afresh, from a snapshot. A last entry torn by the crash is
+# dropped: the step it was for counts as unfinished.
+#
+#   journal = use_journal(Journal('launch_ec2.journal'))
+#   if journal.resuming:
+#     use_inventory(journal.inventory(PLAN_KINDS))
+#   ...
+#   apply(plan(desired))
+#   journal.complete()
+import os
+import json
+import uuid
+import hashlib
+import threading
+from describe import KINDS, iter_resources, id_params, name_params
+from inventory import Inventory
+
+# kinds whose create call takes a ClientToken; an interrupted create of any
+# other kind is looked up by Name on resume (route tables too: a replayed
+# CreateRouteTable gets its table back, but not the route made after it)
+TOKEN_KINDS = {'instance', 'nat_gateway'}
+
+class Journal:
+  def __init__(self, path):
+    self.path = path
+    self.run_id = None
+    self.steps = {}
+    self.seen = {}
+    self.resuming = False
+    self._lock = threading.Lock()
+    entries, torn = read_entries(path)
+    if (entries and entries[-1]['op'] != 'complete' and
+        any(entry['op'] == 'planned' for entry in entries)):
+      self.resuming = True
+      for entry in entries:
+        self._apply(entry)
+      if torn:
+        # appends go after a whole line
+        with open(path, 'w') as f:
+          f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+    else:
+      self.run_id = uuid.uuid4().hex
+      with open(path, 'w') as f:
+        f.write(json.dumps({'op': 'start', 'run': self.run_id}) + '\n')
+
+  def _apply(self, entry):
+    op = entry['op']
+    if op == 'start':
+      self.run_id = entry['run']
+    elif op == 'seen':
+      self.seen[(entry['kind'], entry['name'])] = entry['id']
+    elif op == 'begin':
+      self.steps[entry['step']] = {'kind': entry['kind'], 'name': entry['name'], 'ids': [], 'done': False}
+    elif op == 'done':
+      self.steps[entry['step']].update(ids=entry['ids'], done=True)
+
+  def _write(self, entry):
+    with self._lock:
+      self._apply(entry)
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+  def token(self, step, suffix=''):
+    # ClientToken for a step: at most 64 ASCII characters, the same on every run
+    return hashlib.sha256(f'{self.run_id}\0{step}\0{suffix}'.encode('utf-8')).hexdigest()
+
+  def done(self, step):
+    entry = self.steps.get(step)
+    return entry is not None and entry['done']
+
+  def record_seen(self, kind, name, id):
+    if self.seen.get((kind, name)) != id:
+      self._write({'op': 'seen', 'kind': kind, 'name': name, 'id': id})
+
+  def step(self, step, kind, name, fn):
+    # Runs fn as a journaled step; a step already done is skipped.
+    if self.done(step):
+      return None
+    self._write({'op': 'begin', 'step': step, 'kind': kind, 'name': name})
+    previous = getattr(_local, 'step', None)
+    _local.step = (self, step)
+    try:
+      result = fn()
+    finally:
+      _local.step = previous
+    self._write({'op': 'done', 'step': step, 'ids': result_ids(result)})
+    return result
+
+  def planned(self):
+    # the plan has been made: everything it found is journaled
+    self._write({'op': 'planned'})
+
+  def complete(self):
+    self._write({'op': 'complete'})
+
+  def inventory(self, kinds):
+    # Inventory of the journaled resources, without sweeping the account
+    inventory = Inventory()
+    inventory.loaded.update(kinds)
+    ids = {}
+    for (kind, name), id in self.seen.items():
+      ids.setdefault(kind, set()).add(id)
+    for entry in self.steps.values():
+      if entry['kind'] in KINDS:
+        ids.setdefault(entry['kind'], set()).update(entry['ids'])
+    for kind in kinds:
+      wanted = sorted(ids.get(kind, ()))
+      for i in range(0, len(wanted), 200):
+        for record in iter_resources(kind, **id_params(kind, wanted[i:i + 200])):
+          inventory.add(kind, record)
+    # a create that began and never finished may or may not have happened
+    for entry in self.steps.values():
+      if entry['done'] or entry['kind'] not in kinds or entry['kind'] in TOKEN_KINDS:
+        continue
+      for record in iter_resources(entry['kind'], **name_params(entry['kind'], entry['name'])):
+        inventory.add(entry['kind'], record)
+    return inventory
+
+def read_entries(path):
+  # (entries, torn): the journal's entries, and whether its last line was torn
+  if not os.path.exists(path):
+    return [], False
+  with open(path) as f:
+    lines = [line for line in f if line.strip()]
+  entries = []
+  for i, line in enumerate(lines):
+    try:
+      entries.append(json.loads(line))
+    except ValueError:
+      if i < len(lines) - 1:
+        raise
+      return entries, True
+  return entries, False
+
+def result_ids(result):
+  # IDs of what a step returned: a handle, a list of handles or nothing
+  if isinstance(result, (list, tuple)):
+    return [id for item in result for id in result_ids(item)]
+  id = getattr(result, 'id', None)
+  return [id] if isinstance(id, str) else []
+
+_local = threading.local()
+_current = None
+
+def current_journal():
+  return _current
+
+def use_journal(journal):
+  global _current
+  _current = journal
+  return journal
+
+def client_token(suffix=''):
+  # the idempotency token of the journaled step running on this thread, or None
+  current = getattr(_local, 'step', None)
+  if current is None:
+    return None
+  journal, step = current
+  return journal.token(step, suffix)
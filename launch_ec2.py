@@ -1,4 +1,10 @@
 from my_functions import *
+import sys
+from inventory import snapshot, use_inventory
+from journal import Journal, use_journal
+from plan import plan, apply, format_plan, PLAN_KINDS
+from tracing import get_tracer
+from aws_clients import configure
 
 vpc_cidr="10.0.0.0/16"
 subnet_cidr="10.0.1.0/24"
@@ -6,6 +12,7 @@ vpc_name="LinuxEnvVpc"
 subnet_name="LinuxEnvPublic"
 instance_name="RHEL8"
 instance_type="m5.4xlarge"
+fallback_instance_types=["m5a.4xlarge", "m6i.4xlarge", "m5n.4xlarge"]
 igw_name="LinuxEnvIgw"
 route_table_name="LinuxEnvRTPublic"
 sg_name="LinuxEnvSg"
@@ -44,33 +51,60 @@ systemctl start httpd
 # subnet = get_subnet(subnet_name)
 # security_group = get_security_group(sg_name)
 
-# Create VPC
-vpc = setup_vpc(vpc_name=vpc_name, vpc_cidr=vpc_cidr)
-
-# Create an internet gateway and attach it to VPC
-internet_gateway = setup_internet_gateways(igw_name=igw_name, vpc=vpc)
-
-# create a route table and add internet gateway to the table
-route_table = setup_route_table(route_table_name, vpc, internet_gateway.id)
-
-# create subnet and associate it with route table
-subnet_pub = setup_subnet(subnet_name, subnet_cidr, available_zone_a, vpc, route_table)
-
-# create a security group and allow SSH inbound rule through the 
-security_group = setup_security_group(sg_name, vpc.id)
+desired = {
+  'vpc': {'name': vpc_name, 'cidr': vpc_cidr},
+  'internet_gateway': {'name': igw_name},
+  'route_table': {'name': route_table_name},
+  # create subnet and associate it with route table
+  'subnets': [{'name': subnet_name, 'cidr': subnet_cidr, 'az': available_zone_a}],
+  # one more public subnet in each of the other AZs, carved out of the VPC CIDR
+  'subnet_layout': {'azs': [available_zone_b, available_zone_c], 'tiers': {'public': 24}, 'prefix': 'LinuxEnv'},
+  # security group that allows SSH and HTTP inbound
+  'security_groups': [{'name': sg_name, 'ingress': [('tcp', 22, 22, '0.0.0.0/0'), ('tcp', 80, 80, '0.0.0.0/0')]}],
+  'instances': [{'name': instance_name, 'ami': AMI, 'instance_type': instance_type, 'subnet': subnet_name,
+                 'security_group': sg_name, 'key_pair': key_pair_name, 'userdata': userdata, 'public': public_ip,
+                 # when m5.4xlarge is short in the AZ, the next type / AZ / market with capacity
+                 'fallback': {'instance_types': fallback_instance_types,
+                              'subnets': ['LinuxEnvPublicB', 'LinuxEnvPublicC'],
+                              'markets': ['on-demand', 'spot']}}],
+}
 
 # allocationId = setup_eip(eip_name)
 # Create KeyPair
 # key_pair_name = setup_key_pair(key_pair_name)
 
-instance = setup_instance(AMI, subnet_pub.id, security_group.group_id, instance_name, key_pair_name, userdata, instance_type, public_ip)
+# every client (and the inventory snapshot) goes to this region
+configure(region=region)
+
+# One describe per resource type, then only the changes that are needed.
+# "python launch_ec2.py plan" shows the changes without applying them.
+# Applies are journaled: a run that died halfway is resumed from the journal,
+# from the IDs it recorded instead of a sweep, and only the unfinished steps
+# are run again.
+applying = sys.argv[1:] != ['plan']
+journal = use_journal(Journal('launch_ec2.journal')) if applying else None
+if journal is not None and journal.resuming:
+  print('resuming the unfinished run in launch_ec2.journal')
+  use_inventory(journal.inventory(PLAN_KINDS))
+else:
+  snapshot(kinds=PLAN_KINDS)
+changes = plan(desired)
+print(format_plan(changes))
+if applying:
+  dag = apply(changes)
+  print(dag.report())
+  journal.complete()
+
+# where the time went: API calls per operation and helper, and a timeline
+print(get_tracer().summary())
+get_tracer().export_chrome_trace('launch_ec2_trace.json')
 
 exit()
 
 
 # Replace public ip address with elastic ip address
 
-ec2 = boto3.client('ec2')
+ec2 = get_client('ec2')
 
 try:
     response = ec2.associate_address(AllocationId=allocationId,
@@ -1,7 +1,19 @@
 #----------------
 # my_functions.py
 #-----------------
-import boto3
+from aws_clients import get_client, single_attempt
+from handles import Vpc, InternetGateway, RouteTable, Subnet, SecurityGroup, Instance
+from waiters import waiter_service, wait_for, target_health_id
+from dag import Dag
+from inventory import find, remember, forget, current_inventory
+from describe import iter_instances, iter_route_tables, tag_value
+from bake import launch_image
+from templates import launch_template, forget_template, TEMPLATE_NOT_FOUND
+from journal import client_token
+from sg_rules import rules, reconcile_ingress
+from scheduler import THROTTLE_CODES
+from concurrent.futures import ThreadPoolExecutor
+import base64
 import datetime 
 import os
 from botocore.exceptions import ClientError
@@ -16,22 +28,15 @@ def logging_setup(logfile):
 def log(Service, Name):
   print(f'{datetime.datetime.now(tz=datetime.timezone.utc)}\t{Service}\t{Name}')
 
-def setup_vpc(vpc_name='myvpc', vpc_cidr='10.0.0.0/16'):
-  ec2 = boto3.resource('ec2')
-  client = boto3.client('ec2')
-  response = client.describe_vpcs(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ vpc_name ]
-      }
-    ]
-  )
-  if response['Vpcs']:
-    vpc = ec2.Vpc(response['Vpcs'][0]['VpcId'])
+def setup_vpc(vpc_name='myvpc', vpc_cidr='10.0.0.0/16', client=None):
+  client = client or get_client('ec2')
+  record = find('vpc', vpc_name, client=client)
+  if record:
+    vpc = Vpc.from_record(record, client)
     log('VPC already exists', vpc_name)
   else:
-    vpc = ec2.create_vpc(
+    created_at = datetime.datetime.now(tz=datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    record = client.create_vpc(
       CidrBlock=vpc_cidr,
       TagSpecifications=[
         {
@@ -41,29 +46,33 @@ def setup_vpc(vpc_name='myvpc', vpc_cidr='10.0.0.0/16'):
               "Key": "Name",
               "Value": vpc_name
             },
+            {
+              "Key": "auto-delete",
+              "Value": "yes"
+            },
+            {
+              # the sweeper leaves young VPCs alone (sweeper.py)
+              "Key": "created-at",
+              "Value": created_at
+            },
           ]
         }
       ]
-    )
+    )['Vpc']
+    record.setdefault('Tags', [{'Key': 'Name', 'Value': vpc_name}, {'Key': 'auto-delete', 'Value': 'yes'},
+                               {'Key': 'created-at', 'Value': created_at}])
+    vpc = Vpc.from_record(remember('vpc', record, client=client), client)
     log('VPC created', vpc_name)
   return vpc
 
-def setup_internet_gateways(igw_name, vpc):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-  response = client.describe_internet_gateways(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ igw_name ]
-      }
-    ]
-  )
-  if response['InternetGateways']:
-    internet_gateway = ec2.InternetGateway(response['InternetGateways'][0]['InternetGatewayId'])
+def setup_internet_gateways(igw_name, vpc, client=None):
+  client = client or get_client('ec2')
+  record = find('internet_gateway', igw_name, client=client)
+  if record:
+    internet_gateway = InternetGateway.from_record(record, client)
     log('Internet Gateway already exits', igw_name)
   else:
-    internet_gateway = ec2.create_internet_gateway(
+    record = client.create_internet_gateway(
       TagSpecifications=[
         {
           'ResourceType': 'internet-gateway',
@@ -72,30 +81,31 @@ def setup_internet_gateways(igw_name, vpc):
               "Key": "Name",
               "Value": igw_name
             },
+            {
+              "Key": "auto-delete",
+              "Value": "yes"
+            },
           ]
         }
       ]
-    )
-    vpc.attach_internet_gateway(InternetGatewayId=internet_gateway.id)
+    )['InternetGateway']
+    vpc.attach_internet_gateway(InternetGatewayId=record['InternetGatewayId'])
+    record['Attachments'] = [{'VpcId': vpc.id, 'State': 'available'}]
+    record.setdefault('Tags', [{'Key': 'Name', 'Value': igw_name}, {'Key': 'auto-delete', 'Value': 'yes'}])
+    internet_gateway = InternetGateway.from_record(remember('internet_gateway', record, client=client), client)
     log('Internet Gateway created', igw_name)
   return internet_gateway
 
-def setup_route_table(route_table_name, vpc, GatewayId):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-  response = client.describe_route_tables(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ route_table_name ]
-      }
-    ]
-  )
-  if response['RouteTables']:
-    route_table = ec2.RouteTable(response['RouteTables'][0]['RouteTableId'])
+def setup_route_table(route_table_name, vpc, GatewayId=None, client=None):
+  # GatewayId=None creates a route table without a default route (private subnets)
+  client = client or get_client('ec2')
+  record = find('route_table', route_table_name, client=client)
+  if record:
+    route_table = RouteTable.from_record(record, client)
     log('Route Table already exists', route_table_name)
   else:
     route_table = vpc.create_route_table(
+      **with_token({}, client_token()),
       TagSpecifications=[
         {
           'ResourceType': 'route-table',
@@ -108,31 +118,21 @@ def setup_route_table(route_table_name, vpc, GatewayId):
         }
       ]
     )
-    route = route_table.create_route(DestinationCidrBlock='0.0.0.0/0', GatewayId=GatewayId)
+    record = route_table.data
+    if GatewayId is not None:
+      route = route_table.create_route(DestinationCidrBlock='0.0.0.0/0', GatewayId=GatewayId)
+      record.setdefault('Routes', []).append({'DestinationCidrBlock': '0.0.0.0/0', 'GatewayId': GatewayId, 'State': 'active'})
+    record.setdefault('Associations', [])
+    record.setdefault('Tags', [{'Key': 'Name', 'Value': route_table_name}])
+    remember('route_table', record, client=client)
     log('Route Table created', route_table_name)
   return route_table
 
-def setup_instance(AMI, subnet_id, security_group_id, instance_name, key_pair_name, userdata, instance_type, bool_public):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-  response = client.describe_instances(
-    Filters=[
-      {
-        'Name' : 'tag:Name',
-        'Values' : [ instance_name ]
-      },
-      {
-        'Name' : 'instance-state-name',
-        'Values' : [ 'running', 'pending']
-      }
-    ]
-  )
-  if response['Reservations']:
-    instance = ec2.Instance(response['Reservations'][0]['Instances'][0]['InstanceId'])
-    log('EC2 Instance already exists', instance_name)
-  else:
-    instances = ec2.create_instances(
-      BlockDeviceMappings=[
+# RunInstances parameters for one launch configuration.
+def instance_params(AMI, subnet_id, security_group_id, key_pair_name, userdata, instance_type, bool_public, tags, count=1,
+                    delete_on_termination=False):
+  return dict(
+    BlockDeviceMappings=[
 #        {
 #            'DeviceName': '/dev/sdh',
 #            'VirtualName': 'ephemeral0',
@@ -143,73 +143,219 @@ def setup_instance(AMI, subnet_id, security_group_id, instance_name, key_pair_na
 #            'VirtualName': 'ephemeral1',
 #            "NoDevice": ""
 #        },
-        {
-            'DeviceName': '/dev/sdb',
-            'Ebs': {
-                'DeleteOnTermination': False,
-                'VolumeSize': 30,
-                'VolumeType': 'gp3',
-                'Encrypted': True
-            },
-        },
-        ],
-      ImageId=AMI,
-      InstanceType=instance_type,
-      EbsOptimized=True,
-      MaxCount=1,
-      MinCount=1,
-      NetworkInterfaces=[
-        {
-          'SubnetId': subnet_id,
-          'DeviceIndex': 0,
-          'AssociatePublicIpAddress': bool_public,
-          'Groups': [security_group_id],
-          }
+      {
+          'DeviceName': '/dev/sdb',
+          'Ebs': {
+              'DeleteOnTermination': delete_on_termination,
+              'VolumeSize': 30,
+              'VolumeType': 'gp3',
+              'Encrypted': True
+          },
+      },
       ],
-      KeyName=key_pair_name,
-      UserData=userdata,
-      TagSpecifications=[
-        {
-          'ResourceType': 'instance',
-          'Tags':[
-            {
-              "Key": "Name",
-              "Value": instance_name
-            },
-            {
-              "Key": "auto-delete",
-              "Value": "no"
-            }
-          ]
+    ImageId=AMI,
+    InstanceType=instance_type,
+    EbsOptimized=True,
+    MaxCount=count,
+    MinCount=1,
+    NetworkInterfaces=[
+      {
+        'SubnetId': subnet_id,
+        'DeviceIndex': 0,
+        'AssociatePublicIpAddress': bool_public,
+        'Groups': [security_group_id],
         }
-      ]
-    )
-    instance = instances[0]
+    ],
+    KeyName=key_pair_name,
+    UserData=userdata,
+    # volumes that outlive the instance (delete_on_termination False) are
+    # left to the sweeper (sweeper.py) once they are detached
+    TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags},
+                       {'ResourceType': 'volume', 'Tags': [tag for tag in tags if tag['Key'] != 'auto-delete'] +
+                                                          [{'Key': 'auto-delete', 'Value': 'yes'}]}],
+  )
+
+def with_token(params, token):
+  # idempotency token of the journaled step (journal.py), when there is one
+  if token is not None:
+    params['ClientToken'] = token
+  return params
+
+# RunInstances parameters that change from call to call; everything else
+# goes into the launch template
+LAUNCH_OVERRIDES = ('MinCount', 'MaxCount', 'NetworkInterfaces', 'TagSpecifications')
+
+def launch_params(AMI, subnet_id, security_group_id, key_pair_name, userdata, instance_type, bool_public, tags, count=1,
+                  delete_on_termination=False, client=None):
+  # instance_params() as a launch template version plus per-call overrides
+  params = instance_params(AMI, subnet_id, security_group_id, key_pair_name, userdata, instance_type, bool_public,
+                           tags, count=count, delete_on_termination=delete_on_termination)
+  data = dict((key, value) for key, value in params.items() if key not in LAUNCH_OVERRIDES)
+  if data.get('UserData'):
+    # launch templates take userdata base64 encoded, RunInstances encodes it itself
+    data['UserData'] = base64.b64encode(data['UserData'].encode('utf-8')).decode('ascii')
+  else:
+    data.pop('UserData', None)
+  template_id, version = launch_template(data, client=client)
+  overrides = dict((key, params[key]) for key in LAUNCH_OVERRIDES)
+  overrides['LaunchTemplate'] = {'LaunchTemplateId': template_id, 'Version': str(version)}
+  return overrides
+
+# throttled single attempt RunInstances calls are tried this many times
+THROTTLED_ATTEMPTS = 5
+
+def _run_instances(client, params, token, once):
+  if not once:
+    return client.run_instances(**with_token(params, token))['Instances']
+  # no botocore retries: capacity errors come straight back to the caller,
+  # only throttling is retried here
+  for attempt in range(THROTTLED_ATTEMPTS):
+    try:
+      return single_attempt(client).run_instances(**with_token(params, token))['Instances']
+    except ClientError as e:
+      if e.response['Error']['Code'] not in THROTTLE_CODES or attempt == THROTTLED_ATTEMPTS - 1:
+        raise
+      time.sleep(0.5 * 2 ** attempt)
+
+def run_instances(params, token=None, once=False, client=None):
+  # RunInstances with params(), launch_params() style parameters. A cached
+  # launch template that was deleted in the meantime is forgotten, and the
+  # call is made once more with the template created again. once=True makes
+  # a single attempt, for callers that fall back on capacity errors.
+  client = client or get_client('ec2')
+  launch = params()
+  try:
+    return _run_instances(client, launch, token, once)
+  except ClientError as e:
+    if e.response['Error']['Code'] not in TEMPLATE_NOT_FOUND or 'LaunchTemplate' not in launch:
+      raise
+    forget_template(launch['LaunchTemplate']['LaunchTemplateId'])
+  return _run_instances(client, params(), token, once)
+
+def setup_instance(AMI, subnet_id, security_group_id, instance_name, key_pair_name, userdata, instance_type, bool_public, client=None):
+  client = client or get_client('ec2')
+  record = find('instance', instance_name, client=client, states=['running', 'pending'])
+  if record:
+    instance = Instance.from_record(record, client)
+    log('EC2 Instance already exists', instance_name)
+  else:
+    # a baked image of AMI + userdata (bake.py, when in use) replaces the boot-time install
+    AMI, userdata = launch_image(AMI, userdata, instance_type, client=client)
+    instances = run_instances(
+      lambda: launch_params(AMI, subnet_id, security_group_id, key_pair_name, userdata, instance_type, bool_public,
+                            [{'Key': 'Name', 'Value': instance_name}, {'Key': 'auto-delete', 'Value': 'no'}],
+                            client=client),
+      client_token(), client=client)
+    record = instances[0]
+    record.setdefault('State', {'Name': 'pending'})
+    record.setdefault('SubnetId', subnet_id)
+    record.setdefault('Tags', [{'Key': 'Name', 'Value': instance_name}, {'Key': 'auto-delete', 'Value': 'no'}])
+    instance = Instance.from_record(remember('instance', record, client=client), client)
 #    waiter = client.get_waiter('instance_status_ok')
 #    waiter.wait(
 #      InstanceIds=[instance.id]
 #    )
     log('EC2 Instance created', instance_name)
   return instance
+
+# RunInstances errors that mean "not enough capacity right now" rather than a
+# bad request; the shortfall is retried, on the next subnet first.
+CAPACITY_ERRORS = {'InsufficientInstanceCapacity', 'InstanceLimitExceeded', 'InsufficientCapacity'}
+
+def indexed_names(prefix, count, start=1):
+  return [f'{prefix}{i}' for i in range(start, start + count)]
+
+def _existing_instances(instance_names, client):
+  # one lookup for the whole fleet instead of one describe per name
+  inventory = current_inventory()
+  if inventory is not None and inventory.covers('instance'):
+    records = [inventory.find('instance', name, states=['running', 'pending']) for name in instance_names]
+    return dict((name, record) for name, record in zip(instance_names, records) if record)
+  existing = {}
+  for i in range(0, len(instance_names), 200):
+    filters = [{'Name': 'tag:Name', 'Values': instance_names[i:i + 200]},
+               {'Name': 'instance-state-name', 'Values': ['running', 'pending']}]
+    for record in iter_instances(filters, client=client):
+      existing.setdefault(tag_value(record, 'Name'), record)
+  return existing
+
+def create_instance_batch(subnet_id, instance_names, params, client, token=None):
+  # one RunInstances call for every instance of the batch; MinCount=1 so a
+  # partial launch succeeds with what is available
+  try:
+    return run_instances(lambda: params(subnet_id, len(instance_names)), token, once=True, client=client)
+  except ClientError as e:
+    if e.response['Error']['Code'] in CAPACITY_ERRORS:
+      log(f'EC2 capacity short in {subnet_id}', e.response['Error']['Code'])
+      return []
+    raise
+
+def create_name_tag(resource_id, name, client=None):
+  client = client or get_client('ec2')
+  client.create_tags(Resources=[resource_id], Tags=[{'Key': 'Name', 'Value': name}])
+
+def setup_instances(AMI, subnet_ids, security_group_id, instance_names, key_pair_name, userdata, instance_type, bool_public,
+                    max_attempts=3, max_workers=16, client=None):
+  # Launch a fleet: the instances of instance_names that do not exist yet are
+  # spread round robin over subnet_ids and launched with one RunInstances
+  # call per subnet, all subnets in parallel. Instances that were not
+  # launched (partial capacity) are retried, and only those. Returns the
+  # handles in the order of instance_names; names that could not be launched
+  # after max_attempts are missing from the list.
+  client = client or get_client('ec2')
+  instance_names = list(instance_names)
+  subnet_ids = list(subnet_ids)
+  records = _existing_instances(instance_names, client)
+  for name in records:
+    log('EC2 Instance already exists', name)
+  missing = [name for name in instance_names if name not in records]
+  if missing:
+    AMI, userdata = launch_image(AMI, userdata, instance_type, client=client)
+  tags = [{'Key': 'auto-delete', 'Value': 'no'}]
+  params = lambda subnet_id, count: launch_params(AMI, subnet_id, security_group_id, key_pair_name, userdata,
+                                                  instance_type, bool_public, tags, count=count, client=client)
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    for attempt in range(max_attempts):
+      if not missing:
+        break
+      if attempt:
+        time.sleep(2 ** attempt)
+      # rotate the subnets so a shortfall moves on to the next subnet / AZ
+      batches = {}
+      for i, name in enumerate(missing):
+        batches.setdefault(subnet_ids[(i + attempt) % len(subnet_ids)], []).append(name)
+      launched = dict((subnet_id, pool.submit(create_instance_batch, subnet_id, names, params, client,
+                                              client_token(f'{attempt}:{subnet_id}')))
+                      for subnet_id, names in batches.items())
+      named = []
+      for subnet_id, names in batches.items():
+        for name, record in zip(names, launched[subnet_id].result()):
+          record.setdefault('State', {'Name': 'pending'})
+          record.setdefault('SubnetId', subnet_id)
+          record['Tags'] = [{'Key': 'Name', 'Value': name}] + tags
+          records[name] = record
+          named.append((name, record))
+      # CreateTags applies the same tags to every resource in a call, so
+      # indexed names take one call per instance, issued concurrently
+      list(pool.map(lambda item: create_name_tag(item[1]['InstanceId'], item[0], client=client), named))
+      for name, record in named:
+        remember('instance', record, client=client)
+        log('EC2 Instance created', name)
+      missing = [name for name in missing if name not in records]
+  if missing:
+    log('EC2 Instances not launched', ', '.join(missing))
+  return [Instance.from_record(records[name], client) for name in instance_names if name in records]
  
-def setup_subnet(subnet_name, subnet_cidr, AZ, vpc, route_table):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
+def setup_subnet(subnet_name, subnet_cidr, AZ, vpc, route_table, client=None):
+  client = client or get_client('ec2')
 
   # check if subnet already exists.
-  response = client.describe_subnets(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ subnet_name ]
-      }
-    ]
-  )
-  if response['Subnets']:
-    subnet = ec2.Subnet(response['Subnets'][0]['SubnetId'])
+  record = find('subnet', subnet_name, client=client)
+  if record:
+    subnet = Subnet.from_record(record, client)
     log('Subnet already exists', subnet_name)
   else:
-    subnet = ec2.create_subnet(
+    record = client.create_subnet(
       CidrBlock=subnet_cidr, 
       VpcId=vpc.id,
       AvailabilityZone=AZ,
@@ -224,27 +370,55 @@ def setup_subnet(subnet_name, subnet_cidr, AZ, vpc, route_table):
           ]
         }
       ]
-    )
-  route_table.associate_with_subnet(SubnetId=subnet.id)
+    )['Subnet']
+    record.setdefault('Tags', [{'Key': 'Name', 'Value': subnet_name}])
+    subnet = Subnet.from_record(remember('subnet', record, client=client), client)
+    route_table.associate_with_subnet(SubnetId=subnet.id)
+    log('Subnet', subnet_name)
+    return subnet
+  # an existing subnet is only (re)associated when it is not associated
+  # with route_table yet, so reruns make no call
+  association = get_subnet_association(subnet.id, client=client)
+  if association is None:
+    route_table.associate_with_subnet(SubnetId=subnet.id)
+  elif association['RouteTableId'] != route_table.id:
+    client.replace_route_table_association(AssociationId=association['RouteTableAssociationId'],
+                                           RouteTableId=route_table.id)
   log('Subnet', subnet_name)
   return subnet
 
-def setup_security_group(sg_name, vpc_id):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-
-  response = client.describe_security_groups(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ sg_name ]
-      }
-    ]
-  )
-  if response['SecurityGroups']:
-    security_group = ec2.SecurityGroup(response['SecurityGroups'][0]['GroupId'])
+def get_subnet_association(subnet_id, client=None):
+  # the route table association of a subnet, None when it uses the main route table
+  client = client or get_client('ec2')
+  inventory = current_inventory()
+  if inventory is not None and inventory.covers('route_table'):
+    route_tables = inventory.all('route_table')
+  else:
+    route_tables = iter_route_tables([{'Name': 'association.subnet-id', 'Values': [subnet_id]}], client=client)
+  for route_table in route_tables:
+    for association in route_table.get('Associations', []):
+      if association.get('SubnetId') == subnet_id:
+        return association
+  return None
+
+# ingress rules every new security group starts with
+SECURITY_GROUP_INGRESS = [
+  {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
+  {'IpProtocol': 'tcp', 'FromPort': 80, 'ToPort': 80, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
+]
+
+def setup_security_group(sg_name, vpc_id, ingress=None, client=None):
+  # ingress is the set of rules (see sg_rules.py) the group must have, by
+  # default SECURITY_GROUP_INGRESS; existing groups are reconciled to it too
+  client = client or get_client('ec2')
+  desired = rules(SECURITY_GROUP_INGRESS) if ingress is None else ingress
+
+  record = find('security_group', sg_name, client=client)
+  if record:
+    security_group = SecurityGroup.from_record(record, client)
+    current = record.get('IpPermissions')
   else:
-    security_group = ec2.create_security_group(
+    response = client.create_security_group(
       GroupName=sg_name, 
       Description='----', 
       VpcId=vpc_id,
@@ -260,37 +434,35 @@ def setup_security_group(sg_name, vpc_id):
         }
       ] 
     )      
-    security_group.authorize_ingress(CidrIp='0.0.0.0/0', IpProtocol='tcp', FromPort=22, ToPort=22)
-    security_group.authorize_ingress(CidrIp='0.0.0.0/0', IpProtocol='tcp', FromPort=80, ToPort=80)
+    security_group = SecurityGroup(response['GroupId'], client=client)
+    security_group.data.update({
+      'GroupName': sg_name,
+      'VpcId': vpc_id,
+      'Tags': [{'Key': 'Name', 'Value': sg_name}]})
+    current = []
+  # record is the inventory's own copy, updated in place
+  security_group.data['IpPermissions'], added, removed = reconcile_ingress(
+    security_group.id, desired, current=current, client=client)
+  if not record:
+    remember('security_group', security_group.data, client=client)
   log('Security Group', sg_name)
   return security_group
 
-def is_key_pair_exists(key_pair_name):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-  # create a file to store the key locally
-  response = client.describe_key_pairs(
-    Filters=[
-      {
-        'Name' : "key-name",
-        "Values" : [ key_pair_name ]
-      }
-    ]
-  )
-  if response(['KeyPairs']) == 0:
+def is_key_pair_exists(key_pair_name, client=None):
+  client = client or get_client('ec2')
+  if find('key_pair', key_pair_name, client=client) is None:
     return False
   else:
     return True
 
-def create_key_pair(key_pair_name):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
+def create_key_pair(key_pair_name, client=None):
+  client = client or get_client('ec2')
   key_pair_file = key_pair_name + ".pem"
   if os.path.exists(key_pair_file):
     os.remove(key_pair_file)
   outfile = open(key_pair_file, 'w')
   # create a key pair
-  key_pair = ec2.create_key_pair(
+  key_pair = client.create_key_pair(
     KeyName=key_pair_name,
     TagSpecifications=[
       {
@@ -305,26 +477,20 @@ def create_key_pair(key_pair_name):
     ] 
   )
   # capture the key and store it in a file
-  outfile.write(str(key_pair.key_material))
+  outfile.write(str(key_pair['KeyMaterial']))
+  remember('key_pair', {'KeyPairId': key_pair['KeyPairId'], 'KeyName': key_pair_name}, client=client)
   log('Key pair', key_pair_name)
   return True
   
-def setup_key_pair(key_pair_name):
-  if not is_key_pair_exists(key_pair_name):
-    create_key_pair(key_pair_name)
-
-def setup_eip(eip_name):
-  client = boto3.client('ec2')
-  response = client.describe_addresses(
-      Filters=[
-          {
-              'Name': 'tag:Name',
-              'Values': [eip_name] 
-          },
-      ]
-  )
-  if response['Addresses']:
-    AllocationId = response['Addresses'][0]['AllocationId']
+def setup_key_pair(key_pair_name, client=None):
+  if not is_key_pair_exists(key_pair_name, client=client):
+    create_key_pair(key_pair_name, client=client)
+
+def setup_eip(eip_name, client=None):
+  client = client or get_client('ec2')
+  record = find('elastic_ip', eip_name, client=client)
+  if record:
+    AllocationId = record['AllocationId']
   else:
     eip = client.allocate_address(
       Domain='vpc',
@@ -336,32 +502,29 @@ def setup_eip(eip_name):
               "Key": "Name",
               "Value": eip_name
             },
+            {
+              "Key": "auto-delete",
+              "Value": "yes"
+            },
           ]
         }
       ]
     )
     AllocationId = eip['AllocationId']
+    remember('elastic_ip', {'AllocationId': AllocationId, 'PublicIp': eip.get('PublicIp'),
+                            'Tags': [{'Key': 'Name', 'Value': eip_name}, {'Key': 'auto-delete', 'Value': 'yes'}]},
+             client=client)
   log('Elastic IP', eip_name)
   return AllocationId
 
-def setup_nat_gateway(NGW_NAME, eip_id, subnet_id):
-  client = boto3.client('ec2')
-  response = client.describe_nat_gateways(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ NGW_NAME ]
-      },
-      {
-        'Name' : "state",
-        'Values' : ["available", "pending"]
-      }
-    ],
-  )
-  if response['NatGateways']:
-    nat_gateway_id = response['NatGateways'][0]['NatGatewayId']
+def setup_nat_gateway(NGW_NAME, eip_id, subnet_id, wait=True, client=None):
+  client = client or get_client('ec2')
+  record = find('nat_gateway', NGW_NAME, client=client, states=['available', 'pending'])
+  if record:
+    nat_gateway_id = record['NatGatewayId']
   else:
     nat_gateway = client.create_nat_gateway(
+      **with_token({}, client_token()),
       AllocationId=eip_id,
       SubnetId = subnet_id,
       TagSpecifications=[
@@ -372,48 +535,38 @@ def setup_nat_gateway(NGW_NAME, eip_id, subnet_id):
               "Key": "Name",
               "Value": NGW_NAME
             },
+            {
+              "Key": "auto-delete",
+              "Value": "yes"
+            },
           ]
         }
       ]
     )
     nat_gateway_id = nat_gateway['NatGateway']['NatGatewayId']
-    waiter = client.get_waiter('nat_gateway_available')
-    waiter.wait(
-      NatGatewayIds=[nat_gateway_id]
-    )
+    remember('nat_gateway', nat_gateway['NatGateway'], client=client)
+    if wait:
+      wait_for('nat_gateway', nat_gateway_id, 'available', client=client)
   log('NAT Gateway', NGW_NAME)
   return nat_gateway_id
 
-def delete_vpc(vpc_name):
-  client = boto3.client('ec2')
-  response = client.describe_vpcs(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ vpc_name ]
-      }
-    ]
-  )
-  if response['Vpcs']:
+def delete_vpc(vpc_name, client=None):
+  client = client or get_client('ec2')
+  record = find('vpc', vpc_name, client=client)
+  if record:
     client.delete_vpc(
-      VpcId=response['Vpcs'][0]['VpcId']
+      VpcId=record['VpcId']
     )
+    forget('vpc', record['VpcId'], client=client)
   log('VPC', vpc_name)
 
-def delete_internet_gateway(igw_name):
-  client = boto3.client('ec2')
-  response = client.describe_internet_gateways(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ igw_name ]
-      }
-    ]
-  )
-  if response['InternetGateways']:
-    if response['InternetGateways'][0]['Attachments']:
-      internet_gateway_id = response['InternetGateways'][0]['InternetGatewayId']
-      vpc_id = response['InternetGateways'][0]['Attachments'][0]['VpcId']
+def delete_internet_gateway(igw_name, client=None):
+  client = client or get_client('ec2')
+  record = find('internet_gateway', igw_name, client=client)
+  if record:
+    internet_gateway_id = record['InternetGatewayId']
+    if record['Attachments']:
+      vpc_id = record['Attachments'][0]['VpcId']
 
       client.detach_internet_gateway(
         InternetGatewayId=internet_gateway_id,
@@ -422,163 +575,110 @@ def delete_internet_gateway(igw_name):
     client.delete_internet_gateway(
       InternetGatewayId=internet_gateway_id
     )
+    forget('internet_gateway', internet_gateway_id, client=client)
   log("Internet Gateway", igw_name)
 
-def delete_route_table(route_table_name):
-  client = boto3.client('ec2')
-  response = client.describe_route_tables(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ route_table_name ]
-      }
-    ]
-  )
-  if response['RouteTables']:
-    if response['RouteTables'][0]['Associations']:
-      for i in range(len(response['RouteTables'][0]['Associations'])):
+def delete_route_table(route_table_name, client=None):
+  client = client or get_client('ec2')
+  record = find('route_table', route_table_name, client=client)
+  if record:
+    if record['Associations']:
+      for i in range(len(record['Associations'])):
         client.disassociate_route_table(
-          AssociationId=response['RouteTables'][0]['Associations'][i]['RouteTableAssociationId']
+          AssociationId=record['Associations'][i]['RouteTableAssociationId']
         )  
     client.delete_route_table(
-      RouteTableId=response['RouteTables'][0]['RouteTableId']
+      RouteTableId=record['RouteTableId']
     )
+    forget('route_table', record['RouteTableId'], client=client)
   log('Route Table', route_table_name)
 
-def delete_subnet(subnet_name):
-  client = boto3.client('ec2')
+def delete_subnet(subnet_name, client=None):
+  client = client or get_client('ec2')
   # check if subnet already exists.
-  response = client.describe_subnets(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ subnet_name ]
-      }
-    ]
-  )
-  if response['Subnets']:
+  record = find('subnet', subnet_name, client=client)
+  if record:
     client.delete_subnet(
-      SubnetId=response['Subnets'][0]['SubnetId'])
+      SubnetId=record['SubnetId'])
+    forget('subnet', record['SubnetId'], client=client)
   log('Subnet', subnet_name)
 
-def delete_security_group(sg_name):
-  client = boto3.client('ec2')
-  response = client.describe_security_groups(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ sg_name ]
-      }
-    ]
-  )
-  if response['SecurityGroups']:
+def delete_security_group(sg_name, client=None):
+  client = client or get_client('ec2')
+  record = find('security_group', sg_name, client=client)
+  if record:
     client.delete_security_group(
-      GroupId=response['SecurityGroups'][0]['GroupId']
+      GroupId=record['GroupId']
     )
+    forget('security_group', record['GroupId'], client=client)
   log('Security Group', sg_name)
 
-def delete_key_pair(key_pair_name):
-  client = boto3.client('ec2')
+def delete_key_pair(key_pair_name, client=None):
+  client = client or get_client('ec2')
   # create a file to store the key locally
-  response = client.describe_key_pairs(
-    Filters=[
-      {
-        'Name' : "key-name",
-        "Values" : [ key_pair_name ]
-      }
-    ]
-  )
-  if response['KeyPairs']:
+  record = find('key_pair', key_pair_name, client=client)
+  if record:
     client.delete_key_pair(
       KeyName=key_pair_name
     )
+    forget('key_pair', record['KeyPairId'], client=client)
     if os.path.exists('{key_pair_name}.pem'):
       os.remove('{key_pair_name}.pem')
   log('Key Pair', key_pair_name)
 
-def delete_instance(instance_name):
-  client = boto3.client('ec2')
-  response = client.describe_instances(
-    Filters=[
-      {
-        'Name' : 'tag:Name',
-        'Values' : [ instance_name ]
-      },
-      {
-        'Name' : 'instance-state-name',
-        'Values' : [ 'running', 'pending']
-      }
-    ]
-  )
-  if response['Reservations']:
+def delete_instance(instance_name, wait=True, client=None):
+  client = client or get_client('ec2')
+  record = find('instance', instance_name, client=client, states=['running', 'pending'])
+  if record:
+    instance_id = record['InstanceId']
     client.terminate_instances(
-      InstanceIds=[response['Reservations'][0]['Instances'][0]['InstanceId']]
-    )
-    waiter = client.get_waiter('instance_terminated')
-    waiter.wait(
-      InstanceIds=[response['Reservations'][0]['Instances'][0]['InstanceId']]
+      InstanceIds=[instance_id]
     )
+    record['State'] = {'Name': 'shutting-down'}
+    terminated = waiter_service().submit('instance', instance_id, 'terminated', client=client)
+    if wait:
+      terminated.result()
     log('EC2 Instance Deleted', instance_name)
+    return terminated
   else:
     log('EC2 Instance Not Found', instance_name)
 
-def delete_eip(eip_name):
-  client = boto3.client('ec2')
-  response = client.describe_addresses(
-      Filters=[
-          {
-              'Name': 'tag:Name',
-              'Values': [eip_name] 
-          },
-      ]
-  )
-  if response['Addresses']:
+def delete_eip(eip_name, client=None):
+  client = client or get_client('ec2')
+  record = find('elastic_ip', eip_name, client=client)
+  if record:
     client.release_address(
-      AllocationId=response['Addresses'][0]['AllocationId']
+      AllocationId=record['AllocationId']
     )
+    forget('elastic_ip', record['AllocationId'], client=client)
   log('Elastic IP', eip_name)
 
-def delete_nat_gateway(NGW_NAME):
-  client = boto3.client('ec2')
-  response = client.describe_nat_gateways(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ NGW_NAME ]
-      },
-      {
-        'Name' : "state",
-        'Values' : ["available", "pending"]
-      }
-    ],
-  )
-  if response['NatGateways']:
+def delete_nat_gateway(NGW_NAME, wait=True, client=None):
+  client = client or get_client('ec2')
+  record = find('nat_gateway', NGW_NAME, client=client, states=['available', 'pending'])
+  if record:
+    nat_gateway_id = record['NatGatewayId']
     client.delete_nat_gateway(
-      NatGatewayId=response['NatGateways'][0]['NatGatewayId']
+      NatGatewayId=nat_gateway_id
     )
-    wait_deleted_nat_gateway(response['NatGateways'][0]['NatGatewayId'])
+    deleted = waiter_service().submit('nat_gateway', nat_gateway_id, 'deleted', client=client)
+    deleted.add_done_callback(lambda future: future.exception() or forget('nat_gateway', nat_gateway_id, client=client))
+    if wait:
+      deleted.result()
+    log('Nat Gateway', NGW_NAME)
+    return deleted
   log('Nat Gateway', NGW_NAME)
 
-def wait_deleted_nat_gateway(NGW_ID):
-  client = boto3.client('ec2')
-  response = client.describe_nat_gateways(
-    NatGatewayIds=[NGW_ID]
-  )
-  while True:
-    if response['NatGateways'][0]['State'] == 'deleted':
-      break
-    time.sleep(5)
-    response = client.describe_nat_gateways(
-      NatGatewayIds=[NGW_ID]
-    )
+def wait_deleted_nat_gateway(NGW_ID, client=None):
+  wait_for('nat_gateway', NGW_ID, 'deleted', client=client)
 
-def delete_listener(LB_NAME):
-  client = boto3.client('elbv2')
-  load_balancer_arn = get_load_balancer_arn(LB_NAME)
+def delete_listener(LB_NAME, client=None):
+  client = client or get_client('elbv2')
+  load_balancer_arn = get_load_balancer_arn(LB_NAME, client=client)
   if load_balancer_arn == None:
     return 0
   else:
-    listener_arn = get_listener_arn(load_balancer_arn)
+    listener_arn = get_listener_arn(load_balancer_arn, client=client)
     if load_balancer_arn == None:
       return 0
     else:
@@ -587,205 +687,228 @@ def delete_listener(LB_NAME):
       )
   log('Listener', LB_NAME)
 
-def delete_load_balancer(LB_NAME):
-  client = boto3.client('elbv2')
-  try:
-    response = client.describe_load_balancers(
-      Names=[LB_NAME]
-    )
-  except ClientError as e:
-    pass
-  else:
+def delete_load_balancer(LB_NAME, client=None):
+  client = client or get_client('elbv2')
+  record = find('load_balancer', LB_NAME, client=client)
+  if record:
     client.delete_load_balancer(
-      LoadBalancerArn=response['LoadBalancers'][0]['LoadBalancerArn']
+      LoadBalancerArn=record['LoadBalancerArn']
     )
+    forget('load_balancer', record['LoadBalancerArn'], client=client)
   log('Load Balancer', LB_NAME)
 
-def delete_target_group(LB_TARGET_NAME):
-  client = boto3.client('elbv2')
-  try:
-    response = client.describe_target_groups(
-      Names=[ LB_TARGET_NAME ]
-    )
-  except ClientError as e:
-    pass
-  else:
+def delete_target_group(LB_TARGET_NAME, client=None):
+  client = client or get_client('elbv2')
+  record = find('target_group', LB_TARGET_NAME, client=client)
+  if record:
     client.delete_target_group(
-      TargetGroupArn=response['TargetGroups'][0]['TargetGroupArn']
+      TargetGroupArn=record['TargetGroupArn']
     )
+    forget('target_group', record['TargetGroupArn'], client=client)
   log('Target Group', LB_TARGET_NAME)
 
-def setup_load_balancer(LB_NAME, subnet_1_id, subnet_2_id, security_group_id):
-  client = boto3.client('elbv2')
-  try:
-    response = client.describe_load_balancers(
-      Names=[LB_NAME]
-    )
-  except ClientError as e:
+def setup_load_balancer(LB_NAME, subnet_1_id, subnet_2_id, security_group_id, wait=True, client=None, extra_subnet_ids=()):
+  client = client or get_client('elbv2')
+  record = find('load_balancer', LB_NAME, client=client)
+  if record is None:
     response = client.create_load_balancer(
       Name=LB_NAME,
       Subnets=[ 
         subnet_1_id, 
         subnet_2_id 
-      ],
+      ] + list(extra_subnet_ids),
       SecurityGroups=[ security_group_id ]
     )
     load_balancer_arn = response['LoadBalancers'][0]['LoadBalancerArn']
-    waiter = client.get_waiter('load_balancer_available')
-    waiter.wait(
-      LoadBalancerArns=[load_balancer_arn]
-    )
+    remember('load_balancer', response['LoadBalancers'][0], client=client)
+    if wait:
+      wait_for('load_balancer', load_balancer_arn, 'active', client=client)
   else:
-    load_balancer_arn = get_load_balancer_arn(LB_NAME)
+    load_balancer_arn = record['LoadBalancerArn']
   log('Load Balancer', LB_NAME)
   return load_balancer_arn
 
-def setup_target_group(LB_TARGET_NAME, vpc):
-  client = boto3.client('elbv2')
-  try:
-    response = client.describe_target_groups(
-      Names=[ LB_TARGET_NAME ]
-    )
-  except ClientError as e:
+def setup_target_group(LB_TARGET_NAME, vpc, client=None):
+  client = client or get_client('elbv2')
+  record = find('target_group', LB_TARGET_NAME, client=client)
+  if record is None:
     response = client.create_target_group(
         Name=LB_TARGET_NAME,
         Port=80,
         Protocol='HTTP',
         VpcId=vpc.id,
     )
+    record = remember('target_group', response['TargetGroups'][0], client=client)
   log('Target Group', LB_TARGET_NAME)
-  return response['TargetGroups'][0]['TargetGroupArn']
-
-def register_targets(target_group_arn, instance_1_id, instance_2_id):
-  client = boto3.client('elbv2')
-  response = client.register_targets(
-      TargetGroupArn=target_group_arn,
-      Targets=[
-          {
-              'Id': instance_1_id,
-              'Port': 80,
-          },
-          {
-              'Id': instance_2_id,
-              'Port': 80,
-          },
-      ],
-  )
+  return record['TargetGroupArn']
+
+# targets per RegisterTargets call
+REGISTER_BATCH = 100
+
+def wait_running(instance_ids, timeout=None, client=None):
+  # ELBv2 rejects targets that are not running yet (InvalidTarget), so new
+  # instances wait here first: all of them through the waiter service, one
+  # describe per tick
+  futures = [waiter_service().submit('instance', instance_id, 'running', client=client, timeout=timeout)
+             for instance_id in instance_ids]
+  return [future.result() for future in futures]
+
+def register_targets(target_group_arn, *instance_ids, port=80, client=None):
+  # any number of targets, up to REGISTER_BATCH per call; registering a
+  # target that is already registered is a no-op
+  client = client or get_client('elbv2')
+  targets = [{'Id': instance_id, 'Port': port} for instance_id in instance_ids]
+  for i in range(0, len(targets), REGISTER_BATCH):
+    response = client.register_targets(
+        TargetGroupArn=target_group_arn,
+        Targets=targets[i:i + REGISTER_BATCH],
+    )
+  log('Targets registered', f'{len(targets)} in {target_group_arn.rsplit("/", 2)[-2]}')
+
+def deregister_targets(target_group_arn, *instance_ids, port=80, client=None):
+  # the targets go to 'draining' and leave the group once the load
+  # balancer's deregistration delay is over
+  client = client or get_client('elbv2')
+  targets = [{'Id': instance_id, 'Port': port} for instance_id in instance_ids]
+  for i in range(0, len(targets), REGISTER_BATCH):
+    client.deregister_targets(
+        TargetGroupArn=target_group_arn,
+        Targets=targets[i:i + REGISTER_BATCH],
+    )
+  log('Targets deregistered', f'{len(targets)} in {target_group_arn.rsplit("/", 2)[-2]}')
 
-def setup_listener(target_group_arn, loadbalancer_arn):
-  client = boto3.client('elbv2')
-  response = client.create_listener(
-      DefaultActions=[
+def setup_listener(target_group_arn, loadbalancer_arn, port=80, protocol='HTTP', client=None):
+  # one listener per port: created when missing, pointed at the target group
+  # when it forwards somewhere else, left alone otherwise
+  client = client or get_client('elbv2')
+  default_actions = [
+      {
+          'TargetGroupArn': target_group_arn,
+          'Type': 'forward',
+      },
+  ]
+  listener = None
+  for candidate in client.describe_listeners(LoadBalancerArn=loadbalancer_arn)['Listeners']:
+    if candidate['Port'] == port:
+      listener = candidate
+  if listener is None:
+    response = client.create_listener(
+        DefaultActions=default_actions,
+        LoadBalancerArn=loadbalancer_arn,
+        Port=port,
+        Protocol=protocol,
+        Tags=[
           {
-              'TargetGroupArn': target_group_arn,
-              'Type': 'forward',
+              'Key': 'Name',
+              'Value': 'ELBHTTPListener'
           },
-      ],
-      LoadBalancerArn=loadbalancer_arn,
-      Port=80,
-      Protocol='HTTP',
-      Tags=[
-        {
-            'Key': 'Name',
-            'Value': 'ELBHTTPListener'
-        },
-    ]
-  )
+      ]
+    )
+    listener_arn = response['Listeners'][0]['ListenerArn']
+    log('Listener created', port)
+  else:
+    listener_arn = listener['ListenerArn']
+    forwards = [action.get('TargetGroupArn') for action in listener.get('DefaultActions', [])]
+    if forwards != [target_group_arn] or listener['Protocol'] != protocol:
+      client.modify_listener(ListenerArn=listener_arn, Port=port, Protocol=protocol, DefaultActions=default_actions)
+      log('Listener updated', port)
+  return listener_arn
+
+def wait_healthy_targets(target_group_arn, instance_ids, timeout=None, client=None):
+  # all targets' health through the waiter service: one describe_target_health
+  # per target group per tick, however many targets are waiting
+  futures = [waiter_service().submit('target_health', target_health_id(target_group_arn, instance_id), 'healthy',
+                                     client=client, timeout=timeout)
+             for instance_id in instance_ids]
+  return [future.result() for future in futures]
+
+def setup_load_balancer_stack(LB_NAME, LB_TARGET_NAME, subnet_ids, security_group_id, vpc, instances=(),
+                              wait_healthy=False, port=80, client=None, ec2_client=None):
+  # Load balancer, target group, targets and listener, with everything that
+  # does not depend on each other in parallel: the target group and the
+  # instances (a list of IDs or handles, or a function that launches them)
+  # are set up while the load balancer is still provisioning, and nothing
+  # but the health wait blocks on the load balancer becoming active. The
+  # instances are registered once they are running.
+  # Returns the Dag; its results hold the ARNs and the instances.
+  client = client or get_client('elbv2')
+  subnet_ids = list(subnet_ids)
+  launch = instances if callable(instances) else (lambda: instances)
+  dag = Dag()
+  dag.add('load_balancer', lambda r: setup_load_balancer(LB_NAME, subnet_ids[0], subnet_ids[1], security_group_id,
+                                                         wait=False, client=client, extra_subnet_ids=subnet_ids[2:]))
+  dag.add('target_group', lambda r: setup_target_group(LB_TARGET_NAME, vpc, client=client))
+  dag.add('instances', lambda r: [getattr(instance, 'id', instance) for instance in launch()])
+  dag.add('active', lambda r: wait_for('load_balancer', r['load_balancer'], 'active', client=client),
+          ['load_balancer'])
+  dag.add('running', lambda r: wait_running(r['instances'], client=ec2_client), ['instances'])
+  dag.add('targets', lambda r: register_targets(r['target_group'], *r['instances'], port=port, client=client),
+          ['target_group', 'running'])
+  dag.add('listener', lambda r: setup_listener(r['target_group'], r['load_balancer'], port=port, client=client),
+          ['load_balancer', 'target_group'])
+  if wait_healthy:
+    dag.add('healthy', lambda r: wait_healthy_targets(r['target_group'], r['instances'], client=client),
+            ['active', 'targets', 'listener'])
+  dag.run(max_workers=6)
+  log('Load Balancer stack', LB_NAME)
+  return dag
 
 # Get ID / ARN functions
-def get_load_balancer_arn(LB_NAME):
-  client = boto3.client('elbv2')
-  try:
-    response = client.describe_load_balancers(
-      Names=[LB_NAME]
-    )
-  except ClientError as e:
-    return None
+def get_load_balancer_arn(LB_NAME, client=None):
+  client = client or get_client('elbv2')
+  record = find('load_balancer', LB_NAME, client=client)
+  if record:
+    return record['LoadBalancerArn']
   else:
-    return response['LoadBalancers'][0]['LoadBalancerArn']
+    return None
 
-def get_vpc_id(vpc_name):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-  response = client.describe_vpcs(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ vpc_name ]
-      }
-    ]
-  )
-  if response['Vpcs']:
-    vpc = ec2.Vpc(response['Vpcs'][0]['VpcId'])
-    return vpc.id
+def get_vpc_id(vpc_name, client=None):
+  client = client or get_client('ec2')
+  record = find('vpc', vpc_name, client=client)
+  if record:
+    return record['VpcId']
   else:
     return '0'
 
-def get_vpc(vpc_name):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
-  response = client.describe_vpcs(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ vpc_name ]
-      }
-    ]
-  )
-  if response['Vpcs']:
-    vpc = ec2.Vpc(response['Vpcs'][0]['VpcId'])
+def get_vpc(vpc_name, client=None):
+  client = client or get_client('ec2')
+  record = find('vpc', vpc_name, client=client)
+  if record:
+    vpc = Vpc.from_record(record, client)
     return vpc
   else:
     return None
 
-def get_subnet(subnet_name):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
+def get_subnet(subnet_name, client=None):
+  client = client or get_client('ec2')
   # check if subnet already exists.
-  response = client.describe_subnets(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ subnet_name ]
-      }
-    ]
-  )
-  if response['Subnets']:
-    subnet = ec2.Subnet(response['Subnets'][0]['SubnetId'])
+  record = find('subnet', subnet_name, client=client)
+  if record:
+    subnet = Subnet.from_record(record, client)
     return subnet
   else:
     return None
 
-def get_security_group(sg_name):
-  client = boto3.client('ec2')
-  ec2 = boto3.resource('ec2')
+def get_security_group(sg_name, client=None):
+  client = client or get_client('ec2')
 
-  response = client.describe_security_groups(
-    Filters=[
-      {
-        'Name' : "tag:Name",
-        "Values" : [ sg_name ]
-      }
-    ]
-  )
-  if response['SecurityGroups']:
-    security_group = ec2.SecurityGroup(response['SecurityGroups'][0]['GroupId'])
+  record = find('security_group', sg_name, client=client)
+  if record:
+    security_group = SecurityGroup.from_record(record, client)
     return security_group
   else:
     return None
 
-def get_target_group_arn(LB_TARGET_NAME):
-  client = boto3.client('elbv2')
-  response = client.describe_target_groups(
-    Names=[LB_TARGET_NAME]
-  )
-  if response['TargetGroups']:
-    return response['TargetGroups'][0]['TargetGroupArn']
+def get_target_group_arn(LB_TARGET_NAME, client=None):
+  client = client or get_client('elbv2')
+  record = find('target_group', LB_TARGET_NAME, client=client)
+  if record:
+    return record['TargetGroupArn']
   else:
     return '0'
 
-def get_listener_arn(LB_ARN):
-  client = boto3.client('elbv2')
+def get_listener_arn(LB_ARN, client=None):
+  client = client or get_client('elbv2')
   response = client.describe_listeners(
     LoadBalancerArn=LB_ARN
   )
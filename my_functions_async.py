@@ -0,0 +1,147 @@
+#----------------
+# my_functions_async.py
+#-----------------
+# asyncio front end for the my_functions helpers.
+#
+# Every setup_*, delete_*, get_* and is_* helper has an *_async twin that
+# runs the blocking helper on one bounded thread pool, shared by the whole
+# process, so the event loop never blocks and the number of threads stays
+# fixed no matter how many environments are driven at once:
+#
+#   vpc = await setup_vpc_async('myvpc', '10.0.0.0/16')
+#
+# Long-running operations do not hold a pool thread while they wait. NAT
+# gateway and load balancer creation, the load balancer stack, instance
+# termination and NAT gateway deletion hand the wait to the waiter service
+# (waiters.py) and come back as awaitables on its futures:
+#
+#   nat_gateway_id = await setup_nat_gateway_async(name, eip_id, subnet_id)
+#   terminated = await delete_instance_async(name, wait=False)
+#   await terminated
+#
+# Calls keep the scheduler priority (scheduler.priority) of the coroutine
+# that made them.
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import my_functions
+from scheduler import current_priority, priority
+from waiters import waiter_service, target_health_id
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor(max_workers=64):
+  global _executor
+  if _executor is None:
+    with _executor_lock:
+      if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='my-functions-async')
+  return _executor
+
+def use_executor(executor):
+  global _executor
+  _executor = executor
+  return executor
+
+def _call(value, fn, args, kwargs):
+  if value is None:
+    return fn(*args, **kwargs)
+  with priority(value):
+    return fn(*args, **kwargs)
+
+def run(fn, *args, **kwargs):
+  # Run a blocking function on the shared executor and await its result.
+  loop = asyncio.get_running_loop()
+  return loop.run_in_executor(get_executor(), _call, current_priority(), fn, args, kwargs)
+
+def _async(fn):
+  @functools.wraps(fn)
+  async def wrapper(*args, **kwargs):
+    return await run(fn, *args, **kwargs)
+  wrapper.__name__ = wrapper.__qualname__ = fn.__name__ + '_async'
+  return wrapper
+
+# helpers that only make a bounded number of calls, wrapped as they are
+HELPERS = [
+  'setup_vpc', 'setup_internet_gateways', 'setup_route_table', 'setup_instance', 'setup_instances', 'setup_subnet',
+  'setup_security_group', 'setup_key_pair', 'setup_eip', 'setup_target_group', 'setup_listener',
+  'is_key_pair_exists', 'create_key_pair', 'register_targets', 'deregister_targets',
+  'delete_vpc', 'delete_internet_gateway', 'delete_route_table', 'delete_subnet', 'delete_security_group',
+  'delete_key_pair', 'delete_eip', 'delete_listener', 'delete_load_balancer', 'delete_target_group',
+  'get_load_balancer_arn', 'get_vpc_id', 'get_vpc', 'get_subnet', 'get_security_group', 'get_target_group_arn',
+  'get_listener_arn',
+]
+
+for _name in HELPERS:
+  globals()[_name + '_async'] = _async(getattr(my_functions, _name))
+
+def wait_for_async(kind, id, target, client=None, timeout=None):
+  # awaitable that resolves with the state once the resource reaches target
+  return asyncio.wrap_future(waiter_service().submit(kind, id, target, client=client, timeout=timeout))
+
+async def wait_deleted_nat_gateway_async(NGW_ID, client=None):
+  return await wait_for_async('nat_gateway', NGW_ID, 'deleted', client=client)
+
+async def setup_nat_gateway_async(NGW_NAME, eip_id, subnet_id, wait=True, client=None):
+  nat_gateway_id = await run(my_functions.setup_nat_gateway, NGW_NAME, eip_id, subnet_id, wait=False, client=client)
+  if wait:
+    await wait_for_async('nat_gateway', nat_gateway_id, 'available', client=client)
+  return nat_gateway_id
+
+async def setup_load_balancer_async(LB_NAME, subnet_1_id, subnet_2_id, security_group_id, wait=True, client=None):
+  load_balancer_arn = await run(my_functions.setup_load_balancer, LB_NAME, subnet_1_id, subnet_2_id,
+                                security_group_id, wait=False, client=client)
+  if wait:
+    await wait_for_async('load_balancer', load_balancer_arn, 'active', client=client)
+  return load_balancer_arn
+
+async def setup_load_balancer_stack_async(LB_NAME, LB_TARGET_NAME, subnet_ids, security_group_id, vpc, instances=(),
+                                          wait_healthy=False, port=80, client=None, ec2_client=None):
+  # setup_load_balancer_stack() with the same steps in the same order, but
+  # with its waits (load balancer active, instances running, targets healthy)
+  # on waiter service futures instead of pool threads. Returns the results
+  # by step name, as the Dag's results.
+  subnet_ids = list(subnet_ids)
+  launch = instances if callable(instances) else (lambda: instances)
+  r = {}
+  r['load_balancer'], r['target_group'], r['instances'] = await asyncio.gather(
+    run(my_functions.setup_load_balancer, LB_NAME, subnet_ids[0], subnet_ids[1], security_group_id, wait=False,
+        client=client, extra_subnet_ids=subnet_ids[2:]),
+    run(my_functions.setup_target_group, LB_TARGET_NAME, vpc, client=client),
+    run(lambda: [getattr(instance, 'id', instance) for instance in launch()]))
+  active = wait_for_async('load_balancer', r['load_balancer'], 'active', client=client)
+  listener = run(my_functions.setup_listener, r['target_group'], r['load_balancer'], port=port, client=client)
+  r['running'] = await asyncio.gather(*[wait_for_async('instance', instance_id, 'running', client=ec2_client)
+                                        for instance_id in r['instances']])
+  r['targets'] = await run(my_functions.register_targets, r['target_group'], *r['instances'], port=port,
+                           client=client)
+  r['listener'] = await listener
+  r['active'] = await active
+  if wait_healthy:
+    r['healthy'] = await asyncio.gather(*[
+      wait_for_async('target_health', target_health_id(r['target_group'], instance_id), 'healthy', client=client)
+      for instance_id in r['instances']])
+  my_functions.log('Load Balancer stack', LB_NAME)
+  return r
+
+async def delete_instance_async(instance_name, wait=True, client=None):
+  # with wait=False, returns an awaitable that resolves once the instance is
+  # terminated (None if there was no such instance)
+  terminated = await run(my_functions.delete_instance, instance_name, wait=False, client=client)
+  if terminated is None:
+    return None
+  terminated = asyncio.wrap_future(terminated)
+  if wait:
+    return await terminated
+  return terminated
+
+async def delete_nat_gateway_async(NGW_NAME, wait=True, client=None):
+  deleted = await run(my_functions.delete_nat_gateway, NGW_NAME, wait=False, client=client)
+  if deleted is None:
+    return None
+  deleted = asyncio.wrap_future(deleted)
+  if wait:
+    return await deleted
+  return deleted
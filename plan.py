@@ -0,0 +1,301 @@
+#----------------
+# plan.py
+#-----------------
+# Plan / apply for the launch_ec2.py topology.
+#
+# plan() compares a desired-state model of the topology with one inventory
+# snapshot and returns the minimal, ordered list of changes: resources that
+# are missing, plus drift on resources that exist (internet gateway not
+# attached, missing or wrong 0.0.0.0/0 route, subnet not associated with its
+# route table, ingress rules that differ from the desired set). apply() runs
+# only those changes, on the dependency-graph executor. On a converged
+# environment plan() returns an empty list and apply() makes no mutating call
+# at all.
+#
+# The desired state is a plain dict:
+#
+#   {
+#     'vpc': {'name': 'LinuxEnvVpc', 'cidr': '10.0.0.0/16'},
+#     'internet_gateway': {'name': 'LinuxEnvIgw'},
+#     'route_table': {'name': 'LinuxEnvRTPublic'},
+#     'subnets': [{'name': 'LinuxEnvPublic', 'cidr': '10.0.1.0/24', 'az': 'us-west-2a'}],
+#     'subnet_layout': {'azs': ['us-west-2b', 'us-west-2c'], 'tiers': {'public': 24}, 'prefix': 'LinuxEnv'},
+#     'security_groups': [{'name': 'LinuxEnvSg', 'ingress': [('tcp', 22, 22, '0.0.0.0/0')]}],
+#     'instances': [{'name': 'RHEL8', 'ami': ..., 'instance_type': ..., 'subnet': 'LinuxEnvPublic',
+#                    'security_group': 'LinuxEnvSg', 'key_pair': ..., 'userdata': ..., 'public': True,
+#                    'fallback': {'instance_types': [...], 'subnets': [...], 'markets': ['spot', 'on-demand'],
+#                                 'parallel': 1}}],
+#   }
+#
+# Instances with a fallback are launched by capacity.launch_capacity(), from
+# the first of their instance types, subnets and markets with capacity,
+# asking 'parallel' candidates at once (FALLBACK_PARALLEL by default).
+from aws_clients import get_client
+from handles import Vpc, RouteTable
+from dag import Dag
+from sg_rules import rules, diff, reconcile_ingress
+from subnet_layout import layout
+from capacity import candidates, launch_capacity
+from describe import tag_value
+from inventory import current_inventory, snapshot
+from journal import current_journal
+from my_functions import (log, setup_vpc, setup_internet_gateways, setup_route_table, setup_subnet,
+                          setup_security_group, setup_instances, SECURITY_GROUP_INGRESS)
+
+# candidates an instance fallback asks at once; more than one hedges the
+# launch (see capacity.py), at the cost of extra instances terminated right away
+FALLBACK_PARALLEL = 1
+
+PLAN_KINDS = ['vpc', 'internet_gateway', 'route_table', 'subnet', 'security_group', 'instance']
+
+_SYMBOLS = {'create': '+', 'delete': '-'}
+
+class Change:
+  __slots__ = ('action', 'kind', 'name', 'detail', 'fn', 'deps')
+
+  def __init__(self, action, kind, name, fn, deps=(), detail=''):
+    self.action = action
+    self.kind = kind
+    self.name = name
+    self.detail = detail
+    self.fn = fn
+    self.deps = list(deps)
+
+  @property
+  def key(self):
+    return key(self.action, self.kind, self.name)
+
+  def __str__(self):
+    symbol = _SYMBOLS.get(self.action, '~')
+    detail = f' ({self.detail})' if self.detail else ''
+    return f'{symbol} {self.action} {self.kind} {self.name}{detail}'
+
+def unique(values):
+  return list(dict.fromkeys(values))
+
+def key(action, kind, name):
+  return f'{action} {kind} {name}'
+
+def _default_route(route_table):
+  for route in route_table.get('Routes', []):
+    if route.get('DestinationCidrBlock') == '0.0.0.0/0':
+      return route
+  return None
+
+def _associated_route_table(inventory, subnet_id):
+  for route_table in inventory.all('route_table'):
+    for association in route_table.get('Associations', []):
+      if association.get('SubnetId') == subnet_id:
+        return route_table, association
+  return None, None
+
+def layout_subnets(desired, inventory, vpc_id):
+  # desired['subnet_layout'] = {'azs': [...], 'tiers': {'public': 24}, 'prefix': ...} expanded
+  # into subnets; existing layout subnets keep their CIDRs
+  spec = desired.get('subnet_layout')
+  if not spec:
+    return []
+  if set(spec['tiers']) != {'public'}:
+    raise ValueError('plan() has one public route table, so subnet layouts can only have a public tier')
+  vpc_subnets = [record for record in inventory.all('subnet') if vpc_id and record.get('VpcId') == vpc_id]
+  existing = dict((tag_value(record, 'Name'), record['CidrBlock']) for record in vpc_subnets)
+  reserved = [record['CidrBlock'] for record in vpc_subnets] + [subnet['cidr'] for subnet in desired.get('subnets', [])]
+  return layout(desired['vpc']['cidr'], spec['azs'], spec['tiers'], prefix=spec.get('prefix', ''),
+                existing=existing, reserved=reserved)
+
+def plan(desired, inventory=None, client=None):
+  # client selects the account and region; the inventory must describe the same one
+  if inventory is None:
+    inventory = current_inventory() or snapshot(kinds=PLAN_KINDS)
+  client = client or get_client('ec2')
+  journal = current_journal()
+  ids = {}
+  changes = {}
+
+  def exists(kind, name, id):
+    ids[(kind, name)] = id
+    if journal is not None:
+      journal.record_seen(kind, name, id)
+
+  def change(action, kind, name, fn, deps=(), detail=''):
+    c = Change(action, kind, name, fn, [dep for dep in deps if dep in changes], detail)
+    changes[c.key] = c
+    return c.key
+
+  def created(kind, name):
+    return key('create', kind, name)
+
+  def store(kind, name):
+    def fn(resource):
+      ids[(kind, name)] = resource.id
+      return resource
+    return fn
+
+  # VPC
+  vpc = desired['vpc']
+  vpc_name = vpc['name']
+  record = inventory.find('vpc', vpc_name)
+  if record:
+    exists('vpc', vpc_name, record['VpcId'])
+  else:
+    change('create', 'vpc', vpc_name,
+           lambda: store('vpc', vpc_name)(setup_vpc(vpc_name=vpc_name, vpc_cidr=vpc['cidr'], client=client)),
+           detail=vpc['cidr'])
+
+  # internet gateway, attached to the VPC
+  igw_name = desired['internet_gateway']['name']
+  record = inventory.find('internet_gateway', igw_name)
+  if record is None:
+    change('create', 'internet_gateway', igw_name,
+           lambda: store('internet_gateway', igw_name)(
+             setup_internet_gateways(igw_name, Vpc(ids[('vpc', vpc_name)], client=client), client=client)),
+           [created('vpc', vpc_name)])
+  else:
+    exists('internet_gateway', igw_name, record['InternetGatewayId'])
+    attached = [attachment['VpcId'] for attachment in record.get('Attachments', [])]
+    if ids.get(('vpc', vpc_name)) not in attached:
+      change('attach', 'internet_gateway', igw_name,
+             lambda: client.attach_internet_gateway(
+               InternetGatewayId=ids[('internet_gateway', igw_name)], VpcId=ids[('vpc', vpc_name)]),
+             [created('vpc', vpc_name)], detail=vpc_name)
+
+  # route table with a 0.0.0.0/0 route to the internet gateway
+  route_table_name = desired['route_table']['name']
+  igw_deps = [created('internet_gateway', igw_name), key('attach', 'internet_gateway', igw_name)]
+  route_table_record = inventory.find('route_table', route_table_name)
+  if route_table_record is None:
+    change('create', 'route_table', route_table_name,
+           lambda: store('route_table', route_table_name)(
+             setup_route_table(route_table_name, Vpc(ids[('vpc', vpc_name)], client=client),
+                               ids[('internet_gateway', igw_name)], client=client)),
+           [created('vpc', vpc_name)] + igw_deps)
+  else:
+    exists('route_table', route_table_name, route_table_record['RouteTableId'])
+    route = _default_route(route_table_record)
+    if route is None:
+      change('create_route', 'route_table', route_table_name,
+             lambda: client.create_route(
+               RouteTableId=ids[('route_table', route_table_name)], DestinationCidrBlock='0.0.0.0/0',
+               GatewayId=ids[('internet_gateway', igw_name)]),
+             igw_deps, detail='0.0.0.0/0')
+    elif route.get('GatewayId') != ids.get(('internet_gateway', igw_name)) or route.get('State') == 'blackhole':
+      change('replace_route', 'route_table', route_table_name,
+             lambda: client.replace_route(
+               RouteTableId=ids[('route_table', route_table_name)], DestinationCidrBlock='0.0.0.0/0',
+               GatewayId=ids[('internet_gateway', igw_name)]),
+             igw_deps, detail=f'0.0.0.0/0 via {route.get("GatewayId") or route.get("NatGatewayId")}')
+
+  # subnets, associated with the route table
+  for subnet in desired.get('subnets', []) + layout_subnets(desired, inventory, ids.get(('vpc', vpc_name))):
+    subnet_name = subnet['name']
+    record = inventory.find('subnet', subnet_name)
+    if record is None:
+      change('create', 'subnet', subnet_name,
+             lambda subnet=subnet, subnet_name=subnet_name: store('subnet', subnet_name)(
+               setup_subnet(subnet_name, subnet['cidr'], subnet['az'], Vpc(ids[('vpc', vpc_name)], client=client),
+                            RouteTable(ids[('route_table', route_table_name)], client=client), client=client)),
+             [created('vpc', vpc_name), created('route_table', route_table_name)],
+             detail=f'{subnet["cidr"]} {subnet["az"]}')
+      continue
+    exists('subnet', subnet_name, record['SubnetId'])
+    current, association = _associated_route_table(inventory, record['SubnetId'])
+    if current is not None and current['RouteTableId'] == ids.get(('route_table', route_table_name)):
+      continue
+    if association is None:
+      fn = lambda subnet_name=subnet_name: client.associate_route_table(
+        RouteTableId=ids[('route_table', route_table_name)], SubnetId=ids[('subnet', subnet_name)])
+    else:
+      fn = lambda association=association: client.replace_route_table_association(
+        AssociationId=association['RouteTableAssociationId'], RouteTableId=ids[('route_table', route_table_name)])
+    change('associate', 'subnet', subnet_name, fn, [created('route_table', route_table_name)], detail=route_table_name)
+
+  # security groups and their ingress rules
+  for group in desired.get('security_groups', []):
+    sg_name = group['name']
+    wanted = set(group['ingress']) if 'ingress' in group else rules(SECURITY_GROUP_INGRESS)
+    record = inventory.find('security_group', sg_name)
+    if record is None:
+      # created with all of its rules in one call
+      change('create', 'security_group', sg_name,
+             lambda sg_name=sg_name, wanted=wanted: store('security_group', sg_name)(
+               setup_security_group(sg_name, ids[('vpc', vpc_name)], ingress=wanted, client=client)),
+             [created('vpc', vpc_name)], detail=f'{len(wanted)} rules')
+      continue
+    exists('security_group', sg_name, record['GroupId'])
+    added, removed = diff(wanted, rules(record.get('IpPermissions')))
+    if added or removed:
+      change('reconcile', 'security_group', sg_name,
+             lambda record=record, wanted=wanted: reconcile_ingress(
+               record['GroupId'], wanted, current=record.get('IpPermissions'), client=client),
+             detail=', '.join([f'+{p} {f}-{t} {c}' for p, f, t, c in sorted(added, key=str)] +
+                              [f'-{p} {f}-{t} {c}' for p, f, t, c in sorted(removed, key=str)]))
+
+  # instances, one fleet launch per subnet and launch specification
+  fleets = {}
+  for instance in desired.get('instances', []):
+    record = inventory.find('instance', instance['name'], states=['running', 'pending'])
+    if record:
+      exists('instance', instance['name'], record['InstanceId'])
+      continue
+    spec = tuple(instance[field] for field in ('subnet', 'security_group', 'ami', 'instance_type', 'key_pair',
+                                               'userdata', 'public'))
+    fallback = instance.get('fallback')
+    if fallback:
+      # ranked: the instance's own type and subnet first
+      fallback = (tuple(unique([instance['instance_type']] + list(fallback.get('instance_types', ())))),
+                  tuple(unique([instance['subnet']] + list(fallback.get('subnets', ())))),
+                  tuple(fallback.get('markets', ('on-demand',))),
+                  fallback.get('parallel', FALLBACK_PARALLEL))
+    fleets.setdefault(spec + (fallback,), []).append(instance['name'])
+  for (subnet_name, sg_name, ami, instance_type, key_pair, userdata, public, fallback), names in fleets.items():
+    def launch(subnet_name=subnet_name, sg_name=sg_name, ami=ami, instance_type=instance_type, key_pair=key_pair,
+               userdata=userdata, public=public, fallback=fallback, names=names):
+      if fallback:
+        instance_types, subnet_names, markets, parallel = fallback
+        instances = launch_capacity(ami, candidates(instance_types, [ids[('subnet', name)] for name in subnet_names],
+                                                    markets),
+                                    ids[('security_group', sg_name)], names, key_pair, userdata, public,
+                                    parallel=parallel, client=client)
+      else:
+        instances = setup_instances(ami, [ids[('subnet', subnet_name)]], ids[('security_group', sg_name)], names,
+                                    key_pair, userdata, instance_type, public, client=client)
+      for instance in instances:
+        ids[('instance', tag_value(instance.data, 'Name'))] = instance.id
+      return instances
+    detail = instance_type if len(names) == 1 else f'{len(names)} x {instance_type}'
+    if fallback:
+      detail += f', or any of {len(candidates(*fallback[:3])) - 1} fallbacks, {fallback[3]} at a time'
+    change('create', 'instance', names[0] if len(names) == 1 else f'{names[0]}..{names[-1]}', launch,
+           [created('subnet', name) for name in (fallback[1] if fallback else [subnet_name])] +
+           [created('security_group', sg_name)],
+           detail=detail)
+
+  return list(changes.values())
+
+def _run(c):
+  result = c.fn()
+  if c.action != 'create':
+    # the setup_* helpers log their own creates
+    log(f'{c.kind} {c.action}', c.name)
+  return result
+
+def apply(changes, max_workers=8, journal=None):
+  # with a journal (or a current one, see journal.py) every change runs as a
+  # journaled step with its own idempotency token
+  journal = journal or current_journal()
+  if journal is not None:
+    journal.planned()
+  dag = Dag()
+  for c in changes:
+    if journal is None:
+      dag.add(c.key, lambda r, c=c: _run(c), c.deps)
+    else:
+      dag.add(c.key, lambda r, c=c: journal.step(c.key, c.kind, c.name, lambda: _run(c)), c.deps)
+  if changes:
+    dag.run(max_workers=max_workers)
+  return dag
+
+def format_plan(changes):
+  if not changes:
+    return 'No changes. Infrastructure is up to date.'
+  return '\n'.join(str(c) for c in changes)
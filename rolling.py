@@ -0,0 +1,135 @@
+#----------------
+# rolling.py
+#-----------------
+# Rolling blue/green replacement of the instances behind a target group.
+#
+# rolling_replace() works through the old targets batch by batch. For every
+# batch it launches the replacements (one setup_instances() fleet launch),
+# registers them once they are running (ELBv2 rejects pending instances),
+# waits until the target group reports them healthy, and only then
+# deregisters the old batch. Draining and termination of the old
+# instances go on in the background while the next batch is launched, so a
+# fleet update takes about one launch-and-health-check time per batch
+# instead of N serial instance lifecycles.
+#
+# max_unavailable old targets may be taken out of service before their
+# replacements are healthy, which shortens every batch when there is no
+# room to run extra instances; with max_unavailable=0 capacity never drops.
+# If a batch never becomes healthy its replacements are terminated, the
+# old targets taken out early are registered again, and the error is raised.
+#
+#   launch = launcher(AMI, subnet_ids, security_group_id, key_pair_name, userdata, 'm5.large', True, 'WebV2-')
+#   rollout = rolling_replace(target_group_arn, launch, batch_size=4, max_unavailable=1)
+#   print(rollout.report())
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import get_client
+from waiters import waiter_service, target_health_id
+from inventory import forget
+from my_functions import (setup_instances, indexed_names, wait_running, register_targets, deregister_targets,
+                          wait_healthy_targets, log)
+
+def current_targets(target_group_arn, client=None):
+  # IDs of the targets of a group that are in service or on their way in
+  client = client or get_client('elbv2')
+  response = client.describe_target_health(TargetGroupArn=target_group_arn)
+  return [description['Target']['Id'] for description in response['TargetHealthDescriptions']
+          if description['TargetHealth']['State'] not in ('draining', 'unused')]
+
+def launcher(AMI, subnet_ids, security_group_id, key_pair_name, userdata, instance_type, bool_public, name_prefix,
+             client=None):
+  # launch(count, start) for rolling_replace: a setup_instances() fleet named
+  # name_prefix + index
+  def launch(count, start):
+    return setup_instances(AMI, subnet_ids, security_group_id, indexed_names(name_prefix, count, start=start),
+                           key_pair_name, userdata, instance_type, bool_public, client=client)
+  return launch
+
+class Rollout:
+  def __init__(self, target_group_arn):
+    self.target_group_arn = target_group_arn
+    self.batches = []
+    self.replaced = []
+    self.launched = []
+    self.terminated = []
+    self.start = time.monotonic()
+    self.end = None
+
+  def wait(self):
+    # until every old instance has been drained and terminated
+    for future in self.terminated:
+      future.result()
+    return self
+
+  def report(self):
+    lines = [f'{len(self.replaced)} instances replaced in {len(self.batches)} batches, '
+             f'{(self.end or time.monotonic()) - self.start:.1f}s']
+    for i, (old, new, seconds) in enumerate(self.batches):
+      lines.append(f'  batch {i + 1}: {", ".join(old)} -> {", ".join(new)} ({seconds:.1f}s)')
+    return '\n'.join(lines)
+
+def rolling_replace(target_group_arn, launch, old_instance_ids=None, batch_size=1, max_unavailable=0, port=80,
+                    health_timeout=900, drain_timeout=600, client=None, ec2_client=None):
+  client = client or get_client('elbv2')
+  ec2_client = ec2_client or get_client('ec2')
+  old_instance_ids = list(old_instance_ids if old_instance_ids is not None else current_targets(target_group_arn, client=client))
+  rollout = Rollout(target_group_arn)
+
+  def retire(instance_ids, deregister=True):
+    # deregister, wait for connection draining, then terminate without waiting
+    if deregister:
+      deregister_targets(target_group_arn, *instance_ids, port=port, client=client)
+    drained = [waiter_service().submit('target_health', target_health_id(target_group_arn, instance_id), 'unused',
+                                       client=client, timeout=drain_timeout)
+               for instance_id in instance_ids]
+    for future in drained:
+      try:
+        future.result()
+      except TimeoutError:
+        log('Target still draining, terminating anyway', target_group_arn)
+    ec2_client.terminate_instances(InstanceIds=list(instance_ids))
+    for instance_id in instance_ids:
+      forget('instance', instance_id, client=ec2_client)
+    log('Targets retired', ', '.join(instance_ids))
+    return [waiter_service().submit('instance', instance_id, 'terminated', client=ec2_client)
+            for instance_id in instance_ids]
+
+  with ThreadPoolExecutor(max_workers=4, thread_name_prefix='rolling-retire') as retirer:
+    retiring = []
+    for i in range(0, len(old_instance_ids), batch_size):
+      batch_start = time.monotonic()
+      old = old_instance_ids[i:i + batch_size]
+      early, late = old[:max_unavailable], old[max_unavailable:]
+      new = [instance.id for instance in launch(len(old), i + 1)]
+      # an idempotent launch whose names collide with the old instances'
+      # returns the old instances themselves; replacing them with themselves
+      # would take every target out of service
+      if not set(new).isdisjoint(old_instance_ids):
+        raise ValueError(f'replacement batch {i // batch_size + 1} contains old targets: '
+                         f'{", ".join(sorted(set(new) & set(old_instance_ids)))}')
+      rollout.launched += new
+      if early:
+        deregister_targets(target_group_arn, *early, port=port, client=client)
+      try:
+        wait_running(new, timeout=health_timeout, client=ec2_client)
+        register_targets(target_group_arn, *new, port=port, client=client)
+        wait_healthy_targets(target_group_arn, new, timeout=health_timeout, client=client)
+      except Exception:
+        # roll the batch back: the old targets stay in service
+        log('Replacement batch not healthy, rolling back', ', '.join(new))
+        if early:
+          wait_running(early, client=ec2_client)
+          register_targets(target_group_arn, *early, port=port, client=client)
+        retiring.append(retirer.submit(retire, new))
+        raise
+      if early:
+        retiring.append(retirer.submit(retire, early, deregister=False))
+      if late:
+        retiring.append(retirer.submit(retire, late))
+      rollout.replaced += old
+      rollout.batches.append((old, new, time.monotonic() - batch_start))
+      log('Batch replaced', f'{len(rollout.replaced)}/{len(old_instance_ids)}')
+    for future in retiring:
+      rollout.terminated += future.result()
+  rollout.end = time.monotonic()
+  return rollout
@@ -0,0 +1,241 @@
+#----------------
+# scheduler.py
+#-----------------
+# Throttling-aware scheduling of every AWS API call.
+#
+# aws_clients installs the scheduler on every client it creates, through
+# botocore's event system, so it sits underneath all my_functions helpers:
+#
+# * a token bucket per (scope, service, describe/mutate) caps the request
+#   rate,
+# * an adaptive concurrency limit per (scope, service) is halved when AWS
+#   answers with RequestLimitExceeded / Throttling and grows back slowly on
+#   success (additive increase, multiplicative decrease), and the bucket's
+#   refill rate backs off the same way,
+# * calls wait in a priority queue, so creates go first and teardown and
+#   waiter polling can not starve them.
+#
+# AWS throttles per account and region, so that is what a scope stands for:
+# aws_clients gives every client the scope (profile, role, region). A
+# fan-out over regions or accounts gets the full rate in each of them, and
+# throttling in one slows down only that one.
+import heapq
+import itertools
+import threading
+import time
+from functools import partial
+from contextlib import contextmanager
+
+CREATE = 0
+DESCRIBE = 1
+TEARDOWN = 2
+WAITER = 3
+
+THROTTLE_CODES = {
+  'RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'ThrottledException',
+  'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException', 'SlowDown',
+}
+
+# requests per second and burst, per (service, category)
+DEFAULT_RATES = {
+  ('ec2', 'describe'): (20.0, 100),
+  ('ec2', 'mutate'): (5.0, 50),
+  ('elbv2', 'describe'): (10.0, 40),
+  ('elbv2', 'mutate'): (5.0, 20),
+}
+FALLBACK_RATE = (5.0, 20)
+
+_TEARDOWN_PREFIXES = ('Delete', 'Terminate', 'Release', 'Detach', 'Disassociate', 'Deregister', 'Revoke')
+
+def category(operation):
+  if operation.startswith(('Describe', 'Get', 'List')):
+    return 'describe'
+  return 'mutate'
+
+def default_priority(operation):
+  if category(operation) == 'describe':
+    return DESCRIBE
+  if operation.startswith(_TEARDOWN_PREFIXES):
+    return TEARDOWN
+  return CREATE
+
+class TokenBucket:
+  def __init__(self, rate, burst):
+    self.max_rate = rate
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.last = time.monotonic()
+
+  def _refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def delay(self, now):
+    # seconds until a token is available, 0 if one is available now
+    self._refill(now)
+    if self.tokens >= 1:
+      return 0.0
+    return (1 - self.tokens) / self.rate
+
+  def take(self):
+    self.tokens -= 1
+
+class Scheduler:
+  def __init__(self, rates=None, max_concurrency=32, min_concurrency=1, min_rate=0.5):
+    self.rates = dict(DEFAULT_RATES)
+    self.rates.update(rates or {})
+    self.max_concurrency = max_concurrency
+    self.min_concurrency = min_concurrency
+    self.min_rate = min_rate
+    self.throttles = 0
+    self._buckets = {}
+    self._limits = {}
+    self._active = {}
+    self._last_decrease = {}
+    self._queue = []
+    self._seq = itertools.count()
+    self._cond = threading.Condition()
+
+  def _bucket(self, key):
+    bucket = self._buckets.get(key)
+    if bucket is None:
+      bucket = self._buckets[key] = TokenBucket(*self.rates.get(key[1:], FALLBACK_RATE))
+    return bucket
+
+  def _free(self, limit_key):
+    return self._active.get(limit_key, 0) < self._limits.setdefault(limit_key, float(self.max_concurrency))
+
+  def acquire(self, service, operation, priority=None, scope=None):
+    # key: (scope, service, category); its limit key (scope, service)
+    key = (scope, service, category(operation))
+    if priority is None:
+      priority = current_priority()
+    if priority is None:
+      priority = default_priority(operation)
+    entry = (priority, next(self._seq), key)
+    with self._cond:
+      heapq.heappush(self._queue, entry)
+      while True:
+        now = time.monotonic()
+        timeout = None
+        winner = None
+        # the first entry, in priority order, whose scope and service have a free slot
+        # and whose bucket has a token goes next
+        for candidate in sorted(self._queue):
+          if not self._free(candidate[2][:2]):
+            continue
+          delay = self._bucket(candidate[2]).delay(now)
+          if delay == 0:
+            winner = candidate
+            break
+          timeout = delay if timeout is None else min(timeout, delay)
+        if winner is entry:
+          self._queue.remove(entry)
+          heapq.heapify(self._queue)
+          self._bucket(key).take()
+          self._active[key[:2]] = self._active.get(key[:2], 0) + 1
+          self._cond.notify_all()
+          return key
+        if winner is not None:
+          self._cond.notify_all()
+        self._cond.wait(timeout)
+
+  def release(self, key, throttled=False):
+    limit_key = key[:2]
+    with self._cond:
+      self._active[limit_key] -= 1
+      if throttled:
+        self._throttled(key)
+      else:
+        limit = self._limits[limit_key]
+        self._limits[limit_key] = min(self.max_concurrency, limit + 1.0 / limit)
+        bucket = self._bucket(key)
+        bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * 0.05)
+      self._cond.notify_all()
+
+  def throttled(self, key):
+    with self._cond:
+      self._throttled(key)
+
+  def _throttled(self, key):
+    self.throttles += 1
+    limit_key = key[:2]
+    now = time.monotonic()
+    # one burst of throttling errors only backs off once
+    if now - self._last_decrease.get(key, 0) < 1.0:
+      return
+    self._last_decrease[key] = now
+    self._limits[limit_key] = max(self.min_concurrency, self._limits.get(limit_key, self.max_concurrency) / 2)
+    bucket = self._bucket(key)
+    bucket.rate = max(self.min_rate, bucket.rate / 2)
+    bucket.tokens = min(bucket.tokens, 0.0)
+
+  # botocore event handlers
+  def _before_call(self, scope, model, context, **kwargs):
+    context['scheduler_key'] = self.acquire(model.service_model.service_name, model.name, scope=scope)
+
+  def _after_call(self, parsed, context, **kwargs):
+    key = context.pop('scheduler_key', None)
+    if key is not None:
+      self.release(key, throttled=error_code(parsed) in THROTTLE_CODES)
+
+  def _after_call_error(self, context, **kwargs):
+    key = context.pop('scheduler_key', None)
+    if key is not None:
+      self.release(key)
+
+  def _needs_retry(self, response=None, request_dict=None, **kwargs):
+    # a throttled attempt that botocore is about to retry
+    if response is None or request_dict is None:
+      return None
+    key = request_dict.get('context', {}).get('scheduler_key')
+    if key is not None and error_code(response[1]) in THROTTLE_CODES:
+      self.throttled(key)
+    return None
+
+  def install(self, client, scope=None):
+    # scope: what the client's calls are limited with, its region by default
+    scope = scope if scope is not None else client.meta.region_name
+    events = client.meta.events
+    events.register('before-call', partial(self._before_call, scope), unique_id='scheduler-before-call')
+    events.register('after-call', self._after_call, unique_id='scheduler-after-call')
+    events.register('after-call-error', self._after_call_error, unique_id='scheduler-after-call-error')
+    events.register('needs-retry', self._needs_retry, unique_id='scheduler-needs-retry')
+    return client
+
+def error_code(parsed):
+  if not isinstance(parsed, dict):
+    return None
+  return parsed.get('Error', {}).get('Code')
+
+_local = threading.local()
+
+def current_priority():
+  return getattr(_local, 'priority', None)
+
+@contextmanager
+def priority(value):
+  # Run the calls made by this thread inside the block at the given priority.
+  previous = current_priority()
+  _local.priority = value
+  try:
+    yield
+  finally:
+    _local.priority = previous
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+  global _scheduler
+  if _scheduler is None:
+    with _scheduler_lock:
+      if _scheduler is None:
+        _scheduler = Scheduler()
+  return _scheduler
+
+def use_scheduler(scheduler):
+  global _scheduler
+  _scheduler = scheduler
+  return scheduler
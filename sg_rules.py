@@ -0,0 +1,89 @@
+#----------------
+# sg_rules.py
+#-----------------
+# Security group rule sets and their reconciliation.
+#
+# A rule is a normalized tuple (protocol, from port, to port, source), where
+# the source is an IPv4 CIDR, an IPv6 CIDR, a security group ID (sg-...) or
+# a prefix list ID (pl-...):
+#
+#   ('tcp', 22, 22, '0.0.0.0/0'), ('tcp', 443, 443, 'sg-0123456789abcdef0'), ('-1', None, None, '::/0')
+#
+# rules() turns IpPermissions into a set of rules, ip_permissions() turns a
+# set back into the fewest IpPermissions (one per protocol and port range).
+# reconcile_ingress() diffs the desired set against the group's current
+# rules and applies the difference with at most one authorize and one
+# revoke call, however many rules the group has.
+from aws_clients import get_client
+
+_PROTOCOLS = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6', 'all': '-1'}
+
+def rule(protocol, from_port, to_port, source):
+  protocol = _PROTOCOLS.get(str(protocol).lower(), str(protocol).lower())
+  if protocol == '-1':
+    from_port = to_port = None
+  return (protocol, from_port, to_port, source)
+
+def rules(ip_permissions):
+  # IpPermissions -> set of rules
+  result = set()
+  for permission in ip_permissions or []:
+    key = (permission['IpProtocol'], permission.get('FromPort'), permission.get('ToPort'))
+    for ip_range in permission.get('IpRanges', []):
+      result.add(rule(*key, ip_range['CidrIp']))
+    for ip_range in permission.get('Ipv6Ranges', []):
+      result.add(rule(*key, ip_range['CidrIpv6']))
+    for pair in permission.get('UserIdGroupPairs', []):
+      result.add(rule(*key, pair['GroupId']))
+    for prefix_list in permission.get('PrefixListIds', []):
+      result.add(rule(*key, prefix_list['PrefixListId']))
+  return result
+
+def ip_permissions(rule_set):
+  # set of rules -> IpPermissions, one permission per protocol and port range
+  permissions = {}
+  for protocol, from_port, to_port, source in sorted(rule(*r) for r in rule_set):
+    permission = permissions.get((protocol, from_port, to_port))
+    if permission is None:
+      permission = permissions[(protocol, from_port, to_port)] = {'IpProtocol': protocol}
+      if from_port is not None:
+        permission['FromPort'] = from_port
+        permission['ToPort'] = to_port
+    if source.startswith('sg-'):
+      permission.setdefault('UserIdGroupPairs', []).append({'GroupId': source})
+    elif source.startswith('pl-'):
+      permission.setdefault('PrefixListIds', []).append({'PrefixListId': source})
+    elif ':' in source:
+      permission.setdefault('Ipv6Ranges', []).append({'CidrIpv6': source})
+    else:
+      permission.setdefault('IpRanges', []).append({'CidrIp': source})
+  return list(permissions.values())
+
+def diff(desired, current):
+  # (rules to add, rules to remove)
+  desired = set(rule(*r) for r in desired)
+  current = set(rule(*r) for r in current)
+  return desired - current, current - desired
+
+def current_ingress(group_id, client=None):
+  client = client or get_client('ec2')
+  group = client.describe_security_groups(GroupIds=[group_id])['SecurityGroups'][0]
+  return group.get('IpPermissions', [])
+
+def reconcile_ingress(group_id, desired, current=None, revoke=True, client=None):
+  # Makes the group's ingress rules exactly the desired set (or a superset,
+  # with revoke=False). current is the group's IpPermissions when the caller
+  # already has them; otherwise they are described. Returns the new
+  # IpPermissions and the (added, removed) rules.
+  client = client or get_client('ec2')
+  if current is None:
+    current = current_ingress(group_id, client=client)
+  current_rules = rules(current)
+  added, removed = diff(desired, current_rules)
+  if not revoke:
+    removed = set()
+  if added:
+    client.authorize_security_group_ingress(GroupId=group_id, IpPermissions=ip_permissions(added))
+  if removed:
+    client.revoke_security_group_ingress(GroupId=group_id, IpPermissions=ip_permissions(removed))
+  return ip_permissions((current_rules | added) - removed), added, removed
@@ -0,0 +1,97 @@
+#----------------
+# subnet_layout.py
+#-----------------
+# Multi-AZ subnet layouts carved out of a VPC CIDR.
+#
+# layout() gives every (tier, AZ) pair a subnet of the tier's prefix length,
+# e.g. tiers={'public': 24, 'private': 20} over three AZs is six subnets.
+# CIDRs come from a buddy allocator: free blocks are kept in one heap per
+# prefix length and a request splits the smallest free block that fits, so
+# each allocation is O(log n) and hundreds of subnets lay out instantly
+# without overlaps. The layout is deterministic, and subnets that already
+# exist keep their CIDRs (existing=), so reruns give the same answer.
+#
+# setup_subnet_layout() creates the tiers' route tables and then all subnets
+# and their route table associations concurrently; every step is a no-op
+# for what already exists.
+import heapq
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import get_client
+from my_functions import setup_route_table, setup_subnet, log
+
+class CidrAllocator:
+  def __init__(self, cidr, reserved=()):
+    self.network = ipaddress.ip_network(cidr)
+    self.version = self.network.version
+    # prefix length -> heap of the free blocks' start addresses
+    self.free = {}
+    blocks = [self.network]
+    for cidr in sorted(ipaddress.ip_network(c) for c in reserved):
+      remaining = []
+      for block in blocks:
+        if block.overlaps(cidr):
+          if cidr.subnet_of(block) and cidr != block:
+            remaining.extend(block.address_exclude(cidr))
+        else:
+          remaining.append(block)
+      blocks = remaining
+    for block in blocks:
+      self._push(block.prefixlen, int(block.network_address))
+
+  def _push(self, prefixlen, address):
+    heapq.heappush(self.free.setdefault(prefixlen, []), address)
+
+  def allocate(self, prefixlen):
+    # the lowest free block of the smallest size that fits, split down
+    for size in range(prefixlen, self.network.prefixlen - 1, -1):
+      if self.free.get(size):
+        address = heapq.heappop(self.free[size])
+        break
+    else:
+      raise ValueError(f'no free /{prefixlen} left in {self.network}')
+    width = self.network.max_prefixlen
+    while size < prefixlen:
+      size += 1
+      # keep the upper half free, carry on splitting the lower half
+      self._push(size, address + (1 << (width - size)))
+    return ipaddress.ip_network((address, prefixlen))
+
+def az_suffix(az):
+  return az[-1].upper() if az[-1].isalpha() else az.rsplit('-', 1)[-1]
+
+def subnet_name(prefix, tier, az):
+  return f'{prefix}{tier.capitalize()}{az_suffix(az)}'
+
+def layout(vpc_cidr, azs, tiers, prefix='', existing=None, reserved=()):
+  # [{'name', 'cidr', 'az', 'tier'}] for every tier in every AZ. existing
+  # maps the names of subnets that already exist to their CIDRs, reserved
+  # lists other CIDRs in the VPC to stay clear of.
+  existing = existing or {}
+  allocator = CidrAllocator(vpc_cidr, reserved=list(existing.values()) + list(reserved))
+  wanted = [(tiers[tier], tier_index, az_index, tier, az)
+            for tier_index, tier in enumerate(tiers) for az_index, az in enumerate(azs)]
+  subnets = {}
+  # largest blocks first, so smaller ones never fragment the space they need
+  for prefixlen, tier_index, az_index, tier, az in sorted(wanted):
+    name = subnet_name(prefix, tier, az)
+    cidr = existing.get(name) or str(allocator.allocate(prefixlen))
+    subnets[(tier_index, az_index)] = {'name': name, 'cidr': cidr, 'az': az, 'tier': tier}
+  return [subnets[key] for key in sorted(subnets)]
+
+def setup_subnet_layout(vpc, subnets, route_table_names, gateway_ids=None, max_workers=16, client=None):
+  # Creates one route table per tier (route_table_names maps tier -> name,
+  # gateway_ids tier -> the gateway of its default route, if any), then every
+  # subnet of the layout, associated with its tier's route table. Returns
+  # {subnet name: subnet}.
+  client = client or get_client('ec2')
+  gateway_ids = gateway_ids or {}
+  tiers = sorted(set(subnet['tier'] for subnet in subnets))
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    route_tables = dict(zip(tiers, pool.map(
+      lambda tier: setup_route_table(route_table_names[tier], vpc, gateway_ids.get(tier), client=client), tiers)))
+    created = list(pool.map(
+      lambda subnet: setup_subnet(subnet['name'], subnet['cidr'], subnet['az'], vpc, route_tables[subnet['tier']],
+                                  client=client), subnets))
+  log('Subnet layout', f'{len(subnets)} subnets in {len(set(subnet["az"] for subnet in subnets))} AZs')
+  return dict((subnet['name'], handle) for subnet, handle in zip(subnets, created))
@@ -0,0 +1,257 @@
+#----------------
+# sweeper.py
+#-----------------
+# Sweeps orphaned and expired resources out of every region.
+#
+# What may go is decided by the auto-delete tag the helpers put on what they
+# create:
+#
+#   auto-delete: no                      never swept
+#   auto-delete: yes                     swept once orphaned
+#   auto-delete: 2026-11-01T00:00:00Z    swept once orphaned, or once expired
+#
+# Resources without the tag were not made by these helpers and are left
+# alone, unless untagged orphans are asked for. Orphaned means: a detached
+# volume (instances keep their data volume after termination), an elastic
+# IP associated with nothing, a NAT gateway no route table routes to, an
+# internet gateway attached to no VPC, a VPC without network interfaces
+# (no instance, load balancer, NAT gateway, endpoint, Lambda function or
+# database in it) that is older than min_age by its created-at tag. An empty
+# or expired VPC is torn down with everything in it (teardown.plan_teardown);
+# an expired instance or NAT gateway is deleted even while in use.
+#
+# Every region is planned from one inventory sweep (inventory.py) and the
+# regions run in parallel (fanout.py). Within a region the deletions run
+# concurrently in dependency order, as teardowns do, at no more than rate
+# deletions per second. Without --execute nothing is deleted and only the
+# report is printed.
+#
+#   python sweeper.py                                    # dry run, all regions
+#   python sweeper.py --region us-west-2 --execute --rate 2
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from aws_clients import get_client
+from describe import tag_value, record_name
+from inventory import Inventory
+from scheduler import TokenBucket
+from teardown import Teardown, plan_teardown, _terminate_instance, _delete_nat_gateway, _release_address
+from fanout import Target, run_targets, report
+
+AUTO_DELETE = 'auto-delete'
+CREATED_AT = 'created-at'
+
+# an empty VPC younger than this may still be provisioning, or waiting for a
+# rerun after a failed launch
+MIN_AGE = timedelta(hours=2)
+
+SWEEP_KINDS = ['vpc', 'instance', 'volume', 'elastic_ip', 'nat_gateway', 'internet_gateway', 'route_table',
+               'load_balancer', 'network_interface']
+
+def expires_at(value):
+  # the expiry time of an auto-delete tag value, None if it is not a time
+  try:
+    expires = datetime.fromisoformat(value.replace('Z', '+00:00'))
+  except ValueError:
+    return None
+  if expires.tzinfo is None:
+    expires = expires.replace(tzinfo=timezone.utc)
+  return expires
+
+def sweep_reason(record, orphaned, now, untagged=False):
+  # 'expired', 'orphaned' or None (keep), by the record's auto-delete tag
+  value = tag_value(record, AUTO_DELETE)
+  if value is None:
+    return 'orphaned' if orphaned and untagged else None
+  if value.lower() == 'no':
+    return None
+  expires = expires_at(value)
+  if expires is not None and expires <= now:
+    return 'expired'
+  return 'orphaned' if orphaned else None
+
+class RateLimit:
+  # a token bucket shared by the threads of one sweep
+  def __init__(self, rate):
+    self.bucket = TokenBucket(rate, 1)
+    self._lock = threading.Lock()
+
+  def wait(self):
+    while True:
+      with self._lock:
+        delay = self.bucket.delay(time.monotonic())
+        if delay == 0:
+          self.bucket.take()
+          return
+      time.sleep(delay)
+
+def _delete_volume(client, volume_id):
+  client.delete_volume(VolumeId=volume_id)
+
+def _delete_detached_internet_gateway(client, internet_gateway_id):
+  client.delete_internet_gateway(InternetGatewayId=internet_gateway_id)
+
+class Sweep(Teardown):
+  def __init__(self, region=None):
+    Teardown.__init__(self, None)
+    self.region = region
+    # (kind, id, name, reason) of everything the sweep deletes on its own
+    # account; what goes with a VPC is in nodes only
+    self.found = []
+
+  def sweep(self, kind, id, name, reason, fn, deps=()):
+    self.found.append((kind, id, name, reason))
+    return self.add(kind, id, name, fn, deps)
+
+  def run(self, rate=None, max_workers=16, **kwargs):
+    if rate:
+      limit = RateLimit(rate)
+      for node in self.nodes.values():
+        node.fn = lambda fn=node.fn: (limit.wait(), fn())
+    return Teardown.run(self, max_workers=max_workers, **kwargs)
+
+  def report(self):
+    lines = [f'{self.region or "default region"}: {len(self.found)} to sweep, {len(self.nodes)} deletions']
+    for kind, id, name, reason in self.found:
+      lines.append(f'  {kind:<18}\t{name or id:<30}\t{reason}')
+    if any(node.timing for node in self.nodes.values()):
+      lines.append(Teardown.report(self))
+    return '\n'.join(lines)
+
+def young(record, now, min_age):
+  # created less than min_age ago by the record's created-at tag; a record
+  # without the tag is as old as can be
+  created = expires_at(tag_value(record, CREATED_AT) or '')
+  return created is not None and now - created < min_age
+
+def plan_sweep(region=None, untagged=False, now=None, min_age=MIN_AGE, client=None, elbv2_client=None):
+  client = client or get_client('ec2')
+  elbv2_client = elbv2_client or get_client('elbv2')
+  now = now or datetime.now(timezone.utc)
+  inventory = Inventory().load(kinds=SWEEP_KINDS, clients={'ec2': client, 'elbv2': elbv2_client})
+  sweep = Sweep(region)
+
+  instances = [record for record in inventory.records('instance')
+               if record['State']['Name'] not in ('shutting-down', 'terminated')]
+  # whatever runs in a VPC has a network interface there; load balancers are
+  # counted on their own while their interfaces come and go
+  used_vpcs = (set(record.get('VpcId') for record in inventory.records('network_interface')) |
+               set(record.get('VpcId') for record in inventory.records('load_balancer')))
+
+  # empty or expired VPCs, with everything in them
+  for vpc in inventory.records('vpc'):
+    if vpc.get('IsDefault'):
+      continue
+    vpc_id = vpc['VpcId']
+    orphaned = vpc_id not in used_vpcs and not young(vpc, now, min_age)
+    reason = sweep_reason(vpc, orphaned, now, untagged)
+    if reason is None:
+      continue
+    sweep.found.append(('vpc', vpc_id, record_name('vpc', vpc), reason))
+    for key, node in plan_teardown(vpc_id, client=client, elbv2_client=elbv2_client).nodes.items():
+      sweep.nodes.setdefault(key, node)
+
+  for instance in instances:
+    instance_id = instance['InstanceId']
+    reason = sweep_reason(instance, False, now)
+    if reason and ('instance', instance_id) not in sweep.nodes:
+      sweep.sweep('instance', instance_id, record_name('instance', instance), reason,
+                  lambda i=instance_id: _terminate_instance(client, i))
+
+  # NAT gateways no route points at, and the elastic IPs they hold
+  routed = set(route.get('NatGatewayId') for route_table in inventory.records('route_table')
+               for route in route_table.get('Routes', []))
+  for nat in inventory.records('nat_gateway'):
+    nat_id = nat['NatGatewayId']
+    if nat['State'] != 'available' or ('nat_gateway', nat_id) in sweep.nodes:
+      continue
+    reason = sweep_reason(nat, nat_id not in routed, now, untagged)
+    if reason is None:
+      continue
+    key = sweep.sweep('nat_gateway', nat_id, record_name('nat_gateway', nat), reason,
+                      lambda n=nat_id: _delete_nat_gateway(client, n))
+    for address in nat.get('NatGatewayAddresses', []):
+      record = inventory.get(address.get('AllocationId'))
+      if record is not None and sweep_reason(record, True, now, untagged):
+        sweep.sweep('elastic_ip', record['AllocationId'], record_name('elastic_ip', record), reason,
+                    lambda a=record['AllocationId']: _release_address(client, a), [key])
+
+  # only what is detached: anything in use goes with its VPC or not at all
+  for address in inventory.records('elastic_ip'):
+    allocation_id = address.get('AllocationId')
+    if not allocation_id or address.get('AssociationId') or address.get('NetworkInterfaceId'):
+      continue
+    reason = sweep_reason(address, True, now, untagged)
+    if reason and ('elastic_ip', allocation_id) not in sweep.nodes:
+      sweep.sweep('elastic_ip', allocation_id, record_name('elastic_ip', address), reason,
+                  lambda a=allocation_id: _release_address(client, a))
+
+  for volume in inventory.records('volume'):
+    volume_id = volume['VolumeId']
+    if volume['State'] != 'available':
+      continue
+    reason = sweep_reason(volume, True, now, untagged)
+    if reason:
+      sweep.sweep('volume', volume_id, record_name('volume', volume), reason,
+                  lambda v=volume_id: _delete_volume(client, v))
+
+  for igw in inventory.records('internet_gateway'):
+    igw_id = igw['InternetGatewayId']
+    if igw.get('Attachments') or ('internet_gateway', igw_id) in sweep.nodes:
+      continue
+    reason = sweep_reason(igw, True, now, untagged)
+    if reason:
+      sweep.sweep('internet_gateway', igw_id, record_name('internet_gateway', igw), reason,
+                  lambda i=igw_id: _delete_detached_internet_gateway(client, i))
+  return sweep
+
+def sweep_target(target):
+  # fanout.run_targets() function: plans the target's region and, unless
+  # params['dry_run'], runs the sweep
+  params = target.params
+  sweep = plan_sweep(target.region, untagged=params.get('untagged', False), min_age=params.get('min_age', MIN_AGE),
+                     client=target.client('ec2'), elbv2_client=target.client('elbv2'))
+  if not params.get('dry_run', True):
+    sweep.run(rate=params.get('rate'), max_workers=params.get('max_workers', 16))
+  return sweep
+
+def all_regions(client=None):
+  # the regions enabled for the account
+  client = client or get_client('ec2')
+  return sorted(region['RegionName'] for region in client.describe_regions()['Regions'])
+
+def sweep_regions(regions=None, role=None, profile=None, dry_run=True, untagged=False, rate=None, min_age=MIN_AGE,
+                  max_workers=8):
+  # One sweep per region, the regions in parallel. Returns fanout
+  # TargetResults whose results are the Sweeps.
+  regions = regions or all_regions(get_client('ec2', profile=profile, role=role))
+  params = {'dry_run': dry_run, 'untagged': untagged, 'rate': rate, 'min_age': min_age}
+  targets = [Target(region, role=role, params=params, profile=profile) for region in regions]
+  return run_targets(targets, sweep_target, max_workers=max_workers)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Delete orphaned and expired resources in every region')
+  parser.add_argument('--region', action='append', help='region to sweep (repeatable), all regions by default')
+  parser.add_argument('--role', help='IAM role to assume')
+  parser.add_argument('--profile', help='AWS profile')
+  parser.add_argument('--execute', action='store_true', help='delete; without it only the report is printed')
+  parser.add_argument('--untagged', action='store_true', help='also sweep orphans without an auto-delete tag')
+  parser.add_argument('--rate', type=float, help='deletions per second per region')
+  parser.add_argument('--min-age', type=float, default=MIN_AGE.total_seconds() / 3600,
+                      help='hours an empty VPC is left alone after it was created')
+  parser.add_argument('--max-workers', type=int, default=8, help='regions in flight at once')
+  args = parser.parse_args(argv)
+
+  results = sweep_regions(args.region, role=args.role, profile=args.profile, dry_run=not args.execute,
+                          untagged=args.untagged, rate=args.rate, min_age=timedelta(hours=args.min_age),
+                          max_workers=args.max_workers)
+  for result in results:
+    if result.ok:
+      print(result.result.report())
+  print(report(results))
+  return 0 if all(result.ok for result in results) else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,277 @@
+#----------------
+# teardown.py
+#-----------------
+# Concurrent teardown of everything that hangs off a VPC.
+#
+# plan_teardown() discovers the resources in a VPC and records, for each one,
+# which other deletions have to finish before it can go (instances before
+# their subnet and security groups, NAT gateways before the internet gateway,
+# everything before the VPC, ...). Teardown.run() then deletes independent
+# branches concurrently. A deletion that still fails with DependencyViolation
+# is parked and only retried after another deletion has finished.
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+from waiters import wait_for
+from scheduler import priority, TEARDOWN
+from describe import (iter_instances, iter_load_balancers, iter_target_groups, iter_nat_gateways,
+                      iter_internet_gateways, iter_route_tables, iter_subnets, iter_security_groups, tag_value)
+from my_functions import log, get_vpc_id, wait_deleted_nat_gateway
+
+class Node:
+  __slots__ = ('kind', 'id', 'name', 'fn', 'deps', 'attempts', 'timing')
+
+  def __init__(self, kind, id, name, fn):
+    self.kind = kind
+    self.id = id
+    self.name = name
+    self.fn = fn
+    self.deps = set()
+    self.attempts = 0
+    self.timing = None
+
+  @property
+  def key(self):
+    return (self.kind, self.id)
+
+def _tag_name(tags):
+  return tag_value({'Tags': tags}, 'Name')
+
+def _error_code(e):
+  return e.response.get('Error', {}).get('Code')
+
+# Delete functions by ID. The lookup by Name tag is done once by the planner.
+def _terminate_instance(client, instance_id):
+  client.terminate_instances(InstanceIds=[instance_id])
+  wait_for('instance', instance_id, 'terminated', client=client)
+
+def _delete_load_balancer(client, load_balancer_arn):
+  client.delete_load_balancer(LoadBalancerArn=load_balancer_arn)
+  wait_for('load_balancer', load_balancer_arn, 'deleted', client=client)
+
+def _delete_target_group(client, target_group_arn):
+  client.delete_target_group(TargetGroupArn=target_group_arn)
+
+def _delete_nat_gateway(client, nat_gateway_id):
+  client.delete_nat_gateway(NatGatewayId=nat_gateway_id)
+  wait_deleted_nat_gateway(nat_gateway_id, client=client)
+
+def _release_address(client, allocation_id):
+  client.release_address(AllocationId=allocation_id)
+
+def _delete_internet_gateway(client, internet_gateway_id, vpc_id):
+  try:
+    client.detach_internet_gateway(InternetGatewayId=internet_gateway_id, VpcId=vpc_id)
+  except ClientError as e:
+    if _error_code(e) != 'Gateway.NotAttached':
+      raise
+  client.delete_internet_gateway(InternetGatewayId=internet_gateway_id)
+
+def _delete_route_table(client, route_table):
+  for association in route_table.get('Associations', []):
+    try:
+      client.disassociate_route_table(AssociationId=association['RouteTableAssociationId'])
+    except ClientError as e:
+      if _error_code(e) != 'InvalidAssociationID.NotFound':
+        raise
+  client.delete_route_table(RouteTableId=route_table['RouteTableId'])
+
+def _delete_subnet(client, subnet_id):
+  client.delete_subnet(SubnetId=subnet_id)
+
+def _delete_security_group(client, group_id):
+  client.delete_security_group(GroupId=group_id)
+
+def _delete_vpc(client, vpc_id):
+  client.delete_vpc(VpcId=vpc_id)
+
+class Teardown:
+  def __init__(self, vpc_id):
+    self.vpc_id = vpc_id
+    self.nodes = {}
+    self.wall_time = 0.0
+
+  def add(self, kind, id, name, fn, deps=()):
+    node = Node(kind, id, name, fn)
+    node.deps.update(deps)
+    self.nodes[node.key] = node
+    return node.key
+
+  def keys(self, kind):
+    return [key for key in self.nodes if key[0] == kind]
+
+  def run(self, max_workers=16, idle_retry_delay=5, max_attempts=20):
+    done = set()
+    pending = dict(self.nodes)
+    parked = {}
+    running = {}
+    error = None
+    lock = threading.Lock()
+    t0 = time.monotonic()
+
+    def call(node):
+      start = time.monotonic() - t0
+      node.attempts += 1
+      try:
+        with priority(TEARDOWN):
+          node.fn()
+      finally:
+        with lock:
+          node.timing = (start, time.monotonic() - t0)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+      while error is None and (pending or parked or running):
+        for key in [key for key, node in pending.items() if node.deps <= done]:
+          node = pending.pop(key)
+          running[pool.submit(call, node)] = node
+        if not running:
+          if not parked:
+            # dependencies on resources outside of the plan can never be met
+            missing = {key: node.deps - done for key, node in pending.items()}
+            raise RuntimeError(f'unsatisfiable teardown dependencies: {missing}')
+          # Nothing left that could unblock the parked deletions except
+          # resources AWS releases asynchronously (load balancer ENIs, ...).
+          time.sleep(idle_retry_delay)
+          pending.update(parked)
+          parked.clear()
+          continue
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        progressed = False
+        for future in finished:
+          node = running.pop(future)
+          try:
+            future.result()
+          except ClientError as e:
+            if _error_code(e) == 'DependencyViolation' and node.attempts < max_attempts:
+              parked[node.key] = node
+              continue
+            if error is None:
+              error = e
+            continue
+          except Exception as e:
+            if error is None:
+              error = e
+            continue
+          done.add(node.key)
+          progressed = True
+          log(f'{node.kind} deleted', node.name or node.id)
+        if progressed and parked:
+          pending.update(parked)
+          parked.clear()
+      # let anything still running finish before reporting the error
+      if error is not None:
+        wait(running)
+    self.wall_time = time.monotonic() - t0
+    if error is not None:
+      raise error
+    return done
+
+  def report(self):
+    lines = []
+    timed = [node for node in self.nodes.values() if node.timing]
+    for node in sorted(timed, key=lambda n: n.timing[0]):
+      start, end = node.timing
+      lines.append(f'{node.kind:<18}\t{node.name or node.id:<30}\t{start:8.2f}s\t{end:8.2f}s\tattempts={node.attempts}')
+    slowest = max((node.timing[1] - node.timing[0] for node in timed), default=0.0)
+    lines.append(f'wall time: {self.wall_time:.2f}s, slowest single deletion: {slowest:.2f}s')
+    return '\n'.join(lines)
+
+def plan_teardown(vpc_id, client=None, elbv2_client=None, release_addresses=True):
+  client = client or get_client('ec2')
+  elbv2_client = elbv2_client or get_client('elbv2')
+  vpc_filter = [{'Name': 'vpc-id', 'Values': [vpc_id]}]
+  plan = Teardown(vpc_id)
+
+  subnet_users = {}
+  group_users = {}
+  gateway_blockers = []
+
+  def uses(key, subnet_ids=(), group_ids=()):
+    for subnet_id in subnet_ids:
+      subnet_users.setdefault(subnet_id, []).append(key)
+    for group_id in group_ids:
+      group_users.setdefault(group_id, []).append(key)
+
+  # instances
+  for instance in iter_instances(vpc_filter + [
+      {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped', 'shutting-down']}], client):
+    instance_id = instance['InstanceId']
+    key = plan.add('instance', instance_id, _tag_name(instance.get('Tags')),
+                   lambda i=instance_id: _terminate_instance(client, i))
+    groups = [group['GroupId'] for group in instance.get('SecurityGroups', [])]
+    uses(key, [instance['SubnetId']], groups)
+    gateway_blockers.append(key)
+
+  # load balancers and their target groups
+  load_balancers = [lb for lb in iter_load_balancers(elbv2_client)
+                    if lb.get('VpcId') == vpc_id]
+  for lb in load_balancers:
+    arn = lb['LoadBalancerArn']
+    key = plan.add('load_balancer', arn, lb['LoadBalancerName'],
+                   lambda a=arn: _delete_load_balancer(elbv2_client, a))
+    uses(key, [az['SubnetId'] for az in lb.get('AvailabilityZones', [])], lb.get('SecurityGroups', []))
+    gateway_blockers.append(key)
+  for tg in iter_target_groups(elbv2_client):
+    if tg.get('VpcId') != vpc_id:
+      continue
+    arn = tg['TargetGroupArn']
+    deps = [('load_balancer', lb_arn) for lb_arn in tg.get('LoadBalancerArns', [])
+            if ('load_balancer', lb_arn) in plan.nodes]
+    plan.add('target_group', arn, tg['TargetGroupName'],
+             lambda a=arn: _delete_target_group(elbv2_client, a), deps)
+
+  # NAT gateways and the elastic IPs they hold
+  for nat in iter_nat_gateways(vpc_filter + [
+      {'Name': 'state', 'Values': ['pending', 'available']}], client):
+    nat_id = nat['NatGatewayId']
+    key = plan.add('nat_gateway', nat_id, _tag_name(nat.get('Tags')),
+                   lambda n=nat_id: _delete_nat_gateway(client, n))
+    uses(key, [nat['SubnetId']])
+    gateway_blockers.append(key)
+    if release_addresses:
+      for address in nat.get('NatGatewayAddresses', []):
+        if address.get('AllocationId'):
+          plan.add('elastic_ip', address['AllocationId'], None,
+                   lambda a=address['AllocationId']: _release_address(client, a), [key])
+
+  # internet gateways can only be detached once no public address is mapped
+  for igw in iter_internet_gateways([
+      {'Name': 'attachment.vpc-id', 'Values': [vpc_id]}], client):
+    igw_id = igw['InternetGatewayId']
+    plan.add('internet_gateway', igw_id, _tag_name(igw.get('Tags')),
+             lambda i=igw_id: _delete_internet_gateway(client, i, vpc_id), gateway_blockers)
+
+  # route tables (the main route table goes with the VPC)
+  for route_table in iter_route_tables(vpc_filter, client):
+    if any(association.get('Main') for association in route_table.get('Associations', [])):
+      continue
+    plan.add('route_table', route_table['RouteTableId'], _tag_name(route_table.get('Tags')),
+             lambda r=route_table: _delete_route_table(client, r))
+
+  for subnet in iter_subnets(vpc_filter, client):
+    subnet_id = subnet['SubnetId']
+    plan.add('subnet', subnet_id, _tag_name(subnet.get('Tags')),
+             lambda s=subnet_id: _delete_subnet(client, s), subnet_users.get(subnet_id, []))
+
+  # the default security group goes with the VPC
+  for group in iter_security_groups(vpc_filter, client):
+    if group['GroupName'] == 'default':
+      continue
+    group_id = group['GroupId']
+    plan.add('security_group', group_id, _tag_name(group.get('Tags')) or group['GroupName'],
+             lambda g=group_id: _delete_security_group(client, g), group_users.get(group_id, []))
+
+  plan.add('vpc', vpc_id, None, lambda: _delete_vpc(client, vpc_id), list(plan.nodes))
+  return plan
+
+def teardown_vpc(vpc_name, max_workers=16, release_addresses=True, client=None, elbv2_client=None):
+  vpc_id = get_vpc_id(vpc_name, client=client)
+  if vpc_id == '0':
+    log('VPC Not Found', vpc_name)
+    return None
+  plan = plan_teardown(vpc_id, client=client, elbv2_client=elbv2_client, release_addresses=release_addresses)
+  plan.nodes[('vpc', vpc_id)].name = vpc_name
+  plan.run(max_workers=max_workers)
+  return plan
@@ -0,0 +1,117 @@
+#----------------
+# templates.py
+#-----------------
+# EC2 launch templates keyed by a hash of their content.
+#
+# launch_template(data) returns the (template ID, version) holding exactly
+# that LaunchTemplateData. Every distinct content is one version of the
+# named template, with the content hash as its version description, so the
+# same launch configuration always maps to the same version, and comparing
+# the desired launch configuration with the one an instance was launched
+# from is a version compare (see instance_template). Lookups are cached per
+# process, per account and region; a new configuration costs one
+# CreateLaunchTemplateVersion. A template deleted behind the cache's back
+# is dropped from it with forget_template() and created again on the next
+# lookup (my_functions.run_instances does this when RunInstances reports it
+# missing).
+import json
+import hashlib
+import threading
+from botocore.exceptions import ClientError
+from aws_clients import get_client, account_id
+
+DEFAULT_NAME = 'my-functions'
+
+# RunInstances errors for a launch template or version that no longer exists
+TEMPLATE_NOT_FOUND = {
+  'InvalidLaunchTemplateId.NotFound', 'InvalidLaunchTemplateId.VersionNotFound',
+  'InvalidLaunchTemplateName.NotFoundException',
+}
+
+_versions = {}
+_lock = threading.Lock()
+_key_locks = {}
+
+def content_hash(data):
+  text = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+def _template_id(name, client):
+  try:
+    templates = client.describe_launch_templates(LaunchTemplateNames=[name])['LaunchTemplates']
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.NotFoundException':
+      raise
+    return None
+  return templates[0]['LaunchTemplateId'] if templates else None
+
+def _find_version(template_id, digest, client):
+  paginator = client.get_paginator('describe_launch_template_versions')
+  for page in paginator.paginate(LaunchTemplateId=template_id):
+    for version in page['LaunchTemplateVersions']:
+      if version.get('VersionDescription') == digest:
+        return version['VersionNumber']
+  return None
+
+def _create(name, data, digest, client):
+  template_id = _template_id(name, client)
+  if template_id is not None:
+    version = _find_version(template_id, digest, client)
+    if version is not None:
+      return template_id, version
+    response = client.create_launch_template_version(
+      LaunchTemplateId=template_id, VersionDescription=digest, LaunchTemplateData=data)
+    return template_id, response['LaunchTemplateVersion']['VersionNumber']
+  try:
+    response = client.create_launch_template(
+      LaunchTemplateName=name,
+      VersionDescription=digest,
+      LaunchTemplateData=data,
+      TagSpecifications=[{'ResourceType': 'launch-template', 'Tags': [{'Key': 'Name', 'Value': name}]}])
+  except ClientError as e:
+    # created by another process in the meantime
+    if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.AlreadyExistsException':
+      raise
+    return _create(name, data, digest, client)
+  return response['LaunchTemplate']['LaunchTemplateId'], response['LaunchTemplate']['LatestVersionNumber']
+
+def launch_template(data, name=DEFAULT_NAME, client=None):
+  client = client or get_client('ec2')
+  digest = content_hash(data)
+  key = (name, digest, account_id(client), client.meta.region_name)
+  with _lock:
+    if key in _versions:
+      return _versions[key]
+    key_lock = _key_locks.setdefault(key, threading.Lock())
+  # one thread creates a given version, the others wait for it
+  with key_lock:
+    with _lock:
+      if key in _versions:
+        return _versions[key]
+    result = _create(name, data, digest, client)
+    with _lock:
+      _versions[key] = result
+  return result
+
+def forget_template(template_id):
+  with _lock:
+    for key in [key for key, (cached_id, version) in _versions.items() if cached_id == template_id]:
+      del _versions[key]
+
+def reset_templates():
+  # forget every cached template, e.g. when the account behind the clients
+  # is replaced (bench.py resets its stand-in between scenarios)
+  with _lock:
+    _versions.clear()
+
+def instance_template(record):
+  # (template ID, version) an instance was launched from, or None
+  template_id = version = None
+  for tag in record.get('Tags') or []:
+    if tag['Key'] == 'aws:ec2launchtemplate:id':
+      template_id = tag['Value']
+    elif tag['Key'] == 'aws:ec2launchtemplate:version':
+      version = int(tag['Value'])
+  if template_id is None:
+    return None
+  return template_id, version
@@ -0,0 +1,102 @@
+#----------------
+# test_capacity.py
+#-----------------
+# capacity.launch_capacity() against moto, with RunInstances failing with
+# InsufficientInstanceCapacity (HTTP 500, which botocore retries) in the
+# first candidate's subnet, and a hedged launch that has an extra instance to
+# terminate.
+#
+#   python -m pytest test_capacity.py
+import os
+import pytest
+from botocore.awsrequest import AWSResponse
+
+moto = pytest.importorskip('moto')
+
+import aws_clients
+import id_cache
+import inventory
+import templates
+from capacity import candidates, launch_capacity
+
+REGION = 'us-west-2'
+
+_CAPACITY_ERROR = (b'<Response><Errors><Error><Code>InsufficientInstanceCapacity</Code>'
+                   b'<Message>We currently do not have sufficient capacity</Message></Error></Errors>'
+                   b'<RequestID>test</RequestID></Response>')
+
+class _Raw:
+  def __init__(self, body):
+    self.body = body
+
+  def stream(self, **kwargs):
+    yield self.body
+
+class ShortSubnets:
+  # client hook: RunInstances in the short subnets fails for lack of capacity
+  def __init__(self):
+    self.short = set()
+    self.attempts = {}
+
+  def _before_send(self, request, **kwargs):
+    body = request.body.decode('utf-8') if isinstance(request.body, bytes) else str(request.body)
+    for subnet_id in self.short | set(self.attempts):
+      if f'SubnetId={subnet_id}' in body:
+        self.attempts[subnet_id] = self.attempts.get(subnet_id, 0) + 1
+        if subnet_id in self.short:
+          return AWSResponse(request.url, 500, {}, _Raw(_CAPACITY_ERROR))
+    return None
+
+  def __call__(self, client):
+    client.meta.events.register('before-send.ec2.RunInstances', self._before_send)
+
+@pytest.fixture
+def ec2():
+  for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+    os.environ[name] = 'testing'
+  hook = ShortSubnets()
+  with moto.mock_aws():
+    aws_clients.configure(region=REGION, profile=None, client_hooks=(hook,))
+    inventory.use_inventory(None)
+    id_cache.use_cache(None)
+    templates.reset_templates()
+    yield aws_clients.get_client('ec2'), hook
+    templates.reset_templates()
+    aws_clients.configure(client_hooks=())
+
+def test_one_attempt_per_candidate(ec2):
+  client, hook = ec2
+  vpc_id = client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+  subnet_a, subnet_b = [client.create_subnet(VpcId=vpc_id, CidrBlock=f'10.0.{i}.0/24',
+                                             AvailabilityZone=f'{REGION}{az}')['Subnet']['SubnetId']
+                        for i, az in enumerate('ab')]
+  group_id = client.create_security_group(GroupName='capacity', Description='capacity', VpcId=vpc_id)['GroupId']
+  client.create_key_pair(KeyName='capacity')
+  ami = client.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+  hook.short.add(subnet_a)
+  hook.attempts[subnet_b] = 0
+
+  instances = launch_capacity(ami, candidates(['m5.large'], [subnet_a, subnet_b]), group_id, ['Worker1'],
+                              'capacity', '', True, client=client)
+
+  assert [instance.data['SubnetId'] for instance in instances] == [subnet_b]
+  # the short candidate is asked once, not once per botocore retry
+  assert hook.attempts == {subnet_a: 1, subnet_b: 1}
+
+def test_hedged_extra_leaves_no_volume(ec2):
+  client, hook = ec2
+  vpc_id = client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+  subnet_a, subnet_b = [client.create_subnet(VpcId=vpc_id, CidrBlock=f'10.0.{i}.0/24',
+                                             AvailabilityZone=f'{REGION}{az}')['Subnet']['SubnetId']
+                        for i, az in enumerate('ab')]
+  group_id = client.create_security_group(GroupName='capacity', Description='capacity', VpcId=vpc_id)['GroupId']
+  client.create_key_pair(KeyName='capacity')
+  ami = client.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+
+  instances = launch_capacity(ami, candidates(['m5.large'], [subnet_a, subnet_b]), group_id, ['Worker1'],
+                              'capacity', '', True, parallel=2, client=client)
+
+  assert len(instances) == 1
+  # both candidates launched; the extra instance took its data volume with it
+  volumes = client.describe_volumes(Filters=[{'Name': 'size', 'Values': ['30']}])['Volumes']
+  assert [volume['State'] for volume in volumes] == ['in-use']
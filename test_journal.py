@@ -0,0 +1,81 @@
+#----------------
+# test_journal.py
+#-----------------
+# Resuming launch_ec2.py style journaled runs against moto: a run that died
+# during apply() is finished without creating anything twice, and a run that
+# died before it was planned is started afresh from a snapshot.
+#
+#   python -m pytest test_journal.py
+import pytest
+
+pytest.importorskip('moto')
+
+import aws_clients
+import inventory
+from bench import StandIn, topology
+from journal import Journal, use_journal
+from plan import plan, apply, PLAN_KINDS
+
+class Crash(Exception):
+  pass
+
+def _crash(**kwargs):
+  raise Crash()
+
+def provision(path, desired):
+  # what launch_ec2.py does with its journal
+  journal = use_journal(Journal(path))
+  if journal.resuming:
+    inventory.use_inventory(journal.inventory(PLAN_KINDS))
+  else:
+    inventory.snapshot(kinds=PLAN_KINDS)
+  changes = plan(desired)
+  apply(changes)
+  journal.complete()
+  return journal, changes
+
+def counts(client):
+  return (len([vpc for vpc in client.describe_vpcs()['Vpcs'] if not vpc['IsDefault']]),
+          len(client.describe_internet_gateways()['InternetGateways']),
+          len([instance for reservation in client.describe_instances()['Reservations']
+               for instance in reservation['Instances']]))
+
+@pytest.fixture
+def stand_in():
+  with StandIn():
+    yield aws_clients.get_client('ec2')
+  use_journal(None)
+
+def test_resume_interrupted_apply(stand_in, tmp_path):
+  client = stand_in
+  path = str(tmp_path / 'launch.journal')
+  desired = topology()
+  client.meta.events.register('before-call.ec2.CreateSecurityGroup', _crash, unique_id='crash')
+  with pytest.raises(Crash):
+    provision(path, desired)
+  client.meta.events.unregister('before-call.ec2.CreateSecurityGroup', unique_id='crash')
+  # the crash also tore the journal's last write
+  with open(path, 'a') as f:
+    f.write('{"op": "do')
+
+  journal, changes = provision(path, desired)
+  assert journal.resuming
+  # the VPC and the internet gateway were done before the crash
+  assert sorted(change.key for change in changes) == ['create instance LinuxEnvWorker0',
+                                                      'create route_table LinuxEnvRTPublic',
+                                                      'create security_group LinuxEnvSg',
+                                                      'create subnet LinuxEnvPublic0']
+  assert counts(client) == (1, 1, 1)
+
+def test_restart_interrupted_snapshot(stand_in, tmp_path):
+  client = stand_in
+  path = str(tmp_path / 'launch.journal')
+  desired = topology()
+  provision(path, desired)
+  # the next run dies after its 'start' entry, before anything is planned
+  use_journal(Journal(path))
+
+  journal, changes = provision(path, desired)
+  assert not journal.resuming
+  assert changes == []
+  assert counts(client) == (1, 1, 1)
@@ -0,0 +1,229 @@
+#----------------
+# tracing.py
+#-----------------
+# API call tracing and latency histograms.
+#
+# aws_clients installs the tracer on every client it creates. Each API call
+# is recorded with its service, operation, start time, latency, number of
+# retries, whether it was throttled, the thread it ran on and the
+# my_functions helper that made it (for example setup_subnet), and logged at
+# DEBUG level, so logging_setup(logfile) captures it. Calls are counted per
+# operation and per helper for as long as the process runs; only the last
+# max_calls calls are kept whole, for the percentiles and the timeline, so a
+# long-running process (my_functions_async.py) does not grow without bound.
+# At the end of a run:
+#
+#   tracer = get_tracer()
+#   print(tracer.summary())                  # counts and p50/p95/p99 per operation
+#   tracer.export_chrome_trace('trace.json')  # open in Perfetto / chrome://tracing
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+from scheduler import THROTTLE_CODES, error_code
+
+logger = logging.getLogger('my_functions.api')
+
+_HELPER_PREFIXES = ('setup_', 'delete_', 'get_', 'create_', 'is_', 'register_', 'wait_')
+
+# modules whose functions count as helpers when walking the stack
+_HELPER_FILES = {'my_functions.py'}
+
+# calls kept whole; older ones only count
+MAX_CALLS = 10000
+
+class Call:
+  __slots__ = ('service', 'operation', 'helper', 'thread', 'start', 'end', 'retries', 'throttles', 'error')
+
+  @property
+  def latency(self):
+    return self.end - self.start
+
+class Totals:
+  __slots__ = ('calls', 'retries', 'throttles', 'latency')
+
+  def __init__(self):
+    self.calls = 0
+    self.retries = 0
+    self.throttles = 0
+    self.latency = 0.0
+
+  def add(self, call):
+    self.calls += 1
+    self.retries += call.retries
+    self.throttles += call.throttles
+    self.latency += call.latency
+
+def _calling_helper():
+  frame = sys._getframe(2)
+  fallback = None
+  while frame is not None:
+    code = frame.f_code
+    if os.path.basename(code.co_filename) in _HELPER_FILES and code.co_name.startswith(_HELPER_PREFIXES):
+      return code.co_name
+    if fallback is None and code.co_name.startswith(_HELPER_PREFIXES) and 'botocore' not in code.co_filename:
+      fallback = code.co_name
+    frame = frame.f_back
+  return fallback
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+  return values[index]
+
+class Tracer:
+  def __init__(self, max_calls=MAX_CALLS):
+    self.max_calls = max_calls
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.calls = deque(maxlen=self.max_calls)
+      self.operations = {}
+      self.helpers = {}
+      self.t0 = time.monotonic()
+      self.wall_t0 = time.time()
+
+  # botocore event handlers
+  def _before_call(self, model, context, **kwargs):
+    call = Call()
+    call.service = model.service_model.service_name
+    call.operation = model.name
+    call.helper = _calling_helper()
+    call.thread = threading.current_thread().name
+    call.retries = 0
+    call.throttles = 0
+    call.error = None
+    call.end = None
+    call.start = time.monotonic()
+    context['trace_call'] = call
+
+  def _needs_retry(self, response=None, attempts=None, request_dict=None, **kwargs):
+    if request_dict is None:
+      return None
+    call = request_dict.get('context', {}).get('trace_call')
+    if call is not None and attempts:
+      call.retries = attempts - 1
+      if response is not None and error_code(response[1]) in THROTTLE_CODES:
+        call.throttles += 1
+    return None
+
+  def _after_call(self, parsed, context, **kwargs):
+    self._finish(context, error_code(parsed))
+
+  def _after_call_error(self, exception, context, **kwargs):
+    self._finish(context, type(exception).__name__)
+
+  def _finish(self, context, error):
+    call = context.pop('trace_call', None)
+    if call is None:
+      return
+    call.end = time.monotonic()
+    call.error = error
+    with self._lock:
+      self.calls.append(call)
+      self.operations.setdefault(f'{call.service}.{call.operation}', Totals()).add(call)
+      self.helpers.setdefault(call.helper or '-', Totals()).add(call)
+    logger.debug('%s.%s helper=%s latency=%.3fs retries=%d throttles=%d error=%s', call.service, call.operation,
+                 call.helper, call.latency, call.retries, call.throttles, call.error)
+
+  def install(self, client):
+    events = client.meta.events
+    events.register('before-call', self._before_call, unique_id='tracer-before-call')
+    events.register('needs-retry', self._needs_retry, unique_id='tracer-needs-retry')
+    events.register('after-call', self._after_call, unique_id='tracer-after-call')
+    events.register('after-call-error', self._after_call_error, unique_id='tracer-after-call-error')
+    return client
+
+  def operation_totals(self):
+    # operation -> Totals of every call since the last reset
+    with self._lock:
+      return dict(self.operations)
+
+  def helper_totals(self):
+    with self._lock:
+      return dict(self.helpers)
+
+  def by_operation(self):
+    # operation -> the calls kept whole
+    operations = {}
+    with self._lock:
+      calls = list(self.calls)
+    for call in calls:
+      operations.setdefault(f'{call.service}.{call.operation}', []).append(call)
+    return operations
+
+  def by_helper(self):
+    helpers = {}
+    with self._lock:
+      calls = list(self.calls)
+    for call in calls:
+      helpers.setdefault(call.helper or '-', []).append(call)
+    return helpers
+
+  def summary(self):
+    # counts and API time of every call, percentiles of the calls kept whole
+    lines = [f'{"operation":<45}{"calls":>7}{"retries":>9}{"throttles":>11}{"p50":>10}{"p95":>10}{"p99":>10}']
+    operations = self.operation_totals()
+    kept = self.by_operation()
+    for name in sorted(operations, key=lambda n: -operations[n].latency):
+      totals = operations[name]
+      latencies = [call.latency for call in kept.get(name, [])]
+      lines.append(f'{name:<45}{totals.calls:>7}{totals.retries:>9}{totals.throttles:>11}'
+                   f'{percentile(latencies, 50):>9.3f}s{percentile(latencies, 95):>9.3f}s{percentile(latencies, 99):>9.3f}s')
+    lines.append('')
+    lines.append(f'{"helper":<45}{"calls":>7}{"api time":>12}')
+    helpers = self.helper_totals()
+    for name in sorted(helpers, key=lambda n: -helpers[n].calls):
+      totals = helpers[name]
+      lines.append(f'{name:<45}{totals.calls:>7}{totals.latency:>11.2f}s')
+    return '\n'.join(lines)
+
+  def chrome_trace(self):
+    # Trace Event Format, complete events ("X") with microsecond timestamps
+    with self._lock:
+      calls = list(self.calls)
+    threads = {}
+    events = []
+    for call in calls:
+      tid = threads.setdefault(call.thread, len(threads) + 1)
+      events.append({
+        'name': call.operation,
+        'cat': call.service,
+        'ph': 'X',
+        'ts': int((call.start - self.t0) * 1e6),
+        'dur': int(call.latency * 1e6),
+        'pid': 1,
+        'tid': tid,
+        'args': {
+          'helper': call.helper,
+          'retries': call.retries,
+          'throttles': call.throttles,
+          'error': call.error,
+        },
+      })
+    for name, tid in threads.items():
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'start': self.wall_t0}}
+
+  def export_chrome_trace(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.chrome_trace(), f)
+    return path
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer():
+  global _tracer
+  if _tracer is None:
+    with _tracer_lock:
+      if _tracer is None:
+        _tracer = Tracer()
+  return _tracer
@@ -0,0 +1,271 @@
+#----------------
+# waiters.py
+#-----------------
+# One polling loop for every resource that is waiting on a state change.
+#
+# Callers submit (kind, id, target state) entries and get a Future back. A
+# single background thread batches all pending entries of one kind into one
+# describe call per tick, so 50 NAT gateways cost one describe_nat_gateways
+# call per tick instead of 50 polling loops. Every entry backs off on its own:
+# it is polled quickly at first and more slowly the longer it stays pending.
+#
+# EC2 is eventually consistent: a resource created moments ago can be
+# missing from a describe. An ID the describe does not return counts as its
+# kind's 'missing' state (terminated, deleted, ...) only when that is what
+# the entry waits for, or once not_found_grace seconds have passed since it
+# was submitted; until then it is still pending.
+import time
+import threading
+from concurrent.futures import Future
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+from scheduler import priority, WAITER
+from describe import iter_resources, id_params, record_id, record_state
+
+class WaiterFailed(Exception):
+  def __init__(self, kind, id, state):
+    super().__init__(f'{kind} {id} reached state {state}')
+    self.kind = kind
+    self.id = id
+    self.state = state
+
+def _chunks(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+def _states(kind, client, ids):
+  states = {}
+  for chunk in _chunks(ids, 200):
+    for record in iter_resources(kind, client=client, **id_params(kind, chunk)):
+      states[record_id(kind, record)] = record_state(kind, record)
+  return states
+
+def _instance_states(client, ids):
+  return _states('instance', client, ids)
+
+def _nat_gateway_states(client, ids):
+  return _states('nat_gateway', client, ids)
+
+def _load_balancer_states(client, arns):
+  states = {}
+  for chunk in _chunks(arns, 20):
+    try:
+      response = client.describe_load_balancers(LoadBalancerArns=chunk)
+      load_balancers = response['LoadBalancers']
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'LoadBalancerNotFound':
+        raise
+      # one deleted ARN fails the whole batch, fall back to one call per ARN
+      load_balancers = []
+      for arn in chunk:
+        try:
+          load_balancers += client.describe_load_balancers(LoadBalancerArns=[arn])['LoadBalancers']
+        except ClientError as e:
+          if e.response['Error']['Code'] != 'LoadBalancerNotFound':
+            raise
+    for load_balancer in load_balancers:
+      states[load_balancer['LoadBalancerArn']] = load_balancer['State']['Code']
+  return states
+
+def _image_states(client, ids):
+  # an ImageIds parameter fails the call for an unknown ID, the filter does not
+  states = {}
+  for chunk in _chunks(ids, 200):
+    for image in client.describe_images(Filters=[{'Name': 'image-id', 'Values': chunk}])['Images']:
+      states[image['ImageId']] = image['State']
+  return states
+
+def target_health_id(target_group_arn, target_id):
+  # waiter ID of one target's health in one target group
+  return f'{target_group_arn}|{target_id}'
+
+def _target_health_states(client, ids):
+  # one describe_target_health per target group, covering all of its targets
+  targets = {}
+  for id in ids:
+    target_group_arn, target_id = id.split('|', 1)
+    targets.setdefault(target_group_arn, []).append(target_id)
+  states = {}
+  for target_group_arn, target_ids in targets.items():
+    response = client.describe_target_health(TargetGroupArn=target_group_arn)
+    for description in response['TargetHealthDescriptions']:
+      id = target_health_id(target_group_arn, description['Target']['Id'])
+      states[id] = description['TargetHealth']['State']
+  return states
+
+# kind -> service, batched describe, state of a resource that is gone,
+# failure states per target, first poll delay
+KINDS = {
+  'instance': {
+    'service': 'ec2',
+    'describe': _instance_states,
+    'missing': 'terminated',
+    'failures': {'running': {'shutting-down', 'terminated', 'stopping', 'stopped'},
+                 'stopped': {'shutting-down', 'terminated'}},
+    'first_delay': 2.0,
+  },
+  'nat_gateway': {
+    'service': 'ec2',
+    'describe': _nat_gateway_states,
+    'missing': 'deleted',
+    'failures': {'available': {'failed', 'deleting', 'deleted'}},
+    'first_delay': 5.0,
+  },
+  'load_balancer': {
+    'service': 'elbv2',
+    'describe': _load_balancer_states,
+    'missing': 'deleted',
+    'failures': {'active': {'failed', 'deleted'}},
+    'first_delay': 3.0,
+  },
+  # targets are 'unused' until a listener forwards to their group and
+  # 'unhealthy' until their first checks pass, so neither is a failure
+  'target_health': {
+    'service': 'elbv2',
+    'describe': _target_health_states,
+    'missing': 'unused',
+    'failures': {'healthy': {'draining'}},
+    'first_delay': 5.0,
+  },
+  'image': {
+    'service': 'ec2',
+    'describe': _image_states,
+    'missing': 'deregistered',
+    'failures': {'available': {'failed', 'invalid', 'error', 'deregistered'}},
+    'first_delay': 15.0,
+  },
+}
+
+class _Entry:
+  __slots__ = ('kind', 'id', 'targets', 'client', 'future', 'delay', 'due', 'deadline', 'submitted')
+
+class WaiterService:
+  def __init__(self, max_delay=30.0, backoff=1.5, timeout=1800, delay_scale=1.0, not_found_grace=60.0):
+    # delay_scale shortens every delay, for stand-ins that change state at once
+    self.delay_scale = delay_scale
+    self.not_found_grace = not_found_grace
+    self.max_delay = max_delay
+    self.backoff = backoff
+    self.timeout = timeout
+    self.calls = 0
+    self._entries = {}
+    self._cond = threading.Condition()
+    self._thread = None
+
+  def submit(self, kind, id, target, client=None, timeout=None):
+    spec = KINDS[kind]
+    targets = frozenset([target] if isinstance(target, str) else target)
+    client = client or get_client(spec['service'])
+    key = (kind, id, targets, client)
+    now = time.monotonic()
+    with self._cond:
+      entry = self._entries.get(key)
+      if entry is not None:
+        return entry.future
+      entry = _Entry()
+      entry.kind = kind
+      entry.id = id
+      entry.targets = targets
+      entry.client = client
+      entry.future = Future()
+      entry.delay = spec['first_delay'] * self.delay_scale
+      entry.due = now + entry.delay
+      entry.deadline = now + (timeout or self.timeout)
+      entry.submitted = now
+      self._entries[key] = entry
+      if self._thread is None or not self._thread.is_alive():
+        self._thread = threading.Thread(target=self._loop, name='waiter-service', daemon=True)
+        self._thread.start()
+      self._cond.notify()
+    return entry.future
+
+  def wait(self, kind, id, target, client=None, timeout=None):
+    return self.submit(kind, id, target, client=client, timeout=timeout).result()
+
+  def _loop(self):
+    while True:
+      with self._cond:
+        while True:
+          if not self._entries:
+            self._cond.wait()
+            continue
+          now = time.monotonic()
+          next_due = min(entry.due for entry in self._entries.values())
+          if next_due <= now:
+            break
+          self._cond.wait(next_due - now)
+        # poll every kind that has at least one entry due, and take all of
+        # that kind's entries along in the same call
+        groups = {}
+        for key, entry in self._entries.items():
+          groups.setdefault((entry.kind, entry.client), []).append((key, entry))
+        due = [(group, entries) for group, entries in groups.items()
+               if any(entry.due <= now for key, entry in entries)]
+      for (kind, client), entries in due:
+        self._poll(kind, client, entries)
+
+  def _poll(self, kind, client, entries):
+    spec = KINDS[kind]
+    ids = sorted(set(entry.id for key, entry in entries))
+    try:
+      self.calls += 1
+      with priority(WAITER):
+        states = spec['describe'](client, ids)
+    except Exception as e:
+      self._finish(entries, exception=e)
+      return
+    now = time.monotonic()
+    finished = []
+    for key, entry in entries:
+      state = states.get(entry.id)
+      if entry.id not in states:
+        if spec['missing'] in entry.targets or now - entry.submitted >= self.not_found_grace:
+          state = spec['missing']
+        else:
+          state = 'not found yet'
+      failures = set()
+      for target in entry.targets:
+        failures |= spec['failures'].get(target, set())
+      if state in entry.targets:
+        finished.append((key, entry, state, None))
+      elif state in failures:
+        finished.append((key, entry, None, WaiterFailed(kind, entry.id, state)))
+      elif now >= entry.deadline:
+        finished.append((key, entry, None, TimeoutError(f'{kind} {entry.id} still {state}')))
+      elif entry.due <= now:
+        entry.delay = min(self.max_delay * self.delay_scale, entry.delay * self.backoff)
+        entry.due = now + entry.delay
+    with self._cond:
+      for key, entry, state, error in finished:
+        self._entries.pop(key, None)
+    for key, entry, state, error in finished:
+      if error is None:
+        entry.future.set_result(state)
+      else:
+        entry.future.set_exception(error)
+
+  def _finish(self, entries, exception):
+    with self._cond:
+      for key, entry in entries:
+        self._entries.pop(key, None)
+    for key, entry in entries:
+      entry.future.set_exception(exception)
+
+_service = None
+_service_lock = threading.Lock()
+
+def waiter_service():
+  global _service
+  if _service is None:
+    with _service_lock:
+      if _service is None:
+        _service = WaiterService()
+  return _service
+
+def use_waiter_service(service):
+  global _service
+  _service = service
+  return service
+
+def wait_for(kind, id, target, client=None, timeout=None):
+  return waiter_service().wait(kind, id, target, client=client, timeout=timeout)
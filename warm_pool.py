@@ -0,0 +1,182 @@
+#----------------
+# warm_pool.py
+#-----------------
+# Warm pool of stopped, bootstrapped instances per (AMI, instance type,
+# subnet).
+#
+# Pool instances are launched from the same launch template as
+# setup_instance(), with the userdata followed by a shutdown
+# (bake.with_shutdown()), so an instance stops by itself once its bootstrap
+# is done. acquire() takes a stopped instance out of the pool, gives it the
+# Name and auto-delete tags setup_instance() would have given it and starts
+# it, which takes seconds instead of a full boot and install. The pool is
+# refilled in the background.
+#
+# Every pool instance carries the pool's lineage tag. A pool only ever looks
+# at the instances of its own lineage, and load() terminates (recycles)
+# those launched from another AMI or launch configuration instead of
+# handing them out. Other pools' instances, even in the same subnet and of
+# the same type, are left alone. The lineage defaults to one per AMI,
+# instance type and subnet; give a pool a lineage name to have the pool of
+# a new AMI replace the pool of the old one.
+#
+#   pool = WarmPool(AMI, subnet_id, security_group_id, key_pair_name, userdata, 'm5.large', size=4, lineage='web')
+#   pool.load().refill()
+#   instance = pool.acquire('RHEL8')
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import get_client
+from describe import iter_instances, tag_value
+from handles import Instance
+from inventory import remember
+from bake import launch_image, with_shutdown
+from waiters import waiter_service
+from my_functions import launch_params, run_instances, setup_instance, log
+
+POOL_TAG = 'warm-pool'
+CONFIG_TAG = 'warm-pool-config'
+LINEAGE_TAG = 'warm-pool-lineage'
+
+def pool_key(AMI, instance_type, subnet_id):
+  return hashlib.sha256(f'{AMI}\0{instance_type}\0{subnet_id}'.encode('utf-8')).hexdigest()[:16]
+
+class WarmPool:
+  def __init__(self, AMI, subnet_id, security_group_id, key_pair_name, userdata, instance_type, bool_public,
+               size=2, lineage=None, client=None):
+    self.AMI = AMI
+    self.subnet_id = subnet_id
+    self.security_group_id = security_group_id
+    self.key_pair_name = key_pair_name
+    self.userdata = userdata
+    self.instance_type = instance_type
+    self.bool_public = bool_public
+    self.size = size
+    self.client = client or get_client('ec2')
+    self.key = pool_key(AMI, instance_type, subnet_id)
+    self.lineage = lineage or self.key
+    self.name = f'warm-{self.key}'
+    self.ready = []
+    self.filling = set()
+    self._lock = threading.Lock()
+    self._refiller = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'warm-pool-{self.key}')
+    self._configs = {}
+
+  def _tags(self):
+    return [{'Key': 'Name', 'Value': self.name}, {'Key': 'auto-delete', 'Value': 'no'},
+            {'Key': POOL_TAG, 'Value': self.key}, {'Key': CONFIG_TAG, 'Value': self.config()},
+            {'Key': LINEAGE_TAG, 'Value': self.lineage}]
+
+  def _launch(self):
+    # (AMI, userdata) to launch with, a baked image once there is one
+    return launch_image(self.AMI, self.userdata, self.instance_type, client=self.client)
+
+  def _params(self, count, tags, launch=None):
+    AMI, userdata = launch or self._launch()
+    params = launch_params(AMI, self.subnet_id, self.security_group_id, self.key_pair_name,
+                           with_shutdown(userdata), self.instance_type, self.bool_public,
+                           tags, count=count, client=self.client)
+    params['InstanceInitiatedShutdownBehavior'] = 'stop'
+    return params
+
+  def config(self):
+    # the launch template version pool instances are launched from now; a
+    # pool instance tagged with any other version is stale. A bake changes it.
+    launch = self._launch()
+    if launch not in self._configs:
+      template = self._params(1, [], launch)['LaunchTemplate']
+      self._configs[launch] = f'{template["LaunchTemplateId"]}:{template["Version"]}'
+    return self._configs[launch]
+
+  def members(self):
+    # every instance of this pool's lineage, including those launched from
+    # an older AMI or launch configuration
+    filters = [{'Name': f'tag:{LINEAGE_TAG}', 'Values': [self.lineage]},
+               {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]
+    return list(iter_instances(filters, client=self.client))
+
+  def load(self):
+    # Picks up the pool instances that already exist, recycles the stale
+    # ones and waits in the background for the ones still bootstrapping.
+    stale = []
+    with self._lock:
+      known = set(self.ready) | self.filling
+    for record in self.members():
+      instance_id = record['InstanceId']
+      if instance_id in known:
+        continue
+      if tag_value(record, POOL_TAG) != self.key or tag_value(record, CONFIG_TAG) != self.config():
+        stale.append(instance_id)
+      elif record['State']['Name'] == 'stopped':
+        with self._lock:
+          self.ready.append(instance_id)
+      else:
+        self._watch(instance_id)
+    self.recycle(stale)
+    return self
+
+  def recycle(self, instance_ids):
+    if instance_ids:
+      self.client.terminate_instances(InstanceIds=list(instance_ids))
+      log('Warm pool recycled', ', '.join(instance_ids))
+
+  def _watch(self, instance_id):
+    with self._lock:
+      self.filling.add(instance_id)
+    stopped = waiter_service().submit('instance', instance_id, 'stopped', client=self.client)
+    stopped.add_done_callback(lambda future: self._stopped(instance_id, future))
+
+  def _stopped(self, instance_id, future):
+    with self._lock:
+      if instance_id not in self.filling:
+        # drained meanwhile
+        return
+      self.filling.discard(instance_id)
+      if future.exception() is None:
+        self.ready.append(instance_id)
+    if future.exception() is not None:
+      log('Warm pool instance failed', instance_id)
+      self.recycle([instance_id])
+      self.refill_async()
+
+  def refill(self):
+    with self._lock:
+      shortfall = self.size - len(self.ready) - len(self.filling)
+    if shortfall <= 0:
+      return []
+    instances = run_instances(lambda: self._params(shortfall, self._tags()), client=self.client)
+    for record in instances:
+      self._watch(record['InstanceId'])
+    log('Warm pool launched', f'{self.name} x {len(instances)}')
+    return [record['InstanceId'] for record in instances]
+
+  def refill_async(self):
+    return self._refiller.submit(self.refill)
+
+  def acquire(self, instance_name):
+    # A started pool instance named instance_name, or a freshly launched one
+    # when the pool is empty. The pool is refilled in the background either way.
+    with self._lock:
+      instance_id = self.ready.pop(0) if self.ready else None
+    self.refill_async()
+    if instance_id is None:
+      log('Warm pool empty', self.name)
+      return setup_instance(self.AMI, self.subnet_id, self.security_group_id, instance_name, self.key_pair_name,
+                            self.userdata, self.instance_type, self.bool_public, client=self.client)
+    tags = [{'Key': 'Name', 'Value': instance_name}, {'Key': 'auto-delete', 'Value': 'no'}]
+    self.client.create_tags(Resources=[instance_id], Tags=tags)
+    self.client.delete_tags(Resources=[instance_id], Tags=[{'Key': POOL_TAG}, {'Key': CONFIG_TAG}, {'Key': LINEAGE_TAG}])
+    self.client.start_instances(InstanceIds=[instance_id])
+    record = remember('instance', {'InstanceId': instance_id, 'State': {'Name': 'pending'},
+                                   'SubnetId': self.subnet_id, 'Tags': tags}, client=self.client)
+    log('EC2 Instance started from warm pool', instance_name)
+    return Instance.from_record(record, self.client)
+
+  def drain(self):
+    # terminate every instance still in the pool
+    self._refiller.shutdown(wait=True)
+    with self._lock:
+      instance_ids = self.ready + list(self.filling)
+      self.ready = []
+      self.filling = set()
+    self.recycle(instance_ids)